@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+import argparse
+import bisect
+import datetime
+import json
+import random
+import sys
+import time
+
+try:
+    from urllib import urlencode
+    from urllib2 import Request, urlopen, HTTPError
+except ImportError:
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+
+"""
+Benchmark of the plays API.
+
+Generates a synthetic dataset (channels, songs with Zipf distributed
+popularity, plays over a time span), ingests it through add_play and then
+runs random get_channel_plays, get_song_plays and get_top queries. Requests
+go through the Flask test client (the in-memory storage of the `testing`
+configuration by default) or to a running server with --url.
+
+Every endpoint is warmed up first, then measured in --repeat repetitions:
+the plays are ingested in as many chunks and the queries run as many times.
+Reports the median throughput and latency percentiles of the repetitions per
+endpoint, with their median absolute deviation, optionally saved as JSON, and
+compares them against a saved baseline of a run with the same parameters:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+
+PLAY_LENGTH = datetime.timedelta(minutes=3)
+WINDOW = datetime.timedelta(days=7)
+
+METRICS = ('throughput', 'mean', 'p50', 'p90', 'p99')
+
+# Parameters that change the workload, which must match the baseline's
+WORKLOAD_PARAMETERS = (
+    'url', 'config', 'channels', 'songs', 'performers', 'plays', 'days', 'skew',
+    'queries', 'top_channels', 'limit', 'seed', 'repeat', 'warmup'
+)
+
+
+class TestClient(object):
+    """Sends requests to the app through Flask's test client"""
+    def __init__(self, config, log_level):
+        import logging
+        from plays import create_app
+        self.client = create_app(config).test_client()
+        logging.getLogger().setLevel(log_level)
+
+    def get(self, endpoint, params):
+        r = self.client.get('/' + endpoint, query_string=params)
+        return r.status_code, r.data
+
+    def post(self, endpoint, data):
+        r = self.client.post('/' + endpoint, data=data, content_type='application/json')
+        return r.status_code, r.data
+
+
+class HttpClient(object):
+    """Sends requests to a running server"""
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def get(self, endpoint, params):
+        return self._open(
+            Request('%s/%s?%s' % (self.url, endpoint, urlencode(params)))
+        )
+
+    def post(self, endpoint, data):
+        return self._open(Request(
+            '%s/%s' % (self.url, endpoint),
+            data.encode('utf-8'),
+            {'Content-Type': 'application/json'}
+        ))
+
+    def _open(self, req):
+        try:
+            response = urlopen(req)
+            return response.getcode(), response.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+
+class ZipfSampler(object):
+    """Samples ranks in [0, n) with probability proportional to 1 / (rank + 1)^s"""
+    def __init__(self, n, s, rnd):
+        self.rnd = rnd
+        self.cumulative = []
+        total = 0.0
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** s
+            self.cumulative.append(total)
+
+    def sample(self):
+        x = self.rnd.random() * self.cumulative[-1]
+        return min(bisect.bisect_left(self.cumulative, x), len(self.cumulative) - 1)
+
+
+def generate_dataset(args, rnd):
+    channels = [u'Channel%d' % i for i in range(args.channels)]
+    songs = [(u'Song%d' % i, u'Performer%d' % (i % args.performers))
+             for i in range(args.songs)]
+    start = datetime.datetime(2016, 1, 1)
+    span = int(args.days * 24 * 3600)
+
+    sampler = ZipfSampler(len(songs), args.skew, rnd)
+    plays = []
+    for _ in range(args.plays):
+        title, performer = songs[sampler.sample()]
+        play_start = start + datetime.timedelta(seconds=rnd.randrange(span))
+        plays.append({
+            'channel': rnd.choice(channels),
+            'title': title,
+            'performer': performer,
+            'start': play_start.isoformat(),
+            'end': (play_start + PLAY_LENGTH).isoformat(),
+        })
+
+    return {
+        'channels': channels,
+        'songs': songs,
+        'sampler': sampler,
+        'start': start,
+        'end': start + datetime.timedelta(seconds=span),
+        'plays': plays,
+    }
+
+
+class Recorder(object):
+    """Statistics of every repetition per endpoint"""
+    def __init__(self):
+        self.runs = {}
+
+    def run(self, endpoint, requests, record=True):
+        """Send the requests, recording their statistics as a repetition if record is set"""
+        latencies = []
+        errors = 0
+        t0 = time.time()
+        for request in requests:
+            t = time.time()
+            status, _ = request()
+            latencies.append(time.time() - t)
+            if status != 200:
+                errors += 1
+        elapsed = time.time() - t0
+        if not record or not latencies:
+            return
+
+        latencies.sort()
+        self.runs.setdefault(endpoint, []).append({
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / elapsed if elapsed else 0,
+            'mean': 1000 * sum(latencies) / len(latencies),
+            'p50': 1000 * percentile(latencies, 50),
+            'p90': 1000 * percentile(latencies, 90),
+            'p99': 1000 * percentile(latencies, 99),
+        })
+
+    def report(self):
+        """Medians of the repetitions, with their median absolute deviations as <metric>_mad"""
+        report = {}
+        for endpoint, runs in self.runs.items():
+            stats = {
+                'requests': sum(run['requests'] for run in runs),
+                'errors': sum(run['errors'] for run in runs),
+                'repetitions': len(runs),
+            }
+            for key in METRICS:
+                values = [run[key] for run in runs]
+                stats[key] = median(values)
+                stats[key + '_mad'] = median([abs(value - stats[key]) for value in values])
+            report[endpoint] = stats
+        return report
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    i = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return 0
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    dataset = generate_dataset(args, rnd)
+    client = HttpClient(args.url) if args.url else TestClient(args.config, args.log_level)
+    recorder = Recorder()
+
+    if args.truncate:
+        client.post('truncate_tables', json.dumps({'truncate': True}))
+
+    def random_window():
+        span = int((dataset['end'] - dataset['start'] - WINDOW).total_seconds())
+        start = dataset['start'] + datetime.timedelta(seconds=rnd.randrange(max(span, 1)))
+        return start, start + WINDOW
+
+    def post(endpoint, data):
+        return lambda: client.post(endpoint, json.dumps(data))
+
+    def get(endpoint, params):
+        return lambda: client.get(endpoint, params)
+
+    # The first plays warm up add_play, the rest are ingested in a chunk per
+    # repetition, of sizes differing by one at most
+    plays = dataset['plays']
+    warmup = min(args.warmup, len(plays))
+    recorder.run('add_play', (post('add_play', play) for play in plays[:warmup]), record=False)
+    bounds = [
+        warmup + (len(plays) - warmup) * i // args.repeat
+        for i in range(args.repeat + 1)
+    ]
+    for first, last in zip(bounds, bounds[1:]):
+        recorder.run('add_play', (post('add_play', play) for play in plays[first:last]))
+
+    def channel_plays(queries):
+        for _ in range(queries):
+            start, end = random_window()
+            yield get('get_channel_plays', {
+                'channel': rnd.choice(dataset['channels']),
+                'start': start.isoformat(),
+                'end': end.isoformat(),
+            })
+
+    def song_plays(queries):
+        for _ in range(queries):
+            start, end = random_window()
+            title, performer = dataset['songs'][dataset['sampler'].sample()]
+            yield get('get_song_plays', {
+                'title': title.encode('utf-8'),
+                'performer': performer.encode('utf-8'),
+                'start': start.isoformat(),
+                'end': end.isoformat(),
+            })
+
+    def top(queries):
+        for _ in range(queries):
+            start, _ = random_window()
+            channels = rnd.sample(dataset['channels'], min(args.top_channels, len(dataset['channels'])))
+            yield get('get_top', {
+                'channels': json.dumps(channels),
+                'start': start.isoformat(),
+                'limit': args.limit,
+            })
+
+    queries = (
+        ('get_channel_plays', channel_plays),
+        ('get_song_plays', song_plays),
+        ('get_top', top),
+    )
+    for endpoint, requests in queries:
+        recorder.run(endpoint, requests(args.warmup), record=False)
+    for _ in range(args.repeat):
+        for endpoint, requests in queries:
+            recorder.run(endpoint, requests(args.queries))
+
+    return recorder.report()
+
+
+def parameter_differences(args, baseline):
+    """Workload parameters of the run that differ from the baseline's"""
+    parameters = baseline.get('parameters', {})
+    return [
+        '%s: %r -> %r' % (name, parameters.get(name), getattr(args, name))
+        for name in WORKLOAD_PARAMETERS
+        if parameters.get(name) != getattr(args, name)
+    ]
+
+
+def compare(report, baseline, threshold, noise):
+    """
+    Returns the regressions of the report with respect to the baseline. A
+    metric regresses when its median is worse than the baseline's by more
+    than the threshold, relative to the baseline, and by more than noise
+    times the larger median absolute deviation of both runs.
+    """
+    regressions = []
+    for endpoint, stats in sorted(report.items()):
+        base = baseline.get('endpoints', {}).get(endpoint)
+        if not base:
+            continue
+        for key in ('throughput', 'p50', 'p90', 'p99'):
+            if not base[key]:
+                continue
+            margin = max(
+                threshold * base[key],
+                noise * max(base.get(key + '_mad', 0), stats.get(key + '_mad', 0))
+            )
+            # Lower is worse for throughput, higher for latencies
+            worse = base[key] - stats[key] if key == 'throughput' else stats[key] - base[key]
+            if worse > margin:
+                unit = 'req/s' if key == 'throughput' else 'ms'
+                regressions.append('%s %s: %.2f %s -> %.2f %s (margin %.2f %s)' % (
+                    endpoint, key, base[key], unit, stats[key], unit, margin, unit))
+    return regressions
+
+
+def print_report(report, baseline=None):
+    base = (baseline or {}).get('endpoints', {})
+    print('Medians of %d repetitions' % max(
+        [s.get('repetitions', 1) for s in report.values()] or [0]))
+    print('%-18s %8s %7s %10s %9s %9s %9s %9s' % (
+        'Endpoint', 'Requests', 'Errors', 'Req/s', 'Mean', 'p50', 'p90', 'p99'))
+    for endpoint in ('add_play', 'get_channel_plays', 'get_song_plays', 'get_top'):
+        if endpoint not in report:
+            continue
+        s = report[endpoint]
+        print('%-18s %8d %7d %10.1f %9.2f %9.2f %9.2f %9.2f' % (
+            endpoint, s['requests'], s['errors'], s['throughput'],
+            s['mean'], s['p50'], s['p90'], s['p99']))
+        if endpoint in base:
+            b = base[endpoint]
+            print('%-18s %8s %7s %10.1f %9.2f %9.2f %9.2f %9.2f' % (
+                '  baseline', '', '', b['throughput'], b['mean'], b['p50'], b['p90'], b['p99']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plays API benchmark')
+    parser.add_argument('--url', help='Base URL of a running server. '
+                        'The Flask test client is used if not given')
+    parser.add_argument('--config', default='testing',
+                        help='App configuration for the test client')
+    parser.add_argument('--log-level', default='WARNING', dest='log_level',
+                        help='Log level of the app run by the test client')
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--songs', type=int, default=1000)
+    parser.add_argument('--performers', type=int, default=200)
+    parser.add_argument('--plays', type=int, default=20000)
+    parser.add_argument('--days', type=float, default=60)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Exponent of the Zipf distribution of song plays')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='Requests per query endpoint and repetition')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Measured repetitions of every endpoint')
+    parser.add_argument('--warmup', type=int, default=50,
+                        help='Requests per endpoint sent before measuring')
+    parser.add_argument('--top-channels', type=int, default=10, dest='top_channels')
+    parser.add_argument('--limit', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--truncate', action='store_true',
+                        help='Truncate the tables before ingesting the dataset')
+    parser.add_argument('--output', help='Save the results as JSON')
+    parser.add_argument('--baseline', help='Compare with the results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown reported as a regression')
+    parser.add_argument('--noise', type=float, default=3,
+                        help='Slowdowns within this many median absolute deviations '
+                             'of the repetitions are not regressions')
+
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differences = parameter_differences(args, baseline)
+        if differences:
+            print('The baseline was run with different parameters:')
+            for difference in differences:
+                print('  %s' % difference)
+            sys.exit(2)
+
+    report = run(args)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'parameters': dict((k, v) for k, v in vars(args).items()
+                                   if k in WORKLOAD_PARAMETERS),
+                'endpoints': report,
+            }, f, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare(report, baseline, args.threshold, args.noise)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        sys.exit(1 if regressions else 0)
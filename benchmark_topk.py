@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import argparse
+import bisect
+import itertools
+import json
+import random
+import sys
+import time
+from collections import Counter
+
+from plays import topk
+
+"""
+Microbenchmark and correctness check of the top-k algorithms of plays/topk.py.
+
+Builds synthetic song count databases ({channel: {song: count}}) sweeping the
+number of channels, the size of the song catalog, k and the skew of the
+song popularity. For every case and algorithm it checks the result against an
+exact sum-and-sort aggregation and records the time and the number of sorted
+and random accesses:
+
+    python benchmark_topk.py
+    python benchmark_topk.py --channels 10 50 --songs 1000 10000 --k 10 40
+    python benchmark_topk.py --output topk.json
+
+Exits with an error if an algorithm returns a wrong result.
+"""
+
+
+def generate_counts(channels, songs, skew, plays_per_channel, rnd):
+    """
+    Song counts of every channel. Songs are drawn from a catalog of the given
+    size with Zipf distributed popularity, shuffled per channel so that
+    channels do not share the same ranking.
+    """
+    weights = [1.0 / (rank + 1) ** skew for rank in range(songs)]
+    catalog = ['Song%d' % i for i in range(songs)]
+
+    m = {}
+    for c in range(channels):
+        order = list(catalog)
+        # Keep the popular songs mostly popular everywhere by only shuffling
+        # a fraction of them
+        for i in range(len(order) // 10):
+            a, b = rnd.randrange(songs), rnd.randrange(songs)
+            order[a], order[b] = order[b], order[a]
+        counts = Counter(_weighted_sample(order, weights, plays_per_channel, rnd))
+        m['Channel%d' % c] = dict(counts)
+    return m
+
+
+def _weighted_sample(population, weights, n, rnd):
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    for _ in range(n):
+        i = bisect.bisect_left(cumulative, rnd.random() * total)
+        yield population[min(i, len(population) - 1)]
+
+
+def sum_and_sort(m, k):
+    """Sum the scores of every item over all lists and sort"""
+    scores = Counter()
+    for l_value in m.values():
+        scores.update(l_value)
+    return sorted(scores.items(), key=lambda x: -x[1])[:k]
+
+
+def check(m, result, expected):
+    """
+    Check a result against the exact top-k. Items with equal scores may be
+    returned in any order, so the scores are compared by position and the
+    score of every returned item is recomputed.
+    """
+    if len(result) != len(expected):
+        return 'returned %d items instead of %d' % (len(result), len(expected))
+    for (item, score), (_, expected_score) in zip(result, expected):
+        if score != expected_score:
+            return 'score %s of %s instead of %s' % (score, item, expected_score)
+        actual = sum(l_value.get(item, 0) for l_value in m.values())
+        if actual != score:
+            return 'score %s of %s, actually %s' % (score, item, actual)
+    if len(set(item for item, _ in result)) != len(result):
+        return 'duplicated items'
+
+
+def run_case(m, k, algorithms, repeat):
+    expected = sum_and_sort(m, k)
+    results = {}
+
+    t = time.time()
+    for _ in range(repeat):
+        sum_and_sort(m, k)
+    results['sort'] = {'time': 1000 * (time.time() - t) / repeat}
+
+    for name in algorithms:
+        stats = {}
+        t = time.time()
+        for _ in range(repeat):
+            result = topk.ALGORITHMS[name](m, k, stats)
+        elapsed = 1000 * (time.time() - t) / repeat
+        results[name] = {
+            'time': elapsed,
+            'sorted_accesses': stats['sorted_accesses'],
+            'random_accesses': stats['random_accesses'],
+            'error': check(m, result, expected),
+        }
+    return results
+
+
+def print_results(case, results, algorithms):
+    print('channels=%(channels)d songs=%(songs)d k=%(k)d skew=%(skew)s' % case)
+    print('  %-8s %10s %10s %10s' % ('', 'ms', 'sorted', 'random'))
+    print('  %-8s %10.2f %10s %10s' % ('sort', results['sort']['time'], '', ''))
+    for name in algorithms:
+        r = results[name]
+        print('  %-8s %10.2f %10d %10d%s' % (
+            name, r['time'], r['sorted_accesses'], r['random_accesses'],
+            '  WRONG: %s' % r['error'] if r['error'] else ''
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Top-k algorithms benchmark')
+    parser.add_argument('--channels', type=int, nargs='+', default=[2, 10, 50],
+                        help='Numbers of lists')
+    parser.add_argument('--songs', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Sizes of the song catalog')
+    parser.add_argument('--k', type=int, nargs='+', default=[10, 40])
+    parser.add_argument('--skew', type=float, nargs='+', default=[0.5, 1.0, 1.5],
+                        help='Exponents of the Zipf distribution of song plays')
+    parser.add_argument('--plays', type=int, default=5000,
+                        help='Plays per channel')
+    parser.add_argument('--algorithms', nargs='+', default=sorted(topk.ALGORITHMS),
+                        choices=sorted(topk.ALGORITHMS))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of every algorithm per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Save the results as JSON')
+
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    cases = []
+    failed = False
+    for channels, songs, skew in itertools.product(args.channels, args.songs, args.skew):
+        m = generate_counts(channels, songs, skew, args.plays, rnd)
+        for k in args.k:
+            case = {'channels': channels, 'songs': songs, 'k': k, 'skew': skew}
+            results = run_case(m, k, args.algorithms, args.repeat)
+            print_results(case, results, args.algorithms)
+            failed = failed or any(results[name]['error'] for name in args.algorithms)
+            cases.append(dict(case, results=results))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'parameters': vars(args),
+                'cases': cases,
+            }, f, indent=2, sort_keys=True)
+
+    sys.exit(1 if failed else 0)
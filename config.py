@@ -9,9 +9,139 @@ class Config(object):
     DEBUG = False
     TESTING = False
     
+    # Storage backend: 'cassandra', or 'memory' to keep the data in process
+    # memory (no cluster needed, for benchmarks and tests)
+    STORAGE = 'cassandra'
+
     CASSANDRA_CONTACT_POINTS = ['127.0.0.1']
     CASSANDRA_KEYSPACE = 'plays'
 
+    # Driver settings. Requests are routed to the replicas of their partition
+    # in CASSANDRA_LOCAL_DC (None for the datacenter of the contact points).
+    # Pool sizes are connections per host and only apply to protocol versions
+    # 1 and 2: they are ignored with the default version 3, which multiplexes
+    # requests over one connection per host. Timeouts are in seconds.
+    CASSANDRA_PROTOCOL_VERSION = 3
+    CASSANDRA_LOCAL_DC = None
+    CASSANDRA_CORE_CONNECTIONS = 2
+    CASSANDRA_MAX_CONNECTIONS = 8
+    CASSANDRA_CONNECT_TIMEOUT = 5
+    CASSANDRA_REQUEST_TIMEOUT = 10
+
+    # Default top-k algorithm for get_top: 'fa', 'ta', 'bpa', 'bpa2' or 'exact'
+    TOPK_ALGORITHM = 'bpa2'
+
+    # Compute get_top song counts from the hourly rollups instead of scanning
+    # play_by_channel. Rollups are only written while it is enabled, so run
+    # `python manage.py backfill_rollups` when enabling it on a database with
+    # existing plays, or get_top will miss them. Rollups are counters: a play
+    # posted again, which overwrites the stored play, is counted twice.
+    SONG_COUNTS_FROM_ROLLUPS = False
+
+    # Coarser rollups, among 'day', 'week' (from Monday) and 'month', also
+    # incremented on every play with SONG_COUNTS_FROM_ROLLUPS. Windows are split into the fewest whole
+    # buckets of these and of hours, so long windows read a few buckets instead
+    # of one per hour, at the cost of a counter update per resolution and play.
+    # Run `python manage.py backfill_rollups` after changing them on a database
+    # with existing plays.
+    ROLLUP_RESOLUTIONS = []
+
+    # How plays are counted when scanning play_by_channel: 'uda' aggregates
+    # them in Cassandra with the group_and_count UDA (requires UDFs enabled),
+    # 'client' pages through the (title, performer) columns and counts them
+    # in Python
+    SONG_COUNTS_ENGINE = 'uda'
+    SONG_COUNTS_FETCH_SIZE = 5000
+
+    # Store and count channels and songs by integer ids instead of their
+    # names, translated back when responding. Ids are allocated in blocks of
+    # DICTIONARY_ID_BLOCK_SIZE per process and cached in both directions.
+    # Encoded plays go to separate tables: run `python manage.py encode_plays`
+    # before enabling it on a database with existing plays.
+    DICTIONARY_ENCODING = False
+    DICTIONARY_CACHE_SIZE = 100000
+    DICTIONARY_ID_BLOCK_SIZE = 100
+
+    # Batch ingestion (add_plays): maximum number of plays per request,
+    # requests in flight and statements per partition batch
+    ADD_PLAYS_MAX_ITEMS = 10000
+    ADD_PLAYS_CONCURRENCY = 50
+    ADD_PLAYS_BATCH_SIZE = 100
+
+    # Songs and performers known to be stored are not written again. Entries
+    # are evicted when the cache is full or after the TTL (seconds, None to
+    # keep them until evicted)
+    METADATA_CACHE_SIZE = 100000
+    METADATA_CACHE_TTL = 3600
+
+    # get_top result cache. Results whose window includes the present expire
+    # after TOP_CACHE_LIVE_TTL seconds. Past windows are invalidated when plays
+    # are added to them and expire after TOP_CACHE_TTL (None to never expire).
+    # Invalidation only reaches the process that added the play, so set a TTL
+    # when running several workers.
+    TOP_CACHE_SIZE = 1000
+    TOP_CACHE_LIVE_TTL = 60
+    TOP_CACHE_TTL = None
+
+    # Approximate get_top (approximate=true) from Space-Saving sketches of the
+    # songs played per channel and hour. Sketches are updated in memory on
+    # every play and stored every SKETCH_FLUSH_INTERVAL seconds. They monitor
+    # at most SKETCH_CAPACITY songs, larger sketches give tighter error bounds.
+    # Merged sketches of queried hours are cached for SKETCH_CACHE_TTL seconds
+    # before reading again the sketches stored by other workers. A play posted
+    # again with the same song is skipped when it is among the last
+    # SKETCH_DEDUP_SIZE plays of the process, and counted again otherwise.
+    # Enabling them starts a flush thread in every process.
+    SKETCHES = False
+    SKETCH_CAPACITY = 200
+    SKETCH_FLUSH_INTERVAL = 60
+    SKETCH_CACHE_SIZE = 10000
+    SKETCH_CACHE_TTL = 60
+    SKETCH_DEDUP_SIZE = 100000
+
+    # Weekly charts of groups of channels, as {name: [channel, ...]}. The song
+    # counts of their channels for the current week (Monday to Sunday, UTC)
+    # are kept in memory with the ranked top CHART_SIZE songs of every group,
+    # updated on every play and reloaded every CHART_REFRESH_INTERVAL seconds
+    # to include the plays added by other workers. Charts of a week are frozen
+    # and stored when it ends, for the previous ranks and plays of the next
+    # one. get_top of a group for the whole current week (start on Monday at
+    # 00:00, end on Sunday at 23:59:59) is served from its chart.
+    CHARTS = {}
+    CHART_SIZE = 40
+    CHART_REFRESH_INTERVAL = 300
+
+    # Write-behind mode for add_play: plays are acknowledged once queued and
+    # WRITE_BUFFER_WORKERS threads write them in batches of at most
+    # WRITE_BUFFER_BATCH_SIZE plays, waiting at most WRITE_BUFFER_FLUSH_INTERVAL
+    # seconds for a batch to fill up. add_play answers 503 when
+    # WRITE_BUFFER_SIZE plays are waiting. Queued plays are written on a clean
+    # shutdown but lost if the process is killed.
+    WRITE_BUFFER = False
+    WRITE_BUFFER_SIZE = 10000
+    WRITE_BUFFER_BATCH_SIZE = 500
+    WRITE_BUFFER_FLUSH_INTERVAL = 0.5
+    WRITE_BUFFER_WORKERS = 2
+
+    # Latency histograms per endpoint and stage of the requests, served in the
+    # Prometheus text format by GET /metrics. With METRICS_SERVER_TIMING the
+    # stage durations of every request are also sent in a Server-Timing header.
+    METRICS = True
+    METRICS_SERVER_TIMING = False
+
+    # Profiling of a fraction of the requests and of every request slower than
+    # PROFILE_SLOW_THRESHOLD seconds (None to disable), dumped per endpoint to
+    # PROFILE_DIR. PROFILE_MODE 'cprofile' dumps pstats files, 'sample' samples
+    # the request stacks every PROFILE_INTERVAL seconds and dumps collapsed
+    # stacks. cProfile slows down every request it watches, so prefer sampling
+    # to catch slow requests. Summarize the dumps with manage.py profile_summary.
+    PROFILE = False
+    PROFILE_MODE = 'sample'
+    PROFILE_SAMPLE_RATE = 0.01
+    PROFILE_SLOW_THRESHOLD = 0.5
+    PROFILE_INTERVAL = 0.005
+    PROFILE_DIR = 'profiles'
+
 
 class ProductionConfig(Config):
     pass
@@ -23,6 +153,7 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+    STORAGE = 'memory'
 
 
 config = {
@@ -2,7 +2,7 @@
 
 import os
 
-from flask_script import Manager
+from flask_script import Command, Manager, Option
 
 from plays import create_app
 
@@ -19,5 +19,128 @@ def sync():
     from plays.models import _sync_database
     _sync_database()
 
+@manager.command
+def migrate_buckets(drop=False):
+    from plays.models import _migrate_month_buckets
+    _migrate_month_buckets(drop=drop)
+
+@manager.command
+def backfill_rollups():
+    from plays.models import _backfill_song_counts
+    _backfill_song_counts()
+
+@manager.command
+def encode_plays():
+    """Copy the stored plays to the dictionary encoded tables"""
+    from plays.db import storage
+    from plays.models import _encode_plays
+    _encode_plays(storage.dictionary)
+
+@manager.option('-c', '--channels', dest='channels', required=True,
+                help='Comma separated list of channels')
+@manager.option('-s', '--start', dest='start', required=True)
+@manager.option('-e', '--end', dest='end', default=None)
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=5)
+def benchmark_song_counts(channels, start, end=None, repeat=5):
+    """Compare the song count engines scanning play_by_channel"""
+    import time
+    from datetime import timedelta
+    import dateutil.parser
+    from plays.db import db
+    from plays.models import PlayByChannel
+
+    channels = channels.split(',')
+    start = dateutil.parser.parse(start)
+    end = dateutil.parser.parse(end) if end else start + timedelta(days=7)
+
+    config = dict(db.config)
+    db.config['SONG_COUNTS_FROM_ROLLUPS'] = False
+    results = {}
+    try:
+        for engine in ('uda', 'client'):
+            db.config['SONG_COUNTS_ENGINE'] = engine
+            times = []
+            for _ in range(repeat):
+                t = time.time()
+                results[engine] = PlayByChannel.get_song_counts(channels, start, end)
+                times.append(time.time() - t)
+            times.sort()
+            print('%-6s min %8.1f ms  median %8.1f ms' % (
+                engine, times[0] * 1000, times[len(times) // 2] * 1000))
+    finally:
+        db.config.clear()
+        db.config.update(config)
+
+    print('Results match: %s' % (results['uda'] == results['client']))
+
+@manager.option('-d', '--directory', dest='directory', default=None,
+                help='Directory of the dumps, PROFILE_DIR by default')
+@manager.option('-e', '--endpoint', dest='endpoint', default=None)
+@manager.option('-l', '--limit', dest='limit', type=int, default=20)
+@manager.option('-s', '--sort', dest='sort', default='cumulative',
+                help='pstats sort key of the cProfile dumps')
+def profile_summary(directory=None, endpoint=None, limit=20, sort='cumulative'):
+    """Print the top functions of the profiles dumped by the profiling mode"""
+    from plays.profiler import summarize
+    summarize(directory or app.config.get('PROFILE_DIR', 'profiles'),
+              endpoint=endpoint, limit=limit, sort=sort)
+
+class ImportPlays(Command):
+    """Import plays from a NDJSON or CSV file"""
+
+    option_list = (
+        Option('path'),
+        Option('-f', '--format', dest='fmt', choices=('ndjson', 'csv'), default=None,
+               help='Format of the file, guessed from its extension by default'),
+        Option('-w', '--workers', dest='workers', type=int, default=4,
+               help='Worker processes, 0 to import in process'),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=1000),
+        Option('-c', '--checkpoint', dest='checkpoint', default=None,
+               help='Checkpoint file, <path>.checkpoint by default'),
+        Option('-r', '--resume', dest='resume', action='store_true', default=False,
+               help='Skip the batches of the checkpoint'),
+        Option('-p', '--progress', dest='progress', type=float, default=10,
+               help='Seconds between progress reports'),
+    )
+
+    def run(self, path, fmt, workers, batch_size, checkpoint, resume, progress):
+        from plays.bulk import import_plays
+        failed = import_plays(path, fmt=fmt, workers=workers, batch_size=batch_size,
+                              checkpoint=checkpoint, resume=resume, progress=progress)
+        return 1 if failed else 0
+
+class ExportPlays(Command):
+    """Export the plays of channels to a NDJSON or CSV file"""
+
+    option_list = (
+        Option('path'),
+        Option('-s', '--start', dest='start', required=True),
+        Option('-e', '--end', dest='end', default=None, help='Now by default'),
+        Option('-c', '--channels', dest='channels', default=None,
+               help='Comma separated list of channels, every channel by default'),
+        Option('-f', '--format', dest='fmt', choices=('ndjson', 'csv'), default=None,
+               help='Format of the file, guessed from its extension by default'),
+        Option('-w', '--workers', dest='workers', type=int, default=4,
+               help='Worker processes, 0 to export in process'),
+        Option('-p', '--progress', dest='progress', type=float, default=10,
+               help='Seconds between progress reports'),
+    )
+
+    def run(self, path, start, end, channels, fmt, workers, progress):
+        from datetime import datetime
+        import dateutil.parser
+        from plays.bulk import export_plays
+        export_plays(
+            path,
+            dateutil.parser.parse(start),
+            dateutil.parser.parse(end) if end else datetime.utcnow(),
+            channels=channels.split(',') if channels else None,
+            fmt=fmt, workers=workers, progress=progress
+        )
+
+# import is a keyword, so these commands are not registered by function name
+manager.add_command('import', ImportPlays())
+manager.add_command('export', ExportPlays())
+
 if __name__ == '__main__':
     manager.run()
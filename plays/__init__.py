@@ -29,6 +29,16 @@ def create_app(config_name):
     import yaml
     logging.config.dictConfig(yaml.load(open('logging.yml')))
 
+    # Metrics
+    if app.config.get('METRICS'):
+        from .metrics import metrics as metrics_blueprint
+        app.register_blueprint(metrics_blueprint, url_prefix='')
+
+    # Profiling
+    if app.config.get('PROFILE'):
+        from .profiler import profiler as profiler_blueprint
+        app.register_blueprint(profiler_blueprint, url_prefix='')
+
     # Error Handling
     from .handlers import handlers as handlers_blueprint
     app.register_blueprint(handlers_blueprint, url_prefix='')
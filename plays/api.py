@@ -1,19 +1,120 @@
 # -*- coding: utf-8 -*-
+import base64
 import json
 import logging
+from contextlib import contextmanager
 from datetime import timedelta
 
-from flask import Blueprint, jsonify, request
+import dateutil.parser
+from flask import Blueprint, Response, current_app, jsonify, request
 
-from .models import Song, Performer, Channel, PlayByChannel, PlayBySong, _recreate_keyspace
-from .schemas import channel_schema, performer_schema, song_schema, play_by_channel_schema, play_by_song_schema, request_schema, channels_param_schema
+from .cache import TopCache
+from .db import db, storage
+from .schemas import channel_schema, performer_schema, song_schema, play_by_channel_schema, play_by_song_schema, request_schema, channels_param_schema, play_by_channel_serializer, play_by_song_serializer
+from .buffer import WriteBuffer
+from .charts import ChartStore
 from .exceptions import PlaysException
-import topk
+from .metrics import registry, timed
+from .sketch import SketchStore
+from . import topk
 
 logger = logging.getLogger()
 
 api = Blueprint('api', __name__)
 
+# get_top results
+top_cache = TopCache(
+    maxsize=db.config.get('TOP_CACHE_SIZE', 1000),
+    live_ttl=db.config.get('TOP_CACHE_LIVE_TTL', 60),
+    ttl=db.config.get('TOP_CACHE_TTL')
+)
+
+# Song sketches for the approximate get_top
+sketches = None
+if db.config.get('SKETCHES'):
+    sketches = SketchStore(
+        storage,
+        capacity=db.config.get('SKETCH_CAPACITY', 200),
+        cache_size=db.config.get('SKETCH_CACHE_SIZE', 10000),
+        cache_ttl=db.config.get('SKETCH_CACHE_TTL'),
+        dedup_size=db.config.get('SKETCH_DEDUP_SIZE', 100000)
+    )
+    if db.config.get('SKETCH_FLUSH_INTERVAL'):
+        sketches.start(db.config['SKETCH_FLUSH_INTERVAL'])
+
+# Weekly charts of the configured groups of channels
+charts = None
+if db.config.get('CHARTS'):
+    charts = ChartStore(
+        storage,
+        db.config['CHARTS'],
+        size=db.config.get('CHART_SIZE', 40)
+    )
+    if db.config.get('CHART_REFRESH_INTERVAL'):
+        charts.start(db.config['CHART_REFRESH_INTERVAL'])
+
+
+@contextmanager
+def _writing():
+    """Write of plays and their addition to the charts, which reloads must not overlap"""
+    if charts is None:
+        yield
+    else:
+        with charts.writing():
+            yield
+
+
+def _plays_written(plays):
+    # Results computed while the plays were buffered are stale too
+    for play in plays:
+        top_cache.invalidate(play.channel, play.start)
+        if charts:
+            charts.add(play.channel, play.start, (play.title, play.performer))
+
+
+# Write-behind buffer of add_play
+write_buffer = None
+if db.config.get('WRITE_BUFFER'):
+    write_buffer = WriteBuffer(
+        storage,
+        maxsize=db.config.get('WRITE_BUFFER_SIZE', 10000),
+        batch_size=db.config.get('WRITE_BUFFER_BATCH_SIZE', 500),
+        flush_interval=db.config.get('WRITE_BUFFER_FLUSH_INTERVAL', 0.5),
+        workers=db.config.get('WRITE_BUFFER_WORKERS', 2),
+        on_written=_plays_written,
+        writing=_writing
+    )
+
+
+def _collect_metrics():
+    stats = top_cache.stats()
+    collected = [
+        ('plays_top_cache_size', 'gauge', 'get_top results cached',
+         [({}, stats['size'])]),
+        ('plays_top_cache_requests_total', 'counter', 'get_top cache lookups by result',
+         [({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])]),
+    ]
+
+    if write_buffer:
+        stats = write_buffer.stats()
+        collected.extend([
+            ('plays_write_buffer_depth', 'gauge', 'Plays waiting to be written',
+             [({}, stats['depth'])]),
+            ('plays_write_buffer_plays_total', 'counter', 'Buffered plays by result',
+             [({'result': result}, stats[result])
+              for result in ('written', 'failed', 'rejected')]),
+            ('plays_write_buffer_flushes_total', 'counter', 'Batches of plays written',
+             [({}, stats['flushes'])]),
+            ('plays_write_buffer_flush_seconds_total', 'counter', 'Time spent writing batches',
+             [({}, stats['flush_seconds'])]),
+            ('plays_write_buffer_flush_seconds_max', 'gauge', 'Longest time to write a batch',
+             [({}, stats['max_flush_seconds'])]),
+        ])
+    return collected
+
+
+registry.add_collector(_collect_metrics)
+
 
 def _get_request_parameters(required=None):    
     params = {
@@ -21,10 +122,11 @@ def _get_request_parameters(required=None):
         for item in request.args.items()
     }
 
-    d = request_schema.load(
-        params, 
-        required=required
-    )
+    with timed('parse'):
+        d = request_schema.load(
+            params, 
+            required=required
+        )
     _format_errors(d.errors)
 
 
@@ -43,14 +145,122 @@ def _get_object(schema):
     """
     Retrieve the request body, validate and deserialize it into a model object.
     """
-    j = request.get_json(force=True)
-
-    obj = schema.load(j)
+    with timed('parse'):
+        j = request.get_json(force=True)
+        obj = schema.load(j)
     _format_errors(obj.errors)
 
     return obj.data
 
 
+def _get_items():
+    """
+    Retrieve a request body holding either a JSON array or newline delimited
+    JSON objects. Returns a list of (item, error) pairs so that malformed
+    lines do not fail the whole request.
+    """
+    with timed('parse'):
+        body = request.get_data(as_text=True)
+        return _parse_items(body)
+
+
+def _parse_items(body):
+    if request.mimetype != 'application/x-ndjson':
+        try:
+            items = json.loads(body)
+        except ValueError as e:
+            raise PlaysException(code=400, errors=[str(e)])
+
+        if not isinstance(items, list):
+            raise PlaysException(code=400, errors=['Expected a JSON array'])
+        return [(item, None) for item in items]
+
+    items = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append((json.loads(line), None))
+        except ValueError as e:
+            items.append((None, [str(e)]))
+    return items
+
+
+def _get_page(params):
+    """
+    Returns the (after, limit) pair of a paginated request. after is the
+    start of the last play of the previous page, encoded in the cursor.
+    """
+    if 'page_size' not in params:
+        return None, None
+
+    if params.get('stream') == 'ndjson':
+        raise PlaysException(code=400, errors=['NDJSON streams cannot be paginated'])
+
+    after = None
+    if params.get('cursor'):
+        try:
+            after = dateutil.parser.parse(
+                base64.urlsafe_b64decode(params['cursor'].encode('ascii')).decode('utf-8')
+            )
+        except (TypeError, ValueError, UnicodeError):
+            raise PlaysException(code=400, errors=['Invalid cursor'])
+
+    return after, params['page_size']
+
+
+def _plays_response(rows, serializer, params):
+    """
+    Serialize the plays returned by a range query, either in a single JSON
+    document or streaming them one by one as a JSON array or NDJSON. Pages
+    include the cursor of the next page, or null if it is the last one.
+    """
+    page_size = params.get('page_size')
+
+    def cursor(last, count):
+        if last is None or count < page_size:
+            return None
+        return base64.urlsafe_b64encode(last.start.isoformat().encode('utf-8')).decode('ascii')
+
+    stream = params.get('stream')
+    if not stream:
+        # Rows may be fetched while iterating, which is timed as serialization
+        with timed('serialize'):
+            objs = []
+            last = None
+            for row in rows:
+                objs.append(serializer.dump(row))
+                last = row
+
+            if page_size is None:
+                return jsonify(code=0, result=objs)
+            return jsonify(code=0, result=objs, cursor=cursor(last, len(objs)))
+
+    if stream == 'ndjson':
+        def generate():
+            for row in rows:
+                yield json.dumps(serializer.dump(row), sort_keys=True) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    def generate():
+        yield '{"code": 0, "result": ['
+        count = 0
+        last = None
+        for row in rows:
+            if count:
+                yield ', '
+            yield json.dumps(serializer.dump(row), sort_keys=True)
+            count += 1
+            last = row
+        yield ']'
+        if page_size is not None:
+            yield ', "cursor": %s' % json.dumps(cursor(last, count))
+        yield '}'
+
+    return Response(generate(), mimetype='application/json')
+
+
 def _get_representation(obj, schema):
     """Takes a model and transforms into serializable object"""
     rep = schema.dump(obj)
@@ -61,7 +271,7 @@ def _get_representation(obj, schema):
 @api.route('/add_channel', methods=['POST'])
 def add_channel():
     obj = _get_object(channel_schema)
-    obj.save()
+    storage.add_channel(obj.name)
     rep = _get_representation(obj, channel_schema)
     return jsonify(code=0, result=rep)
 
@@ -69,7 +279,7 @@ def add_channel():
 @api.route('/add_performer', methods=['POST'])
 def add_performer():
     obj = _get_object(performer_schema)
-    obj.save()
+    storage.add_performer(obj.name)
     rep = _get_representation(obj, performer_schema)
     return jsonify(code=0, result=rep)
 
@@ -77,11 +287,7 @@ def add_performer():
 @api.route('/add_song', methods=['POST'])
 def add_song():
     obj = _get_object(song_schema)
-    obj.save()
-    
-    # Make sure that the performer is inserted in the database
-    performer = Performer(name=obj.performer)
-    performer.save()
+    storage.add_song(obj.title, obj.performer)
     
     rep = _get_representation(obj, song_schema)
     return jsonify(code=0, result=rep)
@@ -89,45 +295,108 @@ def add_song():
 
 @api.route('/add_play', methods=['POST'])
 def add_play():
-    j = request.get_json(force=True)
-    
-    # Add to play by song table to query by song
-    dsz = play_by_song_schema.load(j)
-    _format_errors(dsz.errors)
-    obj = dsz.data
-    obj.save()
-    
-    # Add to play by channel table
-    dsz = play_by_channel_schema.load(j)
-    _format_errors(dsz.errors)
-    obj = dsz.data
-    obj.save()
-    
-    # Make sure that the song is inserted in the database
-    performer = Song(title=obj.title, performer=obj.performer)
-    performer.save()
+    obj = _get_object(play_by_channel_schema)
+    if write_buffer:
+        if not write_buffer.put(obj):
+            raise PlaysException(
+                code=503,
+                errors=['Too many plays waiting to be written, try again later']
+            )
+    else:
+        with _writing():
+            with timed('db'):
+                storage.add_play(obj)
+            if charts:
+                charts.add(obj.channel, obj.start, (obj.title, obj.performer))
+    top_cache.invalidate(obj.channel, obj.start)
+    if sketches:
+        sketches.add(obj.channel, obj.start, (obj.title, obj.performer))
     
     rep = _get_representation(obj, play_by_channel_schema)
     return jsonify(code=0, result=rep)
 
 
+@api.route('/add_plays', methods=['POST'])
+def add_plays():
+    items = _get_items()
+
+    max_items = current_app.config['ADD_PLAYS_MAX_ITEMS']
+    if len(items) > max_items:
+        raise PlaysException(
+            code=413,
+            errors=['At most %d plays can be added per request' % max_items]
+        )
+
+    # Validate every play, keeping the errors of the invalid ones
+    errors = {}
+    plays = []
+    with timed('parse'):
+        for index, (item, item_errors) in enumerate(items):
+            if item_errors:
+                errors[index] = item_errors
+                continue
+
+            if not isinstance(item, dict):
+                errors[index] = ['Expected a JSON object']
+                continue
+
+            dsz = play_by_channel_schema.load(item)
+            if dsz.errors:
+                errors[index] = [v for v in dsz.errors.values()]
+                continue
+            plays.append((index, dsz.data))
+
+    with _writing():
+        with timed('db'):
+            write_errors = storage.add_plays(plays)
+        if charts:
+            for index, play in plays:
+                if index not in write_errors:
+                    charts.add(play.channel, play.start, (play.title, play.performer))
+    for index, error in write_errors.items():
+        errors[index] = [error]
+
+    # Invalidated once written, so that results computed from the counts
+    # before the write are not cached with the new generation. Failed plays
+    # may have been partly written.
+    for _, play in plays:
+        top_cache.invalidate(play.channel, play.start)
+
+    for index, play in plays:
+        if index in write_errors:
+            continue
+        if sketches:
+            sketches.add(play.channel, play.start, (play.title, play.performer))
+
+    result = {
+        'inserted': len(plays) - len(write_errors),
+        'errors': [
+            {'index': index, 'errors': errors[index]}
+            for index in sorted(errors.keys())
+        ]
+    }
+    return jsonify(code=0, result=result)
+
+
 @api.route('/get_song_plays', methods=['GET'])
 def get_song_plays():
     params = _get_request_parameters(
         required=('title', 'performer', 'start')
     )
     
-    q = PlayBySong.objects.filter(
-        title=params['title'],
-        performer=params['performer'],
-        start__gte=params['start'],
-        start__lte=params['end']
-    )
+    after, limit = _get_page(params)
+    with timed('db'):
+        q = storage.get_song_plays(
+            params['title'],
+            params['performer'],
+            params['start'],
+            params['end'],
+            after=after,
+            limit=limit
+        )
     
     # Serialize query results
-    objs = [play_by_song_schema.dump(o).data for o in q]
-    
-    return jsonify(code=0, result=objs)
+    return _plays_response(q, play_by_song_serializer, params)
 
 
 @api.route('/get_channel_plays', methods=['GET'])
@@ -136,16 +405,18 @@ def get_channel_plays():
         required=('channel', 'start')
     )
     
-    q = PlayByChannel.objects.filter(
-        channel=params['channel'],
-        start__gte=params['start'],
-        start__lte=params['end']
-    )
+    after, limit = _get_page(params)
+    with timed('db'):
+        q = storage.get_channel_plays(
+            params['channel'],
+            params['start'],
+            params['end'],
+            after=after,
+            limit=limit
+        )
     
     # Serialize query results
-    objs = [play_by_channel_schema.dump(o).data for o in q]
-    
-    return jsonify(code=0, result=objs)
+    return _plays_response(q, play_by_channel_serializer, params)
 
 
 @api.route('/get_top', methods=['GET'])
@@ -155,34 +426,79 @@ def get_top():
     )
     
     # Channels is a special parameter that comes in form of a json list
-    ds = channels_param_schema.loads(
-        '{"channels": %s}' % request.args.get('channels', u'[]')
-    )
+    with timed('parse'):
+        ds = channels_param_schema.loads(
+            '{"channels": %s}' % request.args.get('channels', u'[]')
+        )
     _format_errors(ds.errors)
     params['channels'] = ds.data
+
+    if params.get('approximate'):
+        return _approximate_top(params)
     
-    # TODO: get current and past ranks in parallel
-    current_songs = PlayByChannel.get_song_counts(
+    if charts:
+        with timed('chart'):
+            top = charts.get(
+                params['channels'], params['start'], params['end'], params['limit']
+            )
+        if top is not None:
+            response = jsonify(code=0, result=top)
+            response.headers['X-Top-Chart'] = 'true'
+            return response
+
+    algorithm = topk.ALGORITHMS[
+        params.get('algorithm') or current_app.config['TOPK_ALGORITHM']
+    ]
+    # Algorithms break ties differently, so their results are cached apart
+    key = top_cache.key(
         params['channels'],
         params['start'],
-        params['end']
+        params['end'],
+        params['limit'],
+        algorithm.__name__
     )
+    with timed('cache'):
+        top = top_cache.get(key)
+    if top is not None:
+        response = jsonify(code=0, result=top)
+        response.headers['X-Top-Cache'] = 'hit'
+        response.headers['X-Topk-Algorithm'] = algorithm.__name__
+        return response
+    token = top_cache.token(key)
     
-    past_songs = PlayByChannel.get_song_counts(
-        params['channels'],
-        params['start'] - timedelta(days=7),
-        params['end'] - timedelta(days=7)
-    )
+    # Get current and past counts in parallel
+    with timed('db'):
+        current_songs, past_songs = storage.get_song_counts(
+            params['channels'],
+            [
+                (params['start'], params['end']),
+                (params['start'] - timedelta(days=7), params['end'] - timedelta(days=7))
+            ]
+        )
     
-    current_top = topk.fa(current_songs, params['limit'])
-    past_top = topk.fa(past_songs, params['limit'])
+    current_stats = {}
+    past_stats = {}
+    with timed('topk'):
+        current_top = algorithm(current_songs, params['limit'], current_stats)
+        past_top = algorithm(past_songs, params['limit'], past_stats)
     
+    sorted_accesses = current_stats['sorted_accesses'] + past_stats['sorted_accesses']
+    random_accesses = current_stats['random_accesses'] + past_stats['random_accesses']
+    logger.info(
+        "get_top %s: %d sorted accesses, %d random accesses",
+        algorithm.__name__, sorted_accesses, random_accesses
+    )
+    
+    # Songs may be dictionary ids until here
+    with timed('decode'):
+        names = storage.song_names([item[0] for item in current_top])
+
     # Convert to dictionary for fast access
     current_top_dict = {
         item[0]: {
             'rank': i,
-            'title': item[0][0],
-            'performer': item[0][1],
+            'title': names[item[0]][0],
+            'performer': names[item[0]][1],
             'plays': item[1],
             'previous_plays': 0,
             'previous_rank': None
@@ -204,7 +520,67 @@ def get_top():
     
     # Sort and return
     top = sorted(current_top_dict.values(), key=lambda x: x['rank'])
-    return jsonify(code=0, result=top)
+    top_cache.set(key, top, token)
+    
+    with timed('serialize'):
+        response = jsonify(code=0, result=top)
+    response.headers['X-Top-Cache'] = 'miss'
+    response.headers['X-Topk-Algorithm'] = algorithm.__name__
+    response.headers['X-Topk-Sorted-Accesses'] = str(sorted_accesses)
+    response.headers['X-Topk-Random-Accesses'] = str(random_accesses)
+    return response
+
+
+def _approximate_top(params):
+    """
+    get_top from the merged song sketches of the channels. Windows are
+    rounded to whole hours. The true plays of a song are between
+    plays - plays_error and plays, and guaranteed is true when the song is in
+    the top whatever the errors.
+    """
+    if sketches is None:
+        raise PlaysException(code=400, errors=['Approximate top is not enabled'])
+
+    limit = params['limit']
+    with timed('sketch'):
+        current = sketches.get(params['channels'], params['start'], params['end'])
+        past = sketches.get(
+            params['channels'],
+            params['start'] - timedelta(days=7),
+            params['end'] - timedelta(days=7)
+        )
+
+    # Songs whose lower bound exceeds the upper bound of the first song left
+    # out are guaranteed to be in the top
+    current_top = current.top(limit + 1)
+    if len(current_top) > limit:
+        threshold = current_top.pop()[1]
+    else:
+        threshold = current.bound()
+
+    past_top = {
+        item: {'rank': i, 'plays': plays}
+        for i, (item, plays, _) in enumerate(past.top(limit))
+    }
+
+    top = []
+    for i, (item, plays, error) in enumerate(current_top):
+        previous = past_top.get(item, {})
+        top.append({
+            'rank': i,
+            'title': item[0],
+            'performer': item[1],
+            'plays': plays,
+            'plays_error': error,
+            'guaranteed': plays - error >= threshold,
+            'previous_plays': previous.get('plays', 0),
+            'previous_rank': previous.get('rank')
+        })
+
+    with timed('serialize'):
+        response = jsonify(code=0, result=top)
+    response.headers['X-Top-Approximate'] = 'true'
+    return response
 
 
 @api.route('/truncate_tables', methods=['POST'])
@@ -216,7 +592,14 @@ def truncate_tables():
     elif not j['truncate']:
         raise PlaysException(code=400, errors=['Security flag is not set to true'])
     
-    _recreate_keyspace()
+    if write_buffer:
+        write_buffer.clear()
+    storage.truncate()
+    top_cache.clear()
+    if sketches:
+        sketches.clear()
+    if charts:
+        charts.clear()
     
     return jsonify(code=0, result=None)
         
\ No newline at end of file
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+logger = logging.getLogger()
+
+
+class WriteBuffer(object):
+    """
+    Write-behind buffer of plays. Plays are put in a queue and written by
+    background workers in batches of at most batch_size plays, waiting at
+    most flush_interval seconds for a batch to fill up. At most maxsize plays
+    can be waiting, either queued or in a batch being written.
+
+    on_written is called with the list of plays of every batch once it has
+    been written, within the context returned by writing() if given, which
+    is entered before the write. close() stops accepting plays and waits for the workers to
+    write the queued ones.
+    """
+    def __init__(self, storage, maxsize=10000, batch_size=500, flush_interval=0.5,
+                 workers=2, on_written=None, writing=None):
+        self.storage = storage
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_written = on_written
+        self.writing = writing or _nothing
+        self._queue = Queue()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        # Plays queued or being written
+        self._pending = 0
+        self._stats = {
+            'written': 0,
+            'failed': 0,
+            'rejected': 0,
+            'flushes': 0,
+            'flush_seconds': 0.0,
+            'max_flush_seconds': 0.0,
+        }
+
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._run, name='write-buffer-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        atexit.register(self.close)
+
+    def put(self, play):
+        """Queue a play. Returns False if the buffer is full or closed"""
+        with self._lock:
+            if self._closed.is_set() or self._pending >= self.maxsize:
+                self._stats['rejected'] += 1
+                return False
+            self._pending += 1
+
+        self._queue.put(play)
+        return True
+
+    def close(self, timeout=None):
+        """Write the queued plays and stop the workers"""
+        if self._closed.is_set():
+            return
+        logger.info("Draining %d buffered plays", self._pending)
+        self._closed.set()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def clear(self):
+        """Drop the queued plays"""
+        try:
+            while True:
+                self._queue.get_nowait()
+                with self._lock:
+                    self._pending -= 1
+        except Empty:
+            pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['depth'] = self._pending
+        stats['capacity'] = self.maxsize
+        return stats
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch:
+                self._write(batch)
+            elif self._closed.is_set():
+                return
+
+    def _take(self):
+        """
+        Wait for the next batch: batch_size plays or the plays queued within
+        flush_interval seconds of the first one. Once closed, the queue is
+        drained without waiting.
+        """
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except Empty:
+            return batch
+
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                if self._closed.is_set():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                batch.append(self._queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        with self.writing():
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        t = time.time()
+        try:
+            errors = self.storage.add_plays(list(enumerate(batch)))
+        except Exception as e:
+            logger.exception("Could not write %d buffered plays", len(batch))
+            errors = dict((index, str(e)) for index in range(len(batch)))
+        elapsed = time.time() - t
+
+        for index, error in sorted(errors.items()):
+            logger.error("Could not write buffered play %r: %s", batch[index], error)
+
+        with self._lock:
+            self._pending -= len(batch)
+            self._stats['written'] += len(batch) - len(errors)
+            self._stats['failed'] += len(errors)
+            self._stats['flushes'] += 1
+            self._stats['flush_seconds'] += elapsed
+            self._stats['max_flush_seconds'] = max(self._stats['max_flush_seconds'], elapsed)
+
+        if self.on_written:
+            self.on_written([
+                play for index, play in enumerate(batch) if index not in errors
+            ])
+
+
+@contextmanager
+def _nothing():
+    yield
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+import csv
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+import time
+
+from . import db as database
+from .schemas import play_by_channel_schema, play_by_channel_serializer
+
+"""
+Bulk import and export of plays
+
+Files hold one play per line with the fields of add_play, either as NDJSON
+objects or as CSV rows under a channel,start,end,title,performer header. The
+format is given or guessed from the file extension.
+
+Imports are read in batches of lines, which worker processes validate with
+the add_play schema and write with the storage's add_plays. Completed batches
+are recorded in a checkpoint file, so that an interrupted import can be
+resumed. Exports read the plays of every channel in a worker process into a
+part file named after the channel, and concatenate the parts once they are
+all written. Parts written by an interrupted export are kept and not read
+again, even if the channels have changed meanwhile.
+
+Workers open their own connections to the database: the driver's connections
+do not survive a fork. With the memory storage everything runs in process.
+"""
+
+logger = logging.getLogger()
+
+PY2 = sys.version_info[0] == 2
+
+FIELDS = ('channel', 'start', 'end', 'title', 'performer')
+
+
+def guess_format(path, fmt=None):
+    if fmt:
+        return fmt
+    if path.lower().endswith('.csv'):
+        return 'csv'
+    return 'ndjson'
+
+
+def import_plays(path, fmt=None, workers=4, batch_size=1000, checkpoint=None,
+                 resume=False, progress=10):
+    """
+    Import the plays of a file. Returns the number of lines that could not
+    be imported.
+
+    Batches of the checkpoint are skipped when resuming, which raises a
+    ValueError if the checkpoint is for another file. Batches that were
+    being written when the import was interrupted are written again, which
+    counts their plays twice in the rollups, if enabled.
+    """
+    fmt = guess_format(path, fmt)
+    workers = _workers(workers)
+    checkpoint = checkpoint or path + '.checkpoint'
+
+    state = {'path': os.path.abspath(path), 'batch_size': batch_size, 'next': 0, 'done': []}
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            saved = json.load(f)
+        if saved.get('path') != state['path']:
+            raise ValueError(
+                "Checkpoint %s is for %s, not %s" % (checkpoint, saved.get('path'), state['path'])
+            )
+        state = saved
+        batch_size = state['batch_size']
+        logger.info("Resuming from batch %d of %s", state['next'], path)
+    done = set(state['done'])
+
+    # At most two batches per worker are read ahead of the writes
+    slots = threading.BoundedSemaphore(max(workers, 1) * 2)
+
+    def batches():
+        for index, records in enumerate(_read_batches(path, fmt, batch_size)):
+            if index < state['next'] or index in done:
+                continue
+            slots.acquire()
+            yield index, fmt, records
+
+    report = _Progress('Imported', 'plays', progress)
+    failed = 0
+    for index, inserted, errors in _map(_import_batch, batches(), workers):
+        slots.release()
+        for line, line_errors in sorted(errors.items()):
+            logger.warning("Line %d: %s", line, '; '.join(str(e) for e in line_errors))
+        failed += len(errors)
+        report.add(inserted, failed)
+
+        # The checkpoint keeps the first batch not written and the batches
+        # written after it
+        done.add(index)
+        while state['next'] in done:
+            done.discard(state['next'])
+            state['next'] += 1
+        state['done'] = sorted(done)
+        _write_json(checkpoint, state)
+
+    report.finish(failed)
+    return failed
+
+
+def export_plays(path, start, end, channels=None, fmt=None, workers=4, progress=10):
+    """Export the plays of the channels, every channel with plays by default"""
+    fmt = guess_format(path, fmt)
+    workers = _workers(workers)
+    if channels is None:
+        channels = database.storage.get_channels()
+    channels = sorted(set(channels))
+
+    parts = path + '.parts'
+    if not os.path.isdir(parts):
+        os.makedirs(parts)
+
+    tasks = []
+    for channel in channels:
+        part = _part_path(parts, channel)
+        if os.path.exists(part):
+            logger.info("Skipping channel %s, already exported", channel)
+            continue
+        tasks.append((channel, start, end, fmt, part))
+
+    report = _Progress('Exported', 'plays', progress)
+    for channel, count in _map(_export_channel, tasks, workers):
+        report.add(count)
+
+    with _open_output(path) as f:
+        if fmt == 'csv':
+            _csv_writer(f).writerow(FIELDS)
+        for channel in channels:
+            with _open_input(_part_path(parts, channel)) as part:
+                shutil.copyfileobj(part, f)
+    shutil.rmtree(parts)
+    report.finish()
+
+
+def _part_path(parts, channel):
+    """Part file of a channel, named by a hash since channels can be any text"""
+    return os.path.join(parts, hashlib.sha1(channel.encode('utf-8')).hexdigest())
+
+
+def _import_batch(task):
+    """Validate and write a batch of (line, record) pairs"""
+    index, fmt, records = task
+    errors = {}
+    plays = []
+    for line, record in records:
+        if fmt == 'ndjson':
+            try:
+                record = json.loads(record)
+            except ValueError as e:
+                errors[line] = [str(e)]
+                continue
+        if not isinstance(record, dict):
+            errors[line] = ['Expected a JSON object']
+            continue
+
+        dsz = play_by_channel_schema.load(record)
+        if dsz.errors:
+            errors[line] = [
+                '%s: %s' % (field, ' '.join(messages))
+                for field, messages in sorted(dsz.errors.items())
+            ]
+            continue
+        plays.append((line, dsz.data))
+
+    try:
+        write_errors = database.storage.add_plays(plays)
+    except Exception as e:
+        logger.exception("Could not write batch %d", index)
+        write_errors = dict((line, str(e)) for line, _ in plays)
+    for line, error in write_errors.items():
+        errors[line] = [error]
+    return index, len(plays) - len(write_errors), errors
+
+
+def _export_channel(task):
+    """Write the plays of a channel to a part file. Returns (channel, plays)"""
+    channel, start, end, fmt, part = task
+    count = 0
+    with _open_output(part + '.tmp') as f:
+        writer = _csv_writer(f) if fmt == 'csv' else None
+        for row in database.storage.get_channel_plays(channel, start, end):
+            play = play_by_channel_serializer.dump(row)
+            if writer:
+                writer.writerow([play[field] for field in FIELDS])
+            else:
+                f.write(_text(json.dumps(play, sort_keys=True) + '\n'))
+            count += 1
+    os.rename(part + '.tmp', part)
+    return channel, count
+
+
+def _read_batches(path, fmt, batch_size):
+    """Lists of (line number, record) of batch_size lines"""
+    batch = []
+    for line, record in _read_records(path, fmt):
+        batch.append((line, record))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _read_records(path, fmt):
+    if fmt == 'csv':
+        with _open_input(path) as f:
+            reader = csv.DictReader(f)
+            for record in reader:
+                if PY2:
+                    record = dict(
+                        (key, value.decode('utf-8') if value is not None else None)
+                        for key, value in record.items()
+                    )
+                yield reader.line_num, record
+        return
+
+    with io.open(path, encoding='utf-8') as f:
+        for line, text in enumerate(f, 1):
+            if text.strip():
+                yield line, text
+
+
+def _map(function, tasks, workers):
+    """Unordered results of the function over the tasks in worker processes"""
+    if not workers:
+        for task in tasks:
+            yield function(task)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker)
+    try:
+        for result in pool.imap_unordered(function, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _workers(workers):
+    if workers and database.db.config.get('STORAGE', 'cassandra') == 'memory':
+        logger.warning("Workers do not share the memory storage, running in process")
+        return 0
+    return workers
+
+
+def _init_worker():
+    """Connect to the database again in a forked worker"""
+    database.init_db_blueprint()
+    if database.db.config.get('STORAGE', 'cassandra') != 'memory':
+        from .models import _reset_session
+        _reset_session()
+
+
+class _Progress(object):
+    """Logs the count and rate of items every interval seconds"""
+    def __init__(self, action, items, interval):
+        self.action = action
+        self.items = items
+        self.interval = interval
+        self.count = 0
+        self.start = self.last = time.time()
+
+    def add(self, count, failed=0):
+        self.count += count
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self._log(now, failed)
+
+    def finish(self, failed=0):
+        self._log(time.time(), failed)
+
+    def _log(self, now, failed):
+        elapsed = max(now - self.start, 1e-6)
+        logger.info(
+            "%s %d %s in %.0f s (%.0f %s/s)%s",
+            self.action, self.count, self.items, elapsed, self.count / elapsed,
+            self.items, ', %d failed' % failed if failed else ''
+        )
+
+
+def _open_input(path):
+    if PY2:
+        return open(path, 'rb')
+    return open(path, 'r', newline='', encoding='utf-8')
+
+
+def _open_output(path):
+    if PY2:
+        return open(path, 'wb')
+    return open(path, 'w', newline='', encoding='utf-8')
+
+
+def _csv_writer(f):
+    writer = csv.writer(f)
+    if not PY2:
+        return writer
+
+    class Writer(object):
+        def writerow(self, values):
+            writer.writerow([
+                value.encode('utf-8') if isinstance(value, unicode) else value  # noqa: F821
+                for value in values
+            ])
+    return Writer()
+
+
+def _text(s):
+    """Text for the files opened by _open_output"""
+    if PY2 and isinstance(s, unicode):  # noqa: F821
+        return s.encode('utf-8')
+    return s
+
+
+def _write_json(path, data):
+    """Replace a JSON file atomically"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(path + '.tmp', path)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+_missing = object()
+_default = object()
+
+
+class LRUCache(object):
+    """
+    Thread safe, size bounded cache with least recently used eviction and an
+    optional time to live (in seconds) for its entries.
+    """
+    def __init__(self, maxsize=10000, ttl=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and self._expired(entry):
+                self._evicted(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            # Move to the most recently used end
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def set(self, key, value=True, ttl=_default):
+        """Store a value. ttl overrides the cache's time to live"""
+        if ttl is _default:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                self._evicted(evicted)
+
+    def add(self, key):
+        self.set(key)
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._evicted(key)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._data.keys())
+            self._data.clear()
+            for key in keys:
+                self._evicted(key)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _expired(self, entry):
+        return entry[1] is not None and time.time() > entry[1]
+
+    def _evicted(self, key):
+        if self.on_evict:
+            self.on_evict(key)
+
+
+class TopCache(object):
+    """
+    Cache of get_top results keyed by the canonical form of the request:
+    sorted and deduplicated channels, start, end, limit and algorithm.
+
+    Results depend on the plays of the requested window and of the week
+    before. Results whose window includes the present expire after live_ttl
+    seconds, the rest after ttl (None to only expire them when plays are
+    added to their windows).
+
+    To avoid caching results computed while plays were being added, get a
+    token before computing a result and pass it to set, and invalidate once
+    the plays are written.
+    """
+    def __init__(self, maxsize=1000, live_ttl=60, ttl=None):
+        self.live_ttl = live_ttl
+        self.ttl = ttl
+        self.cache = LRUCache(maxsize=maxsize, on_evict=self._unindex)
+        # channel -> keys of the cached results that include it
+        self._index = {}
+        # channel -> number of invalidations
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(channels, start, end, limit, algorithm=None):
+        return (
+            tuple(sorted(set(channels))),
+            _naive_utc(start),
+            _naive_utc(end),
+            limit,
+            algorithm
+        )
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def token(self, key):
+        with self._lock:
+            return tuple(self._generations.get(channel, 0) for channel in key[0])
+
+    def set(self, key, value, token=None):
+        end = key[2]
+        ttl = self.live_ttl if end >= datetime.utcnow() else self.ttl
+
+        with self._lock:
+            generations = tuple(self._generations.get(channel, 0) for channel in key[0])
+            if token is not None and token != generations:
+                return
+            for channel in key[0]:
+                self._index.setdefault(channel, set()).add(key)
+        self.cache.set(key, value, ttl=ttl)
+
+        # An invalidation between the check and the set may have deleted the
+        # key before it was set
+        if token is not None and token != self.token(key):
+            self.cache.delete(key)
+
+    def invalidate(self, channel, start):
+        """Drop the results of the channel whose windows include start"""
+        start = _naive_utc(start)
+        with self._lock:
+            self._generations[channel] = self._generations.get(channel, 0) + 1
+            keys = list(self._index.get(channel, ()))
+
+        for key in keys:
+            key_start, key_end = key[1], key[2]
+            week = timedelta(days=7)
+            if key_start <= start <= key_end or key_start - week <= start <= key_end - week:
+                self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+    def _unindex(self, key):
+        with self._lock:
+            for channel in key[0]:
+                keys = self._index.get(channel)
+                if keys is None:
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del self._index[channel]
+
+
+def _naive_utc(dt):
+    """Convert timezone aware datetimes to naive UTC ones"""
+    if dt.tzinfo is None:
+        return dt
+    return dt.replace(tzinfo=None) - dt.utcoffset()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import heapq
+import json
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from .cache import _naive_utc
+
+logger = logging.getLogger()
+
+WEEK = timedelta(days=7)
+
+# Reloads retried when plays are written meanwhile, before holding the writes
+RELOAD_ATTEMPTS = 3
+
+
+class Chart(object):
+    """
+    Song counts of a week and the size songs with the most plays, kept
+    ranked as counts grow
+    """
+    def __init__(self, size, counts=None):
+        self.size = size
+        self.counts = dict(counts or {})
+        self.top = heapq.nlargest(size, self.counts, key=self.counts.get)
+        self._members = set(self.top)
+
+    def add(self, song, count=1):
+        counts = self.counts
+        plays = counts[song] = counts.get(song, 0) + count
+
+        top = self.top
+        if song in self._members:
+            i = top.index(song)
+        elif len(top) < self.size:
+            top.append(song)
+            self._members.add(song)
+            i = len(top) - 1
+        elif plays > counts[top[-1]]:
+            self._members.discard(top[-1])
+            self._members.add(song)
+            top[-1] = song
+            i = len(top) - 1
+        else:
+            return
+
+        # Move the song up past the songs with fewer plays
+        while i > 0 and counts[top[i - 1]] < plays:
+            top[i] = top[i - 1]
+            i -= 1
+        top[i] = song
+
+    def ranked(self):
+        """(song, plays) of the top songs by rank"""
+        return [(song, self.counts[song]) for song in self.top]
+
+
+class ChartStore(object):
+    """
+    Weekly charts of groups of channels, given as {name: channels}.
+
+    The song counts of every channel of a group for the current week are
+    loaded from the storage and updated as plays are added, and so is the
+    ranked top of every group. refresh() reloads them to include the plays
+    added by other processes, and rolls over to a new week: the charts of the
+    week that ended are frozen and stored, so that every process gets the
+    same previous ranks and plays.
+
+    Plays must be written to the storage and added within writing(), so that
+    a reload either includes a play and replaces the counts it was added to,
+    or misses it and counts it once written. Reloads overlapping writes are
+    done again, and after RELOAD_ATTEMPTS the writes wait for the reload.
+
+    Weeks start on Monday at 00:00 UTC.
+    """
+    def __init__(self, storage, groups, size=40):
+        self.storage = storage
+        self.size = size
+        self.groups = dict(
+            (name, tuple(sorted(set(channels)))) for name, channels in groups.items()
+        )
+        self._names = dict((channels, name) for name, channels in self.groups.items())
+        self._channel_groups = {}
+        for name, channels in self.groups.items():
+            for channel in channels:
+                self._channel_groups.setdefault(channel, []).append(name)
+
+        self.week = None
+        # channel -> {song: plays} of the current week
+        self._channel_counts = {}
+        # name -> Chart of the current week
+        self._charts = {}
+        # name -> [(song, plays)] frozen chart of the previous week
+        self._previous = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writes = threading.Condition(threading.Lock())
+        # Writes in progress, writes started and whether new ones must wait
+        self._writing = 0
+        self._written = 0
+        self._reloading = False
+
+    @contextmanager
+    def writing(self):
+        """Context of a write of plays to the storage and their add()"""
+        with self._writes:
+            while self._reloading:
+                self._writes.wait()
+            self._writing += 1
+            self._written += 1
+        try:
+            yield
+        finally:
+            with self._writes:
+                self._writing -= 1
+                self._writes.notify_all()
+
+    def add(self, channel, start, song):
+        if channel not in self._channel_groups or _week(_naive_utc(start)) != self.week:
+            return
+
+        with self._lock:
+            if _week(_naive_utc(start)) != self.week:
+                return
+            counts = self._channel_counts.setdefault(channel, {})
+            counts[song] = counts.get(song, 0) + 1
+            for name in self._channel_groups[channel]:
+                self._charts[name].add(song)
+
+    def get(self, channels, start, end, limit):
+        """
+        get_top result of a group for the current week, or None if the
+        channels are not a group, the window is not the current week or the
+        limit is larger than the charts
+        """
+        name = self._names.get(tuple(sorted(set(channels))))
+        if name is None or limit > self.size:
+            return None
+
+        self.refresh(reload=False)
+        start = _naive_utc(start)
+        end = _naive_utc(end)
+        # The end defaults to start + 7 days, which get_top includes
+        if start != self.week or not start + WEEK - timedelta(seconds=1) <= end <= start + WEEK:
+            return None
+
+        with self._lock:
+            ranked = self._charts[name].ranked()[:limit]
+            previous = dict(
+                (song, (rank, plays))
+                for rank, (song, plays) in enumerate(self._previous.get(name, [])[:limit])
+            )
+
+        top = []
+        for rank, (song, plays) in enumerate(ranked):
+            previous_rank, previous_plays = previous.get(song, (None, 0))
+            top.append({
+                'rank': rank,
+                'title': song[0],
+                'performer': song[1],
+                'plays': plays,
+                'previous_plays': previous_plays,
+                'previous_rank': previous_rank
+            })
+        return top
+
+    def refresh(self, reload=True):
+        """
+        Reload the counts of the current week, rolling over to a new week if
+        needed. With reload=False, only roll over.
+        """
+        with self._refresh_lock:
+            week = _week(datetime.utcnow())
+            if not reload and week == self.week:
+                return
+
+            previous = self._previous if week == self.week else self._frozen_charts(week - WEEK)
+            for attempt in range(RELOAD_ATTEMPTS + 1):
+                if self._reload(week, previous, hold=attempt == RELOAD_ATTEMPTS):
+                    return
+
+    def _reload(self, week, previous, hold):
+        """
+        Load the counts of the week once no write is in progress, and swap
+        them in unless writes started meanwhile. With hold, new writes wait.
+        Returns whether the counts were swapped in.
+        """
+        with self._writes:
+            if hold:
+                self._reloading = True
+                while self._writing:
+                    self._writes.wait()
+            elif self._writing:
+                return False
+            written = self._written
+        try:
+            channel_counts, charts = self._load(week)
+            with self._writes:
+                if self._written != written:
+                    return False
+                with self._lock:
+                    self.week = week
+                    self._channel_counts = channel_counts
+                    self._charts = charts
+                    self._previous = previous
+                return True
+        finally:
+            if hold:
+                with self._writes:
+                    self._reloading = False
+                    self._writes.notify_all()
+
+    def start(self, interval):
+        """Refresh every interval seconds in a background thread"""
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception("Could not refresh the weekly charts")
+
+        thread = threading.Thread(target=run, name='chart-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def clear(self):
+        with self._lock:
+            self.week = None
+            self._channel_counts = {}
+            self._charts = {}
+            self._previous = {}
+
+    def _load(self, week):
+        """Song counts of every channel and charts of every group for a week"""
+        channels = sorted(self._channel_groups)
+        counts = self.storage.get_song_counts(
+            channels, [(week, week + WEEK - timedelta(microseconds=1))]
+        )[0]
+        # Songs may be dictionary ids
+        names = self.storage.song_names(
+            set(song for channel_counts in counts.values() for song in channel_counts)
+        )
+        channel_counts = dict(
+            (channel, dict((names[song], plays) for song, plays in songs.items()))
+            for channel, songs in counts.items()
+        )
+
+        charts = {}
+        for name, group in self.groups.items():
+            totals = Counter()
+            for channel in group:
+                totals.update(channel_counts.get(channel, {}))
+            charts[name] = Chart(self.size, totals)
+        return channel_counts, charts
+
+    def _frozen_charts(self, week):
+        """Stored charts of a past week, freezing the ones no process has"""
+        charts = {}
+        missing = []
+        for name in self.groups:
+            stored = self.storage.get_chart(name, week)
+            if stored is None:
+                missing.append(name)
+            else:
+                charts[name] = [
+                    ((title, performer), plays)
+                    for title, performer, plays in json.loads(stored)
+                ]
+
+        if missing:
+            _, computed = self._load(week)
+            for name in missing:
+                logger.info("Freezing chart %s of the week of %s", name, week.date())
+                # Another process may have frozen it meanwhile, whose chart is kept
+                stored = self.storage.add_chart(name, week, json.dumps([
+                    [song[0], song[1], plays] for song, plays in computed[name].ranked()
+                ]))
+                charts[name] = [
+                    ((title, performer), plays)
+                    for title, performer, plays in json.loads(stored)
+                ]
+        return charts
+
+
+def _week(dt):
+    """Monday at 00:00 of the week of a naive UTC datetime"""
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday())
@@ -6,6 +6,8 @@ from flask import Blueprint
 from cassandra.cluster import Cluster
 from cassandra.cqlengine import connection
 from cassandra.cqlengine.management import create_keyspace_simple
+from cassandra.policies import DCAwareRoundRobinPolicy, HostDistance, TokenAwarePolicy
+from cassandra.query import dict_factory, named_tuple_factory
 
 logger = logging.getLogger()
 
@@ -14,33 +16,62 @@ db.config = {}
 
 cluster = None
 session = None
+storage = None
 
 
 @db.record
 def record_params(setup_state):
     app = setup_state.app
-    db.config = dict([(key,value) for (key,value) in app.config.iteritems()])
+    db.config = dict([(key,value) for (key,value) in app.config.items()])
   
   
 def init_db_blueprint():
+    global storage
+    if db.config.get('STORAGE', 'cassandra') == 'memory':
+        logger.info("Using in-memory storage")
+        from .storage import MemoryStorage
+        storage = MemoryStorage(db.config)
+        return
+
     global cluster
     cluster = Cluster(
-        db.config['CASSANDRA_CONTACT_POINTS']
+        db.config['CASSANDRA_CONTACT_POINTS'],
+        protocol_version=db.config.get('CASSANDRA_PROTOCOL_VERSION', 3),
+        load_balancing_policy=TokenAwarePolicy(
+            DCAwareRoundRobinPolicy(local_dc=db.config.get('CASSANDRA_LOCAL_DC'))
+        ),
+        connect_timeout=db.config.get('CASSANDRA_CONNECT_TIMEOUT', 5)
     )
-    
+
+    # Connection pools only grow with protocol versions 1 and 2, newer ones
+    # multiplex every request over a single connection per host
+    if cluster.protocol_version < 3:
+        cluster.set_core_connections_per_host(
+            HostDistance.LOCAL, db.config.get('CASSANDRA_CORE_CONNECTIONS', 2)
+        )
+        cluster.set_max_connections_per_host(
+            HostDistance.LOCAL, db.config.get('CASSANDRA_MAX_CONNECTIONS', 8)
+        )
+
     global session
     session = cluster.connect(
         db.config['CASSANDRA_KEYSPACE']
     )
-    
-    connection.setup(
-        db.config['CASSANDRA_CONTACT_POINTS'],
-        db.config['CASSANDRA_KEYSPACE'], 
-        protocol_version=3
-    )
+    session.default_timeout = db.config.get('CASSANDRA_REQUEST_TIMEOUT', 10)
+
+    # cqlengine shares the session and its connection pools. It requires rows
+    # as dictionaries, which only its queries need: it only creates and drops
+    # tables here and reads no rows, while the models read named tuples
+    session.row_factory = dict_factory
+    connection.set_session(session)
+    session.row_factory = named_tuple_factory
     
     initialize_keyspace()
     
+    # Imported once the session is set up, as models use it
+    from .storage import CassandraStorage
+    storage = CassandraStorage(db.config)
+    
     
 def initialize_keyspace():
     logger.info("Initializing keyspace")
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from .cache import LRUCache
+
+"""
+Dictionary encoding
+
+With DICTIONARY_ENCODING, channels and songs are stored in the play tables
+and counted by integer ids instead of their names, and translated back to
+names when responding. Storage backends allocate the ids and keep the mapping
+in both directions. Ids are never reassigned, so the in-process caches of
+the mapping never go stale and need no TTL.
+
+Names of channels are their name, names of songs (title, performer) tuples.
+"""
+
+CHANNEL = 'channel'
+SONG = 'song'
+
+
+class Dictionary(object):
+    """
+    Bidirectional cache of the ids allocated by a storage backend, which
+    implements get_ids(kind, names), add_ids(kind, names) and
+    get_names(kind, ids)
+    """
+    def __init__(self, storage, cache_size=100000):
+        self.storage = storage
+        # (kind, name) -> id and (kind, id) -> name
+        self._ids = LRUCache(maxsize=cache_size)
+        self._names = LRUCache(maxsize=cache_size)
+
+    def ids(self, kind, names, allocate=False):
+        """
+        Ids of the names as {name: id}. Names without an id are allocated
+        one if allocate is set, and left out otherwise.
+        """
+        ids = {}
+        missing = []
+        for name in set(names):
+            id_ = self._ids.get((kind, name))
+            if id_ is None:
+                missing.append(name)
+            else:
+                ids[name] = id_
+        if not missing:
+            return ids
+
+        found = self.storage.get_ids(kind, missing)
+        if allocate and len(found) < len(missing):
+            found.update(self.storage.add_ids(
+                kind, [name for name in missing if name not in found]
+            ))
+        for name, id_ in found.items():
+            self._ids.set((kind, name), id_)
+            self._names.set((kind, id_), name)
+        ids.update(found)
+        return ids
+
+    def names(self, kind, ids):
+        """Names of the ids as {id: name}"""
+        names = {}
+        missing = []
+        for id_ in set(ids):
+            name = self._names.get((kind, id_))
+            if name is None:
+                missing.append(id_)
+            else:
+                names[id_] = name
+        if not missing:
+            return names
+
+        found = self.storage.get_names(kind, missing)
+        for id_, name in found.items():
+            self._names.set((kind, id_), name)
+            self._ids.set((kind, name), id_)
+        names.update(found)
+        return names
+
+    def clear(self):
+        self._ids.clear()
+        self._names.clear()
+
+
+def decode_rows(rows, convert, chunk_size=500):
+    """
+    Convert rows of ids to rows of names chunk_size rows at a time, so that
+    the names missing from the cache are fetched together. convert takes a
+    list of rows and returns the converted list.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            for converted in convert(chunk):
+                yield converted
+            chunk = []
+    if chunk:
+        for converted in convert(chunk):
+            yield converted
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Blueprint, Response, current_app, request
+
+"""
+Request instrumentation
+
+Views time their stages (parsing, database calls, decoding, top-k,
+serialization...) with the timed context manager. Stages may nest and a stage
+may run several times per request, in which case its durations are added up.
+At the end of every request, the total and stage durations are recorded in
+latency histograms per endpoint, exposed in the Prometheus text format by
+GET /metrics.
+"""
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+metrics = Blueprint('metrics', __name__)
+
+# Stage durations of the request handled by the current thread, None when
+# not in a request or when metrics are disabled
+_local = threading.local()
+
+
+class Histogram(object):
+    """Counts of observations in cumulative buckets, as in Prometheus"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is for observations above every bucket (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """
+    Latency histograms per endpoint and per endpoint and stage, response
+    counts per endpoint and status code, and collectors of other metrics
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.requests = {}
+        self.stages = {}
+        self.responses = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, status, total, stages):
+        with self._lock:
+            histogram = self.requests.get(endpoint)
+            if histogram is None:
+                histogram = self.requests[endpoint] = Histogram(self.buckets)
+            histogram.observe(total)
+
+            for stage, seconds in stages.items():
+                histogram = self.stages.get((endpoint, stage))
+                if histogram is None:
+                    histogram = self.stages[(endpoint, stage)] = Histogram(self.buckets)
+                histogram.observe(seconds)
+
+            key = (endpoint, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def add_collector(self, collector):
+        """
+        Add a function returning a list of (name, type, help, samples) metrics,
+        where samples is a list of (labels, value) pairs
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """All the metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            _render_histograms(
+                lines, 'plays_request_duration_seconds',
+                'Request latency by endpoint', ('endpoint', ), self.requests
+            )
+            _render_histograms(
+                lines, 'plays_stage_duration_seconds',
+                'Latency of the stages of a request by endpoint and stage',
+                ('endpoint', 'stage'), self.stages
+            )
+            _render_metric(
+                lines, 'plays_responses_total', 'counter',
+                'Responses by endpoint and status code',
+                [
+                    ({'endpoint': endpoint, 'code': status}, count)
+                    for (endpoint, status), count in sorted(self.responses.items())
+                ]
+            )
+
+        for collector in self.collectors:
+            for name, type_, help_, samples in collector():
+                _render_metric(lines, name, type_, help_, samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class timed(object):
+    """
+    Context manager adding the time spent in the block to the stage of the
+    current request. A class rather than a generator to keep it cheap.
+    """
+    __slots__ = ('stage', 'timings', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.timings = getattr(_local, 'timings', None)
+
+    def __enter__(self):
+        if self.timings is not None:
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings[self.stage] = (
+                self.timings.get(self.stage, 0) + time.time() - self.start
+            )
+
+
+@metrics.before_app_request
+def start_request():
+    _local.timings = OrderedDict()
+    _local.start = time.time()
+
+
+@metrics.after_app_request
+def end_request(response):
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return response
+    _local.timings = None
+    total = time.time() - _local.start
+
+    # Endpoints of blueprints are prefixed with the blueprint name
+    endpoint = (request.endpoint or 'none').rsplit('.', 1)[-1]
+    registry.record(endpoint, response.status_code, total, timings)
+
+    if current_app.config.get('METRICS_SERVER_TIMING'):
+        response.headers['Server-Timing'] = ', '.join(
+            ['%s;dur=%.3f' % (stage, 1000 * seconds) for stage, seconds in timings.items()] +
+            ['total;dur=%.3f' % (1000 * total)]
+        )
+    return response
+
+
+@metrics.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _render_histograms(lines, name, help_, label_names, histograms):
+    lines.append('# HELP %s %s' % (name, help_))
+    lines.append('# TYPE %s histogram' % name)
+    for key, histogram in sorted(histograms.items()):
+        labels = dict(zip(label_names, key if isinstance(key, tuple) else (key, )))
+        cumulative = 0
+        for le, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, _labels(dict(labels, le=le)), cumulative))
+        lines.append('%s_sum%s %r' % (name, _labels(labels), float(histogram.sum)))
+        lines.append('%s_count%s %d' % (name, _labels(labels), histogram.count))
+
+
+def _render_metric(lines, name, type_, help_, samples):
+    lines.append('# HELP %s %s' % (name, help_))
+    lines.append('# TYPE %s %s' % (name, type_))
+    for labels, value in samples:
+        lines.append('%s%s %r' % (name, _labels(labels), float(value)))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, _escape(value)) for key, value in sorted(labels.items())
+    )
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
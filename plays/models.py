@@ -1,15 +1,37 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import threading
+import uuid
+from collections import Counter
+from datetime import timedelta
 
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
 from cassandra.cqlengine import columns
 from cassandra.cqlengine.models import Model
 from cassandra.cqlengine.management import create_keyspace_simple, sync_table, drop_table
 
-from .db import cluster, session
+from .cache import LRUCache, _naive_utc
+from .db import db, cluster, session
+from .dictionary import CHANNEL, SONG
+from .metrics import timed
 
 logger = logging.getLogger()
 
+# Rollup buckets coarser than hours, from the coarsest
+RESOLUTIONS = ('month', 'week', 'day')
+
+# Songs and performers known to be stored, to skip redundant upserts
+known_songs = LRUCache(
+    maxsize=db.config.get('METADATA_CACHE_SIZE', 10000),
+    ttl=db.config.get('METADATA_CACHE_TTL')
+)
+known_performers = LRUCache(
+    maxsize=db.config.get('METADATA_CACHE_SIZE', 10000),
+    ttl=db.config.get('METADATA_CACHE_TTL')
+)
+
 
 class Channel(Model):
     name = columns.Text(primary_key=True)
@@ -18,12 +40,53 @@ class Channel(Model):
         return '<Channel(name={self.name!r})>'.format(self=self)
 
 
+    insert_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not Channel.insert_stmt:
+            Channel.insert_stmt = session.prepare(
+                """
+                INSERT INTO channel (name) VALUES (?)
+                """
+            )
+
+    @staticmethod
+    def insert(name):
+        Channel._initialize_statements()
+        session.execute(Channel.insert_stmt, [name])
+
+
 class Performer(Model):
     name = columns.Text(primary_key=True)
 
     def __repr__(self):
         return '<Performer(name={self.name!r})>'.format(self=self)
 
+    insert_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not Performer.insert_stmt:
+            Performer.insert_stmt = session.prepare(
+                """
+                INSERT INTO performer (name) VALUES (?)
+                """
+            )
+
+    @staticmethod
+    def insert(name):
+        Performer._initialize_statements()
+        session.execute(Performer.insert_stmt, [name])
+        known_performers.add(name)
+
+    @staticmethod
+    def ensure(name):
+        """Insert the performer unless it is known to be stored already"""
+        if name in known_performers:
+            return
+        Performer.insert(name)
+
 
 class Song(Model):
     title = columns.Text(primary_key=True)
@@ -33,8 +96,40 @@ class Song(Model):
         return '<Song(title={self.title!r})>'.format(self=self)
 
 
+    insert_stmt = None
+
+    @staticmethod
+    def insert(title, performer):
+        Song._initialize_statements()
+        session.execute(Song.insert_stmt, [title, performer])
+        known_songs.add((title, performer))
+
+    @staticmethod
+    def ensure(title, performer):
+        """Insert the song unless it is known to be stored already"""
+        if (title, performer) in known_songs:
+            return
+        Song.insert(title, performer)
+
+    @staticmethod
+    def _initialize_statements():
+        if not Song.insert_stmt:
+            Song.insert_stmt = session.prepare(
+                """
+                INSERT INTO song (title, performer) VALUES (?, ?)
+                """
+            )
+
+
 class PlayByChannel(Model):
+    """
+    Plays partitioned by channel and month, so that a single partition does
+    not grow without limit.
+    """
+    __table_name__ = 'play_by_channel_month'
+
     channel = columns.Text(partition_key=True)
+    month = columns.Integer(partition_key=True)
     start = columns.DateTime(primary_key=True)
     end = columns.DateTime()
 
@@ -46,10 +141,18 @@ class PlayByChannel(Model):
 
 
     song_counts_stmt = None
+    song_counts_open_stmt = None
+    song_rows_stmt = None
+    song_rows_open_stmt = None
+    plays_stmt = None
+    plays_after_stmt = None
+    insert_stmt = None
+    channels_stmt = None
     
     def __init__(self, *args, **kwargs):
         super(PlayByChannel, self).__init__(*args, **kwargs)
-        PlayByChannel._initialize_statements()
+        if self.month is None and self.start is not None:
+            self.month = _month_bucket(self.start)
     
     @staticmethod
     def _initialize_statements():
@@ -59,54 +162,216 @@ class PlayByChannel(Model):
                 SELECT
                     group_and_count(title, performer) as counts 
                 FROM
-                    play_by_channel
+                    play_by_channel_month
+                WHERE
+                    channel=? 
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayByChannel.song_counts_open_stmt:
+            # Same as above, but excluding the end of the range
+            PlayByChannel.song_counts_open_stmt = session.prepare(
+                """
+                SELECT
+                    group_and_count(title, performer) as counts 
+                FROM
+                    play_by_channel_month
                 WHERE
                     channel=? 
                     AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <?
+                """
+            )
+        if not PlayByChannel.song_rows_stmt:
+            # Songs to be counted client side when UDAs are not available
+            PlayByChannel.song_rows_stmt = session.prepare(
+                """
+                SELECT
+                    title, performer
+                FROM
+                    play_by_channel_month
+                WHERE
+                    channel=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <=?
+                """
+            )
+            PlayByChannel.song_rows_stmt.fetch_size = db.config.get('SONG_COUNTS_FETCH_SIZE', 5000)
+        if not PlayByChannel.song_rows_open_stmt:
+            # Same as above, but excluding the end of the range
+            PlayByChannel.song_rows_open_stmt = session.prepare(
+                """
+                SELECT
+                    title, performer
+                FROM
+                    play_by_channel_month
+                WHERE
+                    channel=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <?
+                """
+            )
+            PlayByChannel.song_rows_open_stmt.fetch_size = db.config.get('SONG_COUNTS_FETCH_SIZE', 5000)
+        if not PlayByChannel.plays_stmt:
+            PlayByChannel.plays_stmt = session.prepare(
+                """
+                SELECT
+                    channel, start, "end", title, performer
+                FROM
+                    play_by_channel_month
+                WHERE
+                    channel=?
+                    AND
+                    month=?
+                    AND
                     start>=?
                     AND
                     start <=?
                 """
             )
+        if not PlayByChannel.plays_after_stmt:
+            # Same as above, but excluding the start of the range
+            PlayByChannel.plays_after_stmt = session.prepare(
+                """
+                SELECT
+                    channel, start, "end", title, performer
+                FROM
+                    play_by_channel_month
+                WHERE
+                    channel=?
+                    AND
+                    month=?
+                    AND
+                    start>?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayByChannel.insert_stmt:
+            PlayByChannel.insert_stmt = session.prepare(
+                """
+                INSERT INTO play_by_channel_month
+                    (channel, month, start, "end", title, performer)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """
+            )
+        if not PlayByChannel.channels_stmt:
+            PlayByChannel.channels_stmt = session.prepare(
+                """
+                SELECT DISTINCT channel, month FROM play_by_channel_month
+                """
+            )
 
     @staticmethod
-    def get_song_counts(channels, start, end):
+    def get_plays(channel, start, end, after=None, limit=None):
+        """
+        Plays of a channel in [start, end] ordered by start. If after is
+        given, only plays starting after it are returned. If limit is given,
+        at most limit plays are returned.
+        """
         PlayByChannel._initialize_statements()
-            
-        # TODO: Limit songs by count threshold
-        # Launch async queries for every channel
-        futures = []
-        for channel in channels:
-            future = session.execute_async(
-                PlayByChannel.song_counts_stmt,
-                [channel, start, end]
-            )
-            futures.append((channel, future))
 
+        return _range_results(
+            PlayByChannel.plays_stmt,
+            PlayByChannel.plays_after_stmt,
+            [channel],
+            start, end, after, limit
+        )
+
+    @staticmethod
+    def get_channels():
+        """Channels with plays, listed from the partitions of the table"""
+        PlayByChannel._initialize_statements()
+        return set(row.channel for row in session.execute(PlayByChannel.channels_stmt))
+
+    @staticmethod
+    def channel_song_counts_futures(channel, start, end, include_end=True):
+        """
+        Launch one async query per month in the range. Returns (source,
+        future) pairs: 'uda' futures hold the group_and_count map, 'rows'
+        futures the songs to be counted client side.
+        """
+        PlayByChannel._initialize_statements()
 
-        counts = {}
-        for channel, future in futures:
-            # Block until result is set
-            q = future.result()
+        if db.config.get('SONG_COUNTS_ENGINE', 'uda') == 'client':
+            source = 'rows'
+            stmt = PlayByChannel.song_rows_stmt if include_end else PlayByChannel.song_rows_open_stmt
+        else:
+            source = 'uda'
+            stmt = PlayByChannel.song_counts_stmt if include_end else PlayByChannel.song_counts_open_stmt
 
-            if len(q.current_rows) == 0:
-                continue
+        return [
+            (source, session.execute_async(stmt, [channel, month, start, end]))
+            for month in _month_buckets(start, end)
+        ]
 
-            # Sort song counts descending
-            channel_counts = {}
-            for key, value in q[0].counts.items():
-                l_key = json.loads(key)
-                # Convert title and performer to tuple
-                channel_counts[(l_key[0], l_key[1])] = value
+    @staticmethod
+    def get_song_counts(channels, start, end):
+        return PlayByChannel.get_song_counts_windows(channels, [(start, end)])[0]
 
-            counts[channel] = channel_counts
+    @staticmethod
+    def get_song_counts_windows(channels, windows):
+        """
+        Song counts per channel for several (start, end) windows. The queries
+        of every channel and window are launched before waiting for any of
+        them, so the latency is that of the slowest query.
+        """
+        return [
+            _collect_song_counts(window_futures)
+            for window_futures in PlayByChannel.song_counts_windows_futures(channels, windows)
+        ]
+
+    @staticmethod
+    def song_counts_windows_futures(channels, windows):
+        """
+        Launch the song count queries of every window. Returns a list of
+        (channel, source, future) per window, to merge with
+        _merge_song_counts once they are done.
+        """
+        if db.config.get('SONG_COUNTS_FROM_ROLLUPS'):
+            launch = SongCountByHour.song_counts_futures
+        else:
+            launch = PlayByChannel.song_counts_futures
+        return [launch(channels, start, end) for start, end in windows]
 
-        return counts
+    @staticmethod
+    def song_counts_futures(channels, start, end):
+        """Launch the group_and_count queries of every channel and month"""
+        # TODO: Limit songs by count threshold
+        futures = []
+        for channel in channels:
+            for source, future in PlayByChannel.channel_song_counts_futures(channel, start, end):
+                futures.append((channel, source, future))
+        return futures
 
 
 class PlayBySong(Model):
+    """
+    Plays partitioned by song and month, so that a single partition does not
+    grow without limit.
+    """
+    __table_name__ = 'play_by_song_month'
+
     title = columns.Text(partition_key=True)
     performer = columns.Text(partition_key=True)
+    month = columns.Integer(partition_key=True)
     start = columns.DateTime(primary_key=True)
     end = columns.DateTime()
 
@@ -116,24 +381,1639 @@ class PlayBySong(Model):
         return '<PlayBySong(title={self.title!r})>'.format(self=self)
 
 
-def _sync_database():
-    logger.info("Synching Tables")
-    sync_table(Channel)
-    sync_table(Performer)
-    sync_table(Song)
-    sync_table(PlayByChannel)
-    sync_table(PlayBySong)
+    plays_stmt = None
+    plays_after_stmt = None
+    insert_stmt = None
 
-    logger.info("Finished")
+    def __init__(self, *args, **kwargs):
+        super(PlayBySong, self).__init__(*args, **kwargs)
+        if self.month is None and self.start is not None:
+            self.month = _month_bucket(self.start)
 
+    @staticmethod
+    def _initialize_statements():
+        if not PlayBySong.plays_stmt:
+            PlayBySong.plays_stmt = session.prepare(
+                """
+                SELECT
+                    title, performer, start, "end", channel
+                FROM
+                    play_by_song_month
+                WHERE
+                    title=?
+                    AND
+                    performer=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayBySong.plays_after_stmt:
+            # Same as above, but excluding the start of the range
+            PlayBySong.plays_after_stmt = session.prepare(
+                """
+                SELECT
+                    title, performer, start, "end", channel
+                FROM
+                    play_by_song_month
+                WHERE
+                    title=?
+                    AND
+                    performer=?
+                    AND
+                    month=?
+                    AND
+                    start>?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayBySong.insert_stmt:
+            PlayBySong.insert_stmt = session.prepare(
+                """
+                INSERT INTO play_by_song_month
+                    (title, performer, month, start, "end", channel)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """
+            )
 
-def _recreate_keyspace():
-    logger.info("Dropping tables")
-    drop_table(Channel)
-    drop_table(Performer)
-    drop_table(Song)
-    drop_table(PlayByChannel)
-    drop_table(PlayBySong)
-    
-    _sync_database()
-    
\ No newline at end of file
+    @staticmethod
+    def get_plays(title, performer, start, end, after=None, limit=None):
+        """
+        Plays of a song in [start, end] ordered by start. If after is given,
+        only plays starting after it are returned. If limit is given, at most
+        limit plays are returned.
+        """
+        PlayBySong._initialize_statements()
+
+        return _range_results(
+            PlayBySong.plays_stmt,
+            PlayBySong.plays_after_stmt,
+            [title, performer],
+            start, end, after, limit
+        )
+
+
+class SongCountByHour(Model):
+    """
+    Hourly rollup of plays per channel and song. Counters are incremented on
+    every add_play so that song counts for a time window can be computed from
+    at most 24 buckets per day instead of scanning the raw plays.
+    """
+    channel = columns.Text(partition_key=True)
+    hour = columns.DateTime(partition_key=True)
+    title = columns.Text(primary_key=True)
+    performer = columns.Text(primary_key=True)
+    plays = columns.Counter()
+
+    def __repr__(self):
+        return '<SongCountByHour(channel={self.channel!r}, hour={self.hour!r})>'.format(self=self)
+
+
+    increment_stmt = None
+    bucket_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not SongCountByHour.increment_stmt:
+            SongCountByHour.increment_stmt = session.prepare(
+                """
+                UPDATE
+                    song_count_by_hour
+                SET
+                    plays = plays + ?
+                WHERE
+                    channel=?
+                    AND
+                    hour=?
+                    AND
+                    title=?
+                    AND
+                    performer=?
+                """
+            )
+        if not SongCountByHour.bucket_stmt:
+            SongCountByHour.bucket_stmt = session.prepare(
+                """
+                SELECT
+                    title, performer, plays
+                FROM
+                    song_count_by_hour
+                WHERE
+                    channel=?
+                    AND
+                    hour=?
+                """
+            )
+
+    @staticmethod
+    def increment(channel, start, title, performer, plays=1):
+        SongCountByHour._initialize_statements()
+        session.execute(
+            SongCountByHour.increment_stmt,
+            [plays, channel, _hour_bucket(start), title, performer]
+        )
+
+    @staticmethod
+    def song_counts_futures(channels, start, end):
+        """
+        Launch the queries for the song counts per channel in [start, end].
+        Whole hours are read from the rollup buckets, coarser buckets included
+        (see _plan_buckets), the fragments at both edges of the window are
+        aggregated from the raw plays.
+        """
+        SongCountByHour._initialize_statements()
+        SongCountByBucket._initialize_statements()
+        return _rollup_song_counts_futures(
+            channels, start, end,
+            SongCountByHour.bucket_stmt, SongCountByBucket.bucket_stmt, 'rollup',
+            PlayByChannel.channel_song_counts_futures
+        )
+
+
+class SongCountByBucket(Model):
+    """
+    Rollups of plays per channel and song in day, week and month buckets
+    (ROLLUP_RESOLUTIONS), which complement the hourly ones so that long
+    windows are counted from a few coarse buckets
+    """
+    __table_name__ = 'song_count_by_bucket'
+
+    channel = columns.Text(partition_key=True)
+    resolution = columns.Text(partition_key=True)
+    bucket = columns.DateTime(partition_key=True)
+    title = columns.Text(primary_key=True)
+    performer = columns.Text(primary_key=True)
+    plays = columns.Counter()
+
+    def __repr__(self):
+        return '<SongCountByBucket(channel={self.channel!r}, resolution={self.resolution!r}, bucket={self.bucket!r})>'.format(self=self)
+
+
+    increment_stmt = None
+    bucket_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not SongCountByBucket.increment_stmt:
+            SongCountByBucket.increment_stmt = session.prepare(
+                """
+                UPDATE
+                    song_count_by_bucket
+                SET
+                    plays = plays + ?
+                WHERE
+                    channel=?
+                    AND
+                    resolution=?
+                    AND
+                    bucket=?
+                    AND
+                    title=?
+                    AND
+                    performer=?
+                """
+            )
+        if not SongCountByBucket.bucket_stmt:
+            SongCountByBucket.bucket_stmt = session.prepare(
+                """
+                SELECT
+                    title, performer, plays
+                FROM
+                    song_count_by_bucket
+                WHERE
+                    channel=?
+                    AND
+                    resolution=?
+                    AND
+                    bucket=?
+                """
+            )
+
+
+class SongSketchByHour(Model):
+    """
+    Space-Saving sketches of the songs played per channel and hour, as JSON.
+    Every flush of a process adds new sketches to the partition, and they are
+    merged when read. Ids are given by the process, so that a sketch written
+    again after a failed flush replaces the first write.
+    """
+    channel = columns.Text(partition_key=True)
+    hour = columns.DateTime(partition_key=True)
+    id = columns.TimeUUID(primary_key=True, default=uuid.uuid1)
+    sketch = columns.Text()
+
+    def __repr__(self):
+        return '<SongSketchByHour(channel={self.channel!r}, hour={self.hour!r})>'.format(self=self)
+
+
+    insert_stmt = None
+    select_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not SongSketchByHour.insert_stmt:
+            SongSketchByHour.insert_stmt = session.prepare(
+                """
+                INSERT INTO
+                    song_sketch_by_hour (channel, hour, id, sketch)
+                VALUES
+                    (?, ?, ?, ?)
+                """
+            )
+        if not SongSketchByHour.select_stmt:
+            SongSketchByHour.select_stmt = session.prepare(
+                """
+                SELECT
+                    id, sketch
+                FROM
+                    song_sketch_by_hour
+                WHERE
+                    channel=?
+                    AND
+                    hour=?
+                """
+            )
+
+    @staticmethod
+    def add_sketches(sketches, concurrency=50):
+        """Store (channel, hour, id, sketch) tuples"""
+        SongSketchByHour._initialize_statements()
+        execute_concurrent_with_args(
+            session,
+            SongSketchByHour.insert_stmt,
+            sketches,
+            concurrency=concurrency
+        )
+
+    @staticmethod
+    def get_sketches(keys):
+        SongSketchByHour._initialize_statements()
+        futures = [
+            (key, session.execute_async(SongSketchByHour.select_stmt, list(key)))
+            for key in keys
+        ]
+        sketches = {}
+        for key, future in futures:
+            rows = dict((row.id, row.sketch) for row in future.result())
+            if rows:
+                sketches[key] = rows
+        return sketches
+
+
+class ChartByWeek(Model):
+    """Frozen weekly charts of groups of channels, as JSON"""
+    __table_name__ = 'chart_by_week'
+
+    chart = columns.Text(partition_key=True)
+    week = columns.DateTime(partition_key=True)
+    songs = columns.Text()
+
+    def __repr__(self):
+        return '<ChartByWeek(chart={self.chart!r}, week={self.week!r})>'.format(self=self)
+
+
+    insert_stmt = None
+    select_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not ChartByWeek.insert_stmt:
+            # The first process to freeze the chart of a week wins
+            ChartByWeek.insert_stmt = session.prepare(
+                """
+                INSERT INTO chart_by_week (chart, week, songs) VALUES (?, ?, ?) IF NOT EXISTS
+                """
+            )
+        if not ChartByWeek.select_stmt:
+            ChartByWeek.select_stmt = session.prepare(
+                """
+                SELECT songs FROM chart_by_week WHERE chart=? AND week=?
+                """
+            )
+
+    @staticmethod
+    def insert(chart, week, songs):
+        """Store the chart of a week unless stored already. Returns the stored songs"""
+        ChartByWeek._initialize_statements()
+        row = session.execute(ChartByWeek.insert_stmt, [chart, week, songs])[0]
+        # Rows of conditional inserts that were not applied hold the stored songs
+        return songs if row[0] else row.songs
+
+    @staticmethod
+    def get(chart, week):
+        ChartByWeek._initialize_statements()
+        rows = session.execute(ChartByWeek.select_stmt, [chart, week])
+        return rows[0].songs if rows else None
+
+
+class IdAllocation(Model):
+    """
+    Next id to allocate per kind of name. Processes reserve blocks of ids
+    with lightweight transactions and hand them out locally.
+    """
+    kind = columns.Text(primary_key=True)
+    next_id = columns.Integer()
+
+    def __repr__(self):
+        return '<IdAllocation(kind={self.kind!r})>'.format(self=self)
+
+
+    select_stmt = None
+    insert_stmt = None
+    update_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not IdAllocation.select_stmt:
+            IdAllocation.select_stmt = session.prepare(
+                """
+                SELECT next_id FROM id_allocation WHERE kind=?
+                """
+            )
+        if not IdAllocation.insert_stmt:
+            IdAllocation.insert_stmt = session.prepare(
+                """
+                INSERT INTO id_allocation (kind, next_id) VALUES (?, ?) IF NOT EXISTS
+                """
+            )
+        if not IdAllocation.update_stmt:
+            IdAllocation.update_stmt = session.prepare(
+                """
+                UPDATE id_allocation SET next_id=? WHERE kind=? IF next_id=?
+                """
+            )
+
+    @staticmethod
+    def reserve(kind, size):
+        """Reserve size ids of a kind. Returns the first one"""
+        IdAllocation._initialize_statements()
+        while True:
+            rows = session.execute(IdAllocation.select_stmt, [kind])
+            if not rows:
+                first = 1
+                applied = session.execute(
+                    IdAllocation.insert_stmt, [kind, first + size]
+                )[0][0]
+            else:
+                first = rows[0].next_id
+                applied = session.execute(
+                    IdAllocation.update_stmt, [first + size, kind, first]
+                )[0][0]
+            if applied:
+                return first
+
+
+class IdByName(Model):
+    """Id of every name per kind. Songs are named by their JSON [title, performer]"""
+    __table_name__ = 'id_by_name'
+
+    kind = columns.Text(partition_key=True)
+    name = columns.Text(partition_key=True)
+    id = columns.Integer()
+
+    def __repr__(self):
+        return '<IdByName(kind={self.kind!r}, name={self.name!r})>'.format(self=self)
+
+
+    select_stmt = None
+    insert_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not IdByName.select_stmt:
+            IdByName.select_stmt = session.prepare(
+                """
+                SELECT id FROM id_by_name WHERE kind=? AND name=?
+                """
+            )
+        if not IdByName.insert_stmt:
+            # The first process to store an id for a name wins
+            IdByName.insert_stmt = session.prepare(
+                """
+                INSERT INTO id_by_name (kind, name, id) VALUES (?, ?, ?) IF NOT EXISTS
+                """
+            )
+
+
+class NameById(Model):
+    """Name of every id per kind"""
+    __table_name__ = 'name_by_id'
+
+    kind = columns.Text(partition_key=True)
+    id = columns.Integer(partition_key=True)
+    name = columns.Text()
+
+    def __repr__(self):
+        return '<NameById(kind={self.kind!r}, id={self.id!r})>'.format(self=self)
+
+
+    select_stmt = None
+    insert_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not NameById.select_stmt:
+            NameById.select_stmt = session.prepare(
+                """
+                SELECT name FROM name_by_id WHERE kind=? AND id=?
+                """
+            )
+        if not NameById.insert_stmt:
+            NameById.insert_stmt = session.prepare(
+                """
+                INSERT INTO name_by_id (kind, id, name) VALUES (?, ?, ?)
+                """
+            )
+
+
+class PlayByChannelId(Model):
+    """
+    Dictionary encoded PlayByChannel: channels and songs are stored by id
+    """
+    __table_name__ = 'play_by_channel_id'
+
+    channel_id = columns.Integer(partition_key=True)
+    month = columns.Integer(partition_key=True)
+    start = columns.DateTime(primary_key=True)
+    end = columns.DateTime()
+
+    song_id = columns.Integer()
+
+    def __repr__(self):
+        return '<PlayByChannelId(channel_id={self.channel_id!r})>'.format(self=self)
+
+
+    song_counts_stmt = None
+    song_counts_open_stmt = None
+    song_rows_stmt = None
+    song_rows_open_stmt = None
+    plays_stmt = None
+    plays_after_stmt = None
+    insert_stmt = None
+    channels_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not PlayByChannelId.song_counts_stmt:
+            PlayByChannelId.song_counts_stmt = session.prepare(
+                """
+                SELECT
+                    count_ids(song_id) as counts
+                FROM
+                    play_by_channel_id
+                WHERE
+                    channel_id=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayByChannelId.song_counts_open_stmt:
+            # Same as above, but excluding the end of the range
+            PlayByChannelId.song_counts_open_stmt = session.prepare(
+                """
+                SELECT
+                    count_ids(song_id) as counts
+                FROM
+                    play_by_channel_id
+                WHERE
+                    channel_id=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <?
+                """
+            )
+        if not PlayByChannelId.song_rows_stmt:
+            PlayByChannelId.song_rows_stmt = session.prepare(
+                """
+                SELECT
+                    song_id
+                FROM
+                    play_by_channel_id
+                WHERE
+                    channel_id=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <=?
+                """
+            )
+            PlayByChannelId.song_rows_stmt.fetch_size = db.config.get('SONG_COUNTS_FETCH_SIZE', 5000)
+        if not PlayByChannelId.song_rows_open_stmt:
+            # Same as above, but excluding the end of the range
+            PlayByChannelId.song_rows_open_stmt = session.prepare(
+                """
+                SELECT
+                    song_id
+                FROM
+                    play_by_channel_id
+                WHERE
+                    channel_id=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <?
+                """
+            )
+            PlayByChannelId.song_rows_open_stmt.fetch_size = db.config.get('SONG_COUNTS_FETCH_SIZE', 5000)
+        if not PlayByChannelId.plays_stmt:
+            PlayByChannelId.plays_stmt = session.prepare(
+                """
+                SELECT
+                    start, "end", song_id
+                FROM
+                    play_by_channel_id
+                WHERE
+                    channel_id=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayByChannelId.plays_after_stmt:
+            # Same as above, but excluding the start of the range
+            PlayByChannelId.plays_after_stmt = session.prepare(
+                """
+                SELECT
+                    start, "end", song_id
+                FROM
+                    play_by_channel_id
+                WHERE
+                    channel_id=?
+                    AND
+                    month=?
+                    AND
+                    start>?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayByChannelId.insert_stmt:
+            PlayByChannelId.insert_stmt = session.prepare(
+                """
+                INSERT INTO play_by_channel_id
+                    (channel_id, month, start, "end", song_id)
+                VALUES (?, ?, ?, ?, ?)
+                """
+            )
+        if not PlayByChannelId.channels_stmt:
+            PlayByChannelId.channels_stmt = session.prepare(
+                """
+                SELECT DISTINCT channel_id, month FROM play_by_channel_id
+                """
+            )
+
+    @staticmethod
+    def get_plays(channel_id, start, end, after=None, limit=None):
+        """Same as PlayByChannel.get_plays, returning (start, end, song_id) rows"""
+        PlayByChannelId._initialize_statements()
+
+        return _range_results(
+            PlayByChannelId.plays_stmt,
+            PlayByChannelId.plays_after_stmt,
+            [channel_id],
+            start, end, after, limit
+        )
+
+    @staticmethod
+    def get_channels():
+        """Same as PlayByChannel.get_channels, returning channel ids"""
+        PlayByChannelId._initialize_statements()
+        return set(row.channel_id for row in session.execute(PlayByChannelId.channels_stmt))
+
+    @staticmethod
+    def channel_song_counts_futures(channel_id, start, end, include_end=True):
+        """
+        Same as PlayByChannel.channel_song_counts_futures, with 'id_uda' futures
+        holding the count_ids map and 'id_rows' futures the song ids
+        """
+        PlayByChannelId._initialize_statements()
+
+        if db.config.get('SONG_COUNTS_ENGINE', 'uda') == 'client':
+            source = 'id_rows'
+            stmt = PlayByChannelId.song_rows_stmt if include_end else PlayByChannelId.song_rows_open_stmt
+        else:
+            source = 'id_uda'
+            stmt = PlayByChannelId.song_counts_stmt if include_end else PlayByChannelId.song_counts_open_stmt
+
+        return [
+            (source, session.execute_async(stmt, [channel_id, month, start, end]))
+            for month in _month_buckets(start, end)
+        ]
+
+    @staticmethod
+    def get_song_counts_windows(channel_ids, windows):
+        """
+        Same as PlayByChannel.get_song_counts_windows, as
+        {channel_id: {song_id: count}}
+        """
+        return [
+            _collect_song_counts(window_futures)
+            for window_futures in PlayByChannelId.song_counts_windows_futures(channel_ids, windows)
+        ]
+
+    @staticmethod
+    def song_counts_windows_futures(channel_ids, windows):
+        """Same as PlayByChannel.song_counts_windows_futures"""
+        if db.config.get('SONG_COUNTS_FROM_ROLLUPS'):
+            launch = SongCountByHourId.song_counts_futures
+        else:
+            launch = PlayByChannelId.song_counts_futures
+        return [launch(channel_ids, start, end) for start, end in windows]
+
+    @staticmethod
+    def song_counts_futures(channel_ids, start, end):
+        futures = []
+        for channel_id in channel_ids:
+            for source, future in PlayByChannelId.channel_song_counts_futures(channel_id, start, end):
+                futures.append((channel_id, source, future))
+        return futures
+
+
+class PlayBySongId(Model):
+    """
+    Dictionary encoded PlayBySong: songs and channels are stored by id
+    """
+    __table_name__ = 'play_by_song_id'
+
+    song_id = columns.Integer(partition_key=True)
+    month = columns.Integer(partition_key=True)
+    start = columns.DateTime(primary_key=True)
+    end = columns.DateTime()
+
+    channel_id = columns.Integer()
+
+    def __repr__(self):
+        return '<PlayBySongId(song_id={self.song_id!r})>'.format(self=self)
+
+
+    plays_stmt = None
+    plays_after_stmt = None
+    insert_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not PlayBySongId.plays_stmt:
+            PlayBySongId.plays_stmt = session.prepare(
+                """
+                SELECT
+                    start, "end", channel_id
+                FROM
+                    play_by_song_id
+                WHERE
+                    song_id=?
+                    AND
+                    month=?
+                    AND
+                    start>=?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayBySongId.plays_after_stmt:
+            # Same as above, but excluding the start of the range
+            PlayBySongId.plays_after_stmt = session.prepare(
+                """
+                SELECT
+                    start, "end", channel_id
+                FROM
+                    play_by_song_id
+                WHERE
+                    song_id=?
+                    AND
+                    month=?
+                    AND
+                    start>?
+                    AND
+                    start <=?
+                """
+            )
+        if not PlayBySongId.insert_stmt:
+            PlayBySongId.insert_stmt = session.prepare(
+                """
+                INSERT INTO play_by_song_id
+                    (song_id, month, start, "end", channel_id)
+                VALUES (?, ?, ?, ?, ?)
+                """
+            )
+
+    @staticmethod
+    def get_plays(song_id, start, end, after=None, limit=None):
+        """Same as PlayBySong.get_plays, returning (start, end, channel_id) rows"""
+        PlayBySongId._initialize_statements()
+
+        return _range_results(
+            PlayBySongId.plays_stmt,
+            PlayBySongId.plays_after_stmt,
+            [song_id],
+            start, end, after, limit
+        )
+
+
+class SongCountByHourId(Model):
+    """
+    Dictionary encoded SongCountByHour: channels and songs are stored by id
+    """
+    __table_name__ = 'song_count_by_hour_id'
+
+    channel_id = columns.Integer(partition_key=True)
+    hour = columns.DateTime(partition_key=True)
+    song_id = columns.Integer(primary_key=True)
+    plays = columns.Counter()
+
+    def __repr__(self):
+        return '<SongCountByHourId(channel_id={self.channel_id!r}, hour={self.hour!r})>'.format(self=self)
+
+
+    increment_stmt = None
+    bucket_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not SongCountByHourId.increment_stmt:
+            SongCountByHourId.increment_stmt = session.prepare(
+                """
+                UPDATE
+                    song_count_by_hour_id
+                SET
+                    plays = plays + ?
+                WHERE
+                    channel_id=?
+                    AND
+                    hour=?
+                    AND
+                    song_id=?
+                """
+            )
+        if not SongCountByHourId.bucket_stmt:
+            SongCountByHourId.bucket_stmt = session.prepare(
+                """
+                SELECT
+                    song_id, plays
+                FROM
+                    song_count_by_hour_id
+                WHERE
+                    channel_id=?
+                    AND
+                    hour=?
+                """
+            )
+
+    @staticmethod
+    def song_counts_futures(channel_ids, start, end):
+        """Same as SongCountByHour.song_counts_futures for channel ids"""
+        SongCountByHourId._initialize_statements()
+        SongCountByBucketId._initialize_statements()
+        return _rollup_song_counts_futures(
+            channel_ids, start, end,
+            SongCountByHourId.bucket_stmt, SongCountByBucketId.bucket_stmt, 'id_rollup',
+            PlayByChannelId.channel_song_counts_futures
+        )
+
+
+class SongCountByBucketId(Model):
+    """
+    Dictionary encoded SongCountByBucket: channels and songs are stored by id
+    """
+    __table_name__ = 'song_count_by_bucket_id'
+
+    channel_id = columns.Integer(partition_key=True)
+    resolution = columns.Text(partition_key=True)
+    bucket = columns.DateTime(partition_key=True)
+    song_id = columns.Integer(primary_key=True)
+    plays = columns.Counter()
+
+    def __repr__(self):
+        return '<SongCountByBucketId(channel_id={self.channel_id!r}, resolution={self.resolution!r}, bucket={self.bucket!r})>'.format(self=self)
+
+
+    increment_stmt = None
+    bucket_stmt = None
+
+    @staticmethod
+    def _initialize_statements():
+        if not SongCountByBucketId.increment_stmt:
+            SongCountByBucketId.increment_stmt = session.prepare(
+                """
+                UPDATE
+                    song_count_by_bucket_id
+                SET
+                    plays = plays + ?
+                WHERE
+                    channel_id=?
+                    AND
+                    resolution=?
+                    AND
+                    bucket=?
+                    AND
+                    song_id=?
+                """
+            )
+        if not SongCountByBucketId.bucket_stmt:
+            SongCountByBucketId.bucket_stmt = session.prepare(
+                """
+                SELECT
+                    song_id, plays
+                FROM
+                    song_count_by_bucket_id
+                WHERE
+                    channel_id=?
+                    AND
+                    resolution=?
+                    AND
+                    bucket=?
+                """
+            )
+
+
+# Blocks of ids reserved by this process, per kind: [next id, end]
+_id_blocks = {}
+_id_blocks_lock = threading.Lock()
+
+
+def _name_key(kind, name):
+    """Text of a name in the dictionary tables"""
+    if kind == SONG:
+        return json.dumps(list(name))
+    return name
+
+
+def _name_value(kind, key):
+    if kind == SONG:
+        return tuple(json.loads(key))
+    return key
+
+
+def get_ids(kind, names):
+    """Ids of the names of a kind stored in id_by_name, as {name: id}"""
+    IdByName._initialize_statements()
+    futures = [
+        (name, session.execute_async(IdByName.select_stmt, [kind, _name_key(kind, name)]))
+        for name in names
+    ]
+    ids = {}
+    for name, future in futures:
+        rows = future.result()
+        if rows:
+            ids[name] = rows[0].id
+    return ids
+
+
+def add_ids(kind, names, block_size=100):
+    """
+    Allocate ids to names of a kind. The name of an id is stored before the
+    id of the name, so that ids are always decodable. A name allocated by
+    another process at the same time keeps the first id stored, and the id
+    allocated here is left unused. Returns {name: id}.
+    """
+    IdByName._initialize_statements()
+    NameById._initialize_statements()
+
+    allocated = {}
+    with _id_blocks_lock:
+        for name in names:
+            block = _id_blocks.get(kind)
+            if block is None or block[0] >= block[1]:
+                first = IdAllocation.reserve(kind, block_size)
+                block = _id_blocks[kind] = [first, first + block_size]
+            allocated[name] = block[0]
+            block[0] += 1
+
+    execute_concurrent_with_args(
+        session,
+        NameById.insert_stmt,
+        [(kind, id_, _name_key(kind, name)) for name, id_ in allocated.items()]
+    )
+
+    futures = [
+        (name, id_, session.execute_async(
+            IdByName.insert_stmt, [kind, _name_key(kind, name), id_]
+        ))
+        for name, id_ in allocated.items()
+    ]
+    ids = {}
+    for name, id_, future in futures:
+        row = future.result()[0]
+        # Rows of conditional inserts that were not applied hold the stored id
+        ids[name] = id_ if row[0] else row.id
+    return ids
+
+
+def get_names(kind, ids):
+    """Names of the ids of a kind, as {id: name}"""
+    NameById._initialize_statements()
+    futures = [
+        (id_, session.execute_async(NameById.select_stmt, [kind, id_]))
+        for id_ in ids
+    ]
+    names = {}
+    for id_, future in futures:
+        rows = future.result()
+        if rows:
+            names[id_] = _name_value(kind, rows[0].name)
+    return names
+
+
+# Buckets are taken from the UTC time, as the driver stores timestamps in UTC
+def _hour_bucket(dt):
+    return _naive_utc(dt).replace(minute=0, second=0, microsecond=0)
+
+
+def _month_bucket(dt):
+    dt = _naive_utc(dt)
+    return dt.year * 100 + dt.month
+
+
+def _month_buckets(start, end):
+    """Month buckets overlapping [start, end] in ascending order"""
+    start = _naive_utc(start)
+    end = _naive_utc(end)
+    buckets = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        buckets.append(year * 100 + month)
+        month += 1
+        if month > 12:
+            year += 1
+            month = 1
+    return buckets
+
+
+def _bucket_start(resolution, dt):
+    """Start of the rollup bucket of a naive UTC datetime"""
+    if resolution == 'hour':
+        return _hour_bucket(dt)
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution == 'day':
+        return day
+    if resolution == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def _next_bucket(resolution, bucket):
+    if resolution == 'hour':
+        return bucket + timedelta(hours=1)
+    if resolution == 'day':
+        return bucket + timedelta(days=1)
+    if resolution == 'week':
+        return bucket + timedelta(days=7)
+    if bucket.month == 12:
+        return bucket.replace(year=bucket.year + 1, month=1)
+    return bucket.replace(month=bucket.month + 1)
+
+
+def _plan_buckets(start, end, resolutions):
+    """
+    Split [start, end), between whole hours, into aligned rollup buckets as
+    in a segment tree: the buckets of the coarsest resolution that fit in the
+    range, then recursively those of the finer resolutions in the fragments
+    left at both edges, down to hours. Returns (resolution, bucket) pairs of
+    naive UTC bucket starts in order.
+
+    Weeks start on Monday and do not nest in months, so they are only used
+    for the fragments left by months.
+    """
+    levels = [
+        resolution for resolution in RESOLUTIONS if resolution in resolutions
+    ] + ['hour']
+    return _split_buckets(_naive_utc(start), _naive_utc(end), levels)
+
+
+def _split_buckets(start, end, levels):
+    if start >= end:
+        return []
+
+    resolution = levels[0]
+    first = _bucket_start(resolution, start)
+    if first < start:
+        first = _next_bucket(resolution, first)
+
+    buckets = []
+    bucket = first
+    while bucket < end:
+        next_bucket = _next_bucket(resolution, bucket)
+        if next_bucket > end:
+            break
+        buckets.append((resolution, bucket))
+        bucket = next_bucket
+
+    if not buckets:
+        return _split_buckets(start, end, levels[1:])
+    return (
+        _split_buckets(start, first, levels[1:]) +
+        buckets +
+        _split_buckets(bucket, end, levels[1:])
+    )
+
+
+def _rollup_song_counts_futures(channels, start, end, hour_stmt, bucket_stmt, source,
+                                channel_song_counts_futures):
+    """
+    Launch the queries of the rollup buckets fully inside [start, end], hours
+    with hour_stmt and coarser buckets with bucket_stmt, and those of the
+    fragments of the window at both edges with channel_song_counts_futures.
+    Returns (channel, source, future) tuples.
+    """
+    start = _naive_utc(start)
+    end = _naive_utc(end)
+    first_hour = _hour_bucket(start)
+    if first_hour < start:
+        first_hour += timedelta(hours=1)
+    last_hour = _hour_bucket(end)
+
+    buckets = []
+    if first_hour < last_hour:
+        buckets = _plan_buckets(first_hour, last_hour, db.config.get('ROLLUP_RESOLUTIONS', ()))
+
+    # Launch async queries for every channel and bucket
+    futures = []
+    for channel in channels:
+        def add_plays(fragment_start, fragment_end, include_end):
+            for fragment_source, future in channel_song_counts_futures(
+                    channel, fragment_start, fragment_end, include_end):
+                futures.append((channel, fragment_source, future))
+
+        if first_hour >= last_hour:
+            add_plays(start, end, True)
+            continue
+
+        if start < first_hour:
+            add_plays(start, first_hour, False)
+
+        for resolution, bucket in buckets:
+            if resolution == 'hour':
+                future = session.execute_async(hour_stmt, [channel, bucket])
+            else:
+                future = session.execute_async(bucket_stmt, [channel, resolution, bucket])
+            futures.append((channel, source, future))
+
+        add_plays(last_hour, end, True)
+
+    return futures
+
+
+def _iterate_results(futures):
+    """Iterate over the rows of several result sets in order"""
+    for future in futures:
+        for row in future.result():
+            yield row
+
+
+def _range_results(stmt, after_stmt, key, start, end, after=None, limit=None):
+    """
+    Rows of a month partitioned table in [start, end], or in (after, end]
+    when after is given, ordered by start.
+
+    Without a limit the queries of every month are launched at once. With a
+    limit, months are queried one after the other, fetching at most limit rows
+    from each, until enough rows have been read.
+    """
+    if after is not None:
+        stmt = after_stmt
+        start = after
+
+    months = _month_buckets(start, end)
+    if limit is None:
+        futures = [
+            session.execute_async(stmt, key + [month, start, end])
+            for month in months
+        ]
+        return _iterate_results(futures)
+
+    def iterate():
+        remaining = limit
+        for month in months:
+            bound = stmt.bind(key + [month, start, end])
+            bound.fetch_size = remaining
+            for row in session.execute(bound):
+                yield row
+                remaining -= 1
+                if remaining == 0:
+                    return
+
+    return iterate()
+
+
+def _collect_song_counts(futures):
+    """
+    Wait for the song count queries launched for a window and merge their
+    results per channel
+    """
+    # Block until every result is set, in turn
+    return _merge_song_counts(
+        (channel, source, future.result()) for channel, source, future in futures
+    )
+
+
+def _merge_song_counts(results):
+    """
+    Merge the (channel, source, rows) results of the song count queries of a
+    window per channel. Rows are result sets or lists of rows.
+    """
+    counts = {}
+    for channel, source, rows in results:
+        with timed('decode'):
+            if source == 'uda':
+                bucket_counts = _decode_song_counts(rows).items()
+            elif source == 'rows':
+                # Rows are (title, performer) named tuples, which hash and
+                # compare as plain tuples. Iterating fetches the next pages.
+                bucket_counts = Counter(rows).items()
+            elif source == 'rollup':
+                bucket_counts = (
+                    ((row.title, row.performer), row.plays) for row in rows
+                )
+            elif source == 'id_uda':
+                # The count_ids map is already keyed by song id
+                bucket_counts = _aggregate_counts(rows).items()
+            elif source == 'id_rows':
+                bucket_counts = Counter(row.song_id for row in rows).items()
+            else:
+                bucket_counts = ((row.song_id, row.plays) for row in rows)
+
+            channel_counts = counts.setdefault(channel, {})
+            for key, value in bucket_counts:
+                channel_counts[key] = channel_counts.get(key, 0) + value
+
+    return {
+        channel: channel_counts
+        for channel, channel_counts in counts.items()
+        if channel_counts
+    }
+
+
+def _aggregate_counts(rows):
+    """Map of the single row of a counting UDA, empty if there is none"""
+    for row in rows:
+        return row.counts or {}
+    return {}
+
+
+def _decode_song_counts(rows):
+    """
+    Convert the map returned by the group_and_count UDA into a dictionary
+    keyed by (title, performer)
+    """
+    song_counts = {}
+    for key, value in _aggregate_counts(rows).items():
+        l_key = json.loads(key)
+        # Convert title and performer to tuple
+        song_counts[(l_key[0], l_key[1])] = value
+    return song_counts
+
+
+def save_play(play, channel_id=None, song_id=None):
+    """
+    Write a play to both play tables and, with SONG_COUNTS_FROM_ROLLUPS,
+    count it in the hourly rollups and in the coarser ones of
+    ROLLUP_RESOLUTIONS, with prepared statements executed concurrently. When the ids of its channel and song are given,
+    the play goes to the dictionary encoded tables.
+    """
+    by_channel, by_song, song_counts, bucket_counts = _play_tables(song_id is not None)
+    if song_id is None:
+        channel, song = play.channel, [play.title, play.performer]
+    else:
+        channel, song = channel_id, [song_id]
+
+    month = _month_bucket(play.start)
+    futures = [
+        session.execute_async(
+            by_channel.insert_stmt,
+            [channel, month, play.start, play.end] + song
+        ),
+        session.execute_async(
+            by_song.insert_stmt,
+            song + [month, play.start, play.end, channel]
+        ),
+    ]
+    # Counters are only paid for when get_top reads them
+    if db.config.get('SONG_COUNTS_FROM_ROLLUPS'):
+        futures.append(session.execute_async(
+            song_counts.increment_stmt,
+            [1, channel, _hour_bucket(play.start)] + song
+        ))
+        start = _naive_utc(play.start)
+        for resolution in db.config.get('ROLLUP_RESOLUTIONS', ()):
+            futures.append(session.execute_async(
+                bucket_counts.increment_stmt,
+                [1, channel, resolution, _bucket_start(resolution, start)] + song
+            ))
+
+    # Make sure that the song is inserted in the database
+    Song.ensure(play.title, play.performer)
+
+    for future in futures:
+        future.result()
+
+
+def _play_tables(encoded):
+    """
+    Play by channel, play by song, hourly rollup and coarser rollup models,
+    with their statements
+    """
+    if encoded:
+        tables = (PlayByChannelId, PlayBySongId, SongCountByHourId, SongCountByBucketId)
+    else:
+        tables = (PlayByChannel, PlayBySong, SongCountByHour, SongCountByBucket)
+    for table in tables:
+        table._initialize_statements()
+    return tables
+
+
+_MODELS = (Channel, Performer, Song, PlayByChannel, PlayBySong,
+           SongCountByHour, SongSketchByHour, IdAllocation, IdByName,
+           NameById, PlayByChannelId, PlayBySongId, SongCountByHourId,
+           ChartByWeek, SongCountByBucket, SongCountByBucketId)
+
+
+def _prepare_statements():
+    """Prepare the statements of every table once, at start up"""
+    for model in _MODELS:
+        model._initialize_statements()
+
+
+def _reset_session():
+    """
+    Use the session of plays.db after init_db_blueprint was run again, as in
+    processes forked from a connected one: the statements are prepared again
+    and the id blocks of the parent are dropped, so that processes do not
+    allocate the same ids.
+    """
+    from . import db as _db
+    global cluster, session
+    cluster = _db.cluster
+    session = _db.session
+
+    for model in _MODELS:
+        for name in list(vars(model)):
+            if name.endswith('_stmt'):
+                setattr(model, name, None)
+    with _id_blocks_lock:
+        _id_blocks.clear()
+    _prepare_statements()
+
+
+def save_plays(plays, concurrency=50, batch_size=100, channel_ids=None, song_ids=None):
+    """
+    Write plays to every table with prepared statements executed
+    asynchronously, keeping at most `concurrency` requests in flight. Rows
+    that go to the same partition are grouped in unlogged batches of at most
+    `batch_size` statements.
+
+    plays is a list of (index, play) pairs where every play has a channel,
+    start, end, title and performer attributes. Returns a dictionary with the error of
+    every index whose writes failed. When the ids of their channels and
+    (title, performer) songs are given, plays go to the dictionary encoded
+    tables. Plays are counted in the rollups with SONG_COUNTS_FROM_ROLLUPS only.
+    """
+    Song._initialize_statements()
+    play_by_channel, play_by_song, song_count_by_hour, song_count_by_bucket = _play_tables(
+        song_ids is not None
+    )
+    rollups = db.config.get('SONG_COUNTS_FROM_ROLLUPS')
+    resolutions = db.config.get('ROLLUP_RESOLUTIONS', ())
+
+    by_channel = {}
+    by_song = {}
+    song_counts = {}
+    bucket_counts = {}
+    songs = {}
+    for index, play in plays:
+        month = _month_bucket(play.start)
+        song = (play.title, play.performer)
+        if song_ids is None:
+            channel_key, song_key = play.channel, song
+        else:
+            channel_key, song_key = channel_ids[play.channel], (song_ids[song],)
+
+        by_channel.setdefault((channel_key, month), []).append((
+            [index],
+            (channel_key, month, play.start, play.end) + song_key
+        ))
+        by_song.setdefault(song_key + (month,), []).append((
+            [index],
+            song_key + (month, play.start, play.end, channel_key)
+        ))
+
+        if rollups:
+            bucket = song_counts.setdefault((channel_key, _hour_bucket(play.start)), {})
+            bucket.setdefault(song_key, []).append(index)
+            start = _naive_utc(play.start)
+            for resolution in resolutions:
+                bucket = bucket_counts.setdefault(
+                    (channel_key, resolution, _bucket_start(resolution, start)), {}
+                )
+                bucket.setdefault(song_key, []).append(index)
+
+        if song not in known_songs:
+            songs.setdefault(song, []).append(index)
+
+    statements = []
+    indexes = []
+
+    def add_batches(stmt, partitions, batch_type):
+        for rows in partitions:
+            for i in range(0, len(rows), batch_size):
+                batch = BatchStatement(batch_type=batch_type)
+                batch_indexes = []
+                for row_indexes, params in rows[i:i + batch_size]:
+                    batch.add(stmt, params)
+                    batch_indexes.extend(row_indexes)
+                statements.append((batch, ()))
+                indexes.append(batch_indexes)
+
+    add_batches(play_by_channel.insert_stmt, by_channel.values(), BatchType.UNLOGGED)
+    add_batches(play_by_song.insert_stmt, by_song.values(), BatchType.UNLOGGED)
+
+    # Plays of the same song in the same bucket are added in a single update
+    add_batches(
+        song_count_by_hour.increment_stmt,
+        [
+            [
+                (song_indexes, (len(song_indexes), channel, hour) + song)
+                for song, song_indexes in bucket.items()
+            ]
+            for (channel, hour), bucket in song_counts.items()
+        ],
+        BatchType.COUNTER
+    )
+    add_batches(
+        song_count_by_bucket.increment_stmt,
+        [
+            [
+                (song_indexes, (len(song_indexes), channel, resolution, start) + song)
+                for song, song_indexes in bucket.items()
+            ]
+            for (channel, resolution, start), bucket in bucket_counts.items()
+        ],
+        BatchType.COUNTER
+    )
+    for song, song_indexes in songs.items():
+        statements.append((Song.insert_stmt, song))
+        indexes.append(song_indexes)
+    stored_songs = list(songs.keys())
+
+    results = execute_concurrent(
+        session, statements, concurrency=concurrency, raise_on_first_error=False
+    )
+
+    errors = {}
+    song_results = results[len(results) - len(stored_songs):]
+    for song, (success, _) in zip(stored_songs, song_results):
+        if success:
+            known_songs.add(song)
+
+    for (success, result), statement_indexes in zip(results, indexes):
+        if success:
+            continue
+        for index in statement_indexes:
+            errors[index] = str(result)
+    return errors
+
+
+def _sync_database():
+    logger.info("Synching Tables")
+    sync_table(Channel)
+    sync_table(Performer)
+    sync_table(Song)
+    sync_table(PlayByChannel)
+    sync_table(PlayBySong)
+    sync_table(SongCountByHour)
+    sync_table(SongSketchByHour)
+    sync_table(IdAllocation)
+    sync_table(IdByName)
+    sync_table(NameById)
+    sync_table(PlayByChannelId)
+    sync_table(PlayBySongId)
+    sync_table(SongCountByHourId)
+    sync_table(ChartByWeek)
+    sync_table(SongCountByBucket)
+    sync_table(SongCountByBucketId)
+
+    logger.info("Finished")
+
+
+def _recreate_keyspace():
+    logger.info("Dropping tables")
+    drop_table(Channel)
+    drop_table(Performer)
+    drop_table(Song)
+    drop_table(PlayByChannel)
+    drop_table(PlayBySong)
+    drop_table(SongCountByHour)
+    drop_table(SongSketchByHour)
+    drop_table(IdAllocation)
+    drop_table(IdByName)
+    drop_table(NameById)
+    drop_table(PlayByChannelId)
+    drop_table(PlayBySongId)
+    drop_table(SongCountByHourId)
+    drop_table(ChartByWeek)
+    drop_table(SongCountByBucket)
+    drop_table(SongCountByBucketId)
+    
+    known_songs.clear()
+    known_performers.clear()
+    with _id_blocks_lock:
+        _id_blocks.clear()
+    
+    _sync_database()
+
+
+def _backfill_song_counts(fetch_size=5000, concurrency=100):
+    """
+    Rebuild the hourly rollups, and the coarser ones of ROLLUP_RESOLUTIONS,
+    from the plays stored in play_by_channel, and with DICTIONARY_ENCODING
+    the dictionary encoded ones from the plays stored in play_by_channel_id.
+    """
+    _rebuild_rollups(
+        SongCountByHour, SongCountByBucket,
+        "SELECT channel, month, start, title, performer FROM play_by_channel_month",
+        lambda row: (row.channel, row.month),
+        lambda row: (row.title, row.performer),
+        fetch_size, concurrency
+    )
+    if db.config.get('DICTIONARY_ENCODING'):
+        _rebuild_rollups(
+            SongCountByHourId, SongCountByBucketId,
+            "SELECT channel_id, month, start, song_id FROM play_by_channel_id",
+            lambda row: (row.channel_id, row.month),
+            lambda row: (row.song_id, ),
+            fetch_size, concurrency
+        )
+
+    logger.info("Finished")
+
+
+def _rebuild_rollups(hour_table, bucket_table, select, partition_of, song_of,
+                     fetch_size, concurrency):
+    """
+    Recreate the rollup tables and count the plays of the select in them.
+    Rows of a partition are returned together, so counts are accumulated and
+    written one (channel, month) partition at a time. Counters are
+    incremented, so buckets spanning several month partitions add up.
+    """
+    resolutions = db.config.get('ROLLUP_RESOLUTIONS', ())
+    name = hour_table.column_family_name(include_keyspace=False)
+
+    logger.info("Truncating %s and the coarser rollups", name)
+    for table in (hour_table, bucket_table):
+        drop_table(table)
+        sync_table(table)
+        table._initialize_statements()
+
+    def flush(channel, channel_counts):
+        execute_concurrent_with_args(
+            session,
+            hour_table.increment_stmt,
+            [
+                (plays, channel, bucket) + song
+                for (resolution, bucket, song), plays in channel_counts.items()
+                if resolution == 'hour'
+            ],
+            concurrency=concurrency
+        )
+        execute_concurrent_with_args(
+            session,
+            bucket_table.increment_stmt,
+            [
+                (plays, channel, resolution, bucket) + song
+                for (resolution, bucket, song), plays in channel_counts.items()
+                if resolution != 'hour'
+            ],
+            concurrency=concurrency
+        )
+        logger.info("Backfilled %d buckets of %s for channel %s", len(channel_counts), name, channel)
+
+    partition = None
+    channel_counts = {}
+    for row in session.execute(SimpleStatement(select, fetch_size=fetch_size)):
+        if partition_of(row) != partition:
+            if channel_counts:
+                flush(partition[0], channel_counts)
+            partition = partition_of(row)
+            channel_counts = {}
+
+        song = song_of(row)
+        for resolution in ('hour', ) + tuple(resolutions):
+            key = (resolution, _bucket_start(resolution, row.start), song)
+            channel_counts[key] = channel_counts.get(key, 0) + 1
+
+    if channel_counts:
+        flush(partition[0], channel_counts)
+
+
+def _migrate_month_buckets(drop=False, fetch_size=5000, concurrency=100):
+    """
+    Copy the plays stored in the unbucketed play_by_channel and play_by_song
+    tables into their month partitioned counterparts.
+    """
+    _sync_database()
+
+    PlayByChannel._initialize_statements()
+    PlayBySong._initialize_statements()
+
+    migrations = (
+        (
+            'play_by_channel',
+            'SELECT channel, start, "end", title, performer FROM play_by_channel',
+            PlayByChannel.insert_stmt,
+            lambda row: (row.channel, _month_bucket(row.start), row.start,
+                         row.end, row.title, row.performer)
+        ),
+        (
+            'play_by_song',
+            'SELECT title, performer, start, "end", channel FROM play_by_song',
+            PlayBySong.insert_stmt,
+            lambda row: (row.title, row.performer, _month_bucket(row.start),
+                         row.start, row.end, row.channel)
+        ),
+    )
+
+    for table, select, insert_stmt, convert in migrations:
+        logger.info("Migrating %s", table)
+        rows = session.execute(SimpleStatement(select, fetch_size=fetch_size))
+
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(convert(row))
+            if len(batch) >= fetch_size:
+                execute_concurrent_with_args(session, insert_stmt, batch, concurrency=concurrency)
+                count += len(batch)
+                batch = []
+                logger.info("Migrated %d rows from %s", count, table)
+
+        if batch:
+            execute_concurrent_with_args(session, insert_stmt, batch, concurrency=concurrency)
+            count += len(batch)
+        logger.info("Migrated %d rows from %s", count, table)
+
+        if drop:
+            logger.info("Dropping %s", table)
+            session.execute('DROP TABLE %s' % table)
+
+    logger.info("Finished")
+
+
+def _encode_plays(dictionary, fetch_size=5000, concurrency=100):
+    """
+    Copy the plays stored in play_by_channel_month to the dictionary encoded
+    tables, allocating ids to their channels and songs, and with
+    SONG_COUNTS_FROM_ROLLUPS count them in the encoded rollups. The encoded tables are recreated first, so that
+    counts are not added twice.
+    """
+    logger.info("Truncating dictionary encoded tables")
+    for table in (PlayByChannelId, PlayBySongId, SongCountByHourId, SongCountByBucketId):
+        drop_table(table)
+        sync_table(table)
+
+    statement = SimpleStatement(
+        'SELECT channel, start, "end", title, performer FROM play_by_channel_month',
+        fetch_size=fetch_size
+    )
+
+    def flush(plays):
+        channel_ids = dictionary.ids(CHANNEL, [play.channel for play in plays], allocate=True)
+        song_ids = dictionary.ids(
+            SONG, [(play.title, play.performer) for play in plays], allocate=True
+        )
+        errors = save_plays(
+            list(enumerate(plays)), concurrency=concurrency,
+            channel_ids=channel_ids, song_ids=song_ids
+        )
+        for index, error in sorted(errors.items()):
+            logger.error("Could not encode play %r: %s", plays[index], error)
+        return len(plays) - len(errors)
+
+    count = 0
+    batch = []
+    for row in session.execute(statement):
+        batch.append(row)
+        if len(batch) >= fetch_size:
+            count += flush(batch)
+            batch = []
+            logger.info("Encoded %d plays", count)
+
+    if batch:
+        count += flush(batch)
+    logger.info("Encoded %d plays", count)
+    logger.info("Finished")
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Blueprint, current_app, request
+
+"""
+Request profiling
+
+A fraction of the requests (PROFILE_SAMPLE_RATE), and every request slower
+than PROFILE_SLOW_THRESHOLD seconds, is profiled and dumped per endpoint to
+PROFILE_DIR. With PROFILE_MODE 'cprofile' dumps are pstats files (.prof).
+With 'sample' the stacks of the request thread are sampled every
+PROFILE_INTERVAL seconds by a background thread and dumped as collapsed
+stacks (.folded), one 'frame;frame;frame count' line per stack.
+
+cProfile slows down the code it profiles, so with a slow threshold in
+'cprofile' mode every request pays for it. Sampling costs little enough to
+watch every request for slow ones.
+"""
+
+logger = logging.getLogger()
+
+profiler = Blueprint('profiler', __name__)
+
+_local = threading.local()
+_sampler = None
+_sequence = [0]
+_lock = threading.Lock()
+
+
+class Sampler(object):
+    """
+    Samples the stacks of the registered threads every interval seconds, and
+    counts them in collapsed form
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # thread id -> Counter of collapsed stacks
+        self._threads = {}
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._run, name='profile-sampler')
+        thread.daemon = True
+        thread.start()
+
+    def start(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] = Counter()
+
+    def stop(self, thread_id):
+        with self._lock:
+            return self._threads.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._threads:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_collapse(frame)] += 1
+
+
+def _collapse(frame):
+    """Stack of a frame from the outermost call, as 'file:function' names"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (_short_path(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _short_path(path):
+    parts = path.replace('\\', '/').split('/')
+    return '/'.join(parts[-2:])
+
+
+@profiler.before_app_request
+def start_profile():
+    config = current_app.config
+    mode = config.get('PROFILE_MODE', 'cprofile')
+    sampled = random.random() < config.get('PROFILE_SAMPLE_RATE', 0)
+    if not sampled and config.get('PROFILE_SLOW_THRESHOLD') is None:
+        _local.profile = None
+        return
+
+    _local.profile = (mode, sampled, time.time())
+    if mode == 'sample':
+        _get_sampler(config).start(threading.current_thread().ident)
+    else:
+        _local.cprofile = cProfile.Profile()
+        _local.cprofile.enable()
+
+
+@profiler.after_app_request
+def end_profile(response):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return response
+    _local.profile = None
+
+    mode, sampled, start = profile
+    if mode == 'sample':
+        stacks = _get_sampler(current_app.config).stop(threading.current_thread().ident)
+    else:
+        _local.cprofile.disable()
+
+    elapsed = time.time() - start
+    threshold = current_app.config.get('PROFILE_SLOW_THRESHOLD')
+    if not sampled and elapsed < threshold:
+        return response
+
+    endpoint = (request.endpoint or 'none').rsplit('.', 1)[-1]
+    try:
+        if mode == 'sample':
+            path = _dump_path(endpoint, 'folded')
+            with open(path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write('%s %d\n' % (stack, count))
+        else:
+            path = _dump_path(endpoint, 'prof')
+            _local.cprofile.dump_stats(path)
+        logger.info("Profiled %s in %.1f ms: %s", endpoint, 1000 * elapsed, path)
+    except (IOError, OSError):
+        logger.exception("Could not dump the profile of %s", endpoint)
+    finally:
+        _local.cprofile = None
+
+    return response
+
+
+def _get_sampler(config):
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = Sampler(config.get('PROFILE_INTERVAL', 0.005))
+    return _sampler
+
+
+def _dump_path(endpoint, extension):
+    directory = current_app.config.get('PROFILE_DIR', 'profiles')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with _lock:
+        _sequence[0] += 1
+        sequence = _sequence[0]
+    return os.path.join(directory, '%s-%s-%d-%d.%s' % (
+        endpoint, time.strftime('%Y%m%d%H%M%S'), os.getpid(), sequence, extension
+    ))
+
+
+def summarize(directory, endpoint=None, limit=20, sort='cumulative'):
+    """
+    Print the top functions of the profiles dumped in a directory, optionally
+    only those of an endpoint. pstats dumps are merged and sorted by sort,
+    collapsed stacks are sorted by the share of samples where a function is
+    running (self), shown with the share where it is on the stack (total).
+    """
+    import pstats
+
+    prof = []
+    folded = []
+    for name in sorted(os.listdir(directory)):
+        if endpoint and not name.startswith(endpoint + '-'):
+            continue
+        path = os.path.join(directory, name)
+        if name.endswith('.prof'):
+            prof.append(path)
+        elif name.endswith('.folded'):
+            folded.append(path)
+
+    if prof:
+        print('%d pstats profiles' % len(prof))
+        stats = pstats.Stats(*prof)
+        stats.sort_stats(sort).print_stats(limit)
+
+    if folded:
+        own = Counter()
+        total = Counter()
+        samples = 0
+        for path in folded:
+            with open(path) as f:
+                for line in f:
+                    stack, count = line.rsplit(' ', 1)
+                    count = int(count)
+                    frames = stack.split(';')
+                    samples += count
+                    own[frames[-1]] += count
+                    for frame in set(frames):
+                        total[frame] += count
+
+        print('%d sampled profiles, %d samples' % (len(folded), samples))
+        print('%8s %8s  %s' % ('self %', 'total %', 'function'))
+        for frame, count in own.most_common(limit):
+            print('%8.1f %8.1f  %s' % (
+                100.0 * count / samples, 100.0 * total[frame] / samples, frame
+            ))
+
+    if not prof and not folded:
+        print('No profiles found in %s' % directory)
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from datetime import timedelta
-from marshmallow import fields, post_load
+from marshmallow import fields, post_load, utils, validate
 
 from . import ma
 from .models import Channel, Performer, Song, PlayByChannel, PlayBySong
+from .topk import ALGORITHMS
 
 class PlaysBaseSchema(ma.Schema):
     
@@ -70,6 +71,11 @@ class GetRequestSchema(ma.Schema):
     start = fields.DateTime(required=True)
     end = fields.DateTime()
     limit = fields.Integer()
+    algorithm = fields.Str(validate=validate.OneOf(sorted(ALGORITHMS.keys())))
+    page_size = fields.Integer(validate=validate.Range(min=1, max=10000))
+    cursor = fields.Str()
+    stream = fields.Str(validate=validate.OneOf(['json', 'ndjson']))
+    approximate = fields.Boolean()
     
     @post_load
     def make(self, data):
@@ -90,7 +96,8 @@ class GetRequestSchema(ma.Schema):
         return super(GetRequestSchema, self).load(data=data, many=many, partial=partial)
     
     class Meta:
-        fields = ('title', 'performer', 'channel', 'start', 'end', 'limit')
+        fields = ('title', 'performer', 'channel', 'start', 'end', 'limit', 'algorithm',
+                  'page_size', 'cursor', 'stream', 'approximate')
 
 
 class ChannelsParameterSchema(ma.Schema):
@@ -105,10 +112,51 @@ class ChannelsParameterSchema(ma.Schema):
     
 
 
+class RowSerializer(object):
+    """
+    Fast path alternative to a schema's dump for the rows returned by the
+    driver. Rows are read by position, so columns must list the selected
+    columns in order (the schema's fields by default). Produces the same
+    dictionaries as the schema without Marshmallow's per field overhead.
+    """
+    def __init__(self, schema, columns=None):
+        self.columns = tuple(columns or schema.Meta.fields)
+        self.datetimes = [
+            (i, name) for i, name in enumerate(self.columns)
+            if isinstance(schema.fields[name], fields.DateTime)
+        ]
+
+    def dump(self, row):
+        data = dict(zip(self.columns, row))
+        for i, name in self.datetimes:
+            data[name] = _isoformat(row[i])
+        return data
+
+
+def _isoformat(dt):
+    """Same output as the DateTime field. Naive datetimes are in UTC"""
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        return dt.isoformat() + '+00:00'
+    return utils.isoformat(dt)
+
+
 channel_schema = ChannelSchema()
 performer_schema = PerformerSchema()
 song_schema = SongSchema()
 play_by_channel_schema = PlayByChannelSchema()
 play_by_song_schema = PlayBySongSchema()
 request_schema = GetRequestSchema()
-channels_param_schema = ChannelsParameterSchema()
\ No newline at end of file
+channels_param_schema = ChannelsParameterSchema()
+
+# Columns in the order selected by PlayByChannel.plays_stmt and
+# PlayBySong.plays_stmt
+play_by_channel_serializer = RowSerializer(
+    play_by_channel_schema,
+    ('channel', 'start', 'end', 'title', 'performer')
+)
+play_by_song_serializer = RowSerializer(
+    play_by_song_schema,
+    ('title', 'performer', 'start', 'end', 'channel')
+)
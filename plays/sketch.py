@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+import atexit
+import heapq
+import json
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from .cache import LRUCache, _naive_utc
+
+logger = logging.getLogger()
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving sketch of the heavy hitters of a stream, from paper:
+    Efficient Computation of Frequent and Top-k Elements in Data Streams
+    by A.Metwally, D.Agrawal and A.El Abbadi
+
+    At most capacity items are monitored, each with a count and the maximum
+    overestimation of that count: the true count of an item lies in
+    [count - error, count]. Items that are not monitored have a true count of
+    at most bound().
+    """
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Upper bound of the count of the unmonitored items while the sketch
+        # is not full. Only merged sketches have a floor above 0
+        self.floor = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, item, count=1):
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+            return
+
+        if len(counts) < self.capacity:
+            bound = self.floor
+        else:
+            # Replace the item with the minimum count
+            evicted = min(counts, key=counts.get)
+            bound = counts.pop(evicted)
+            del self.errors[evicted]
+        counts[item] = bound + count
+        self.errors[item] = bound
+
+    def bound(self):
+        if len(self.counts) < self.capacity:
+            return self.floor
+        return min(self.counts.values())
+
+    def top(self, k):
+        """The k items with the highest counts as (item, count, error)"""
+        items = heapq.nlargest(k, self.counts, key=self.counts.get)
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+    def dumps(self):
+        return json.dumps({
+            'capacity': self.capacity,
+            'floor': self.floor,
+            'items': [
+                list(item) + [count, self.errors[item]]
+                for item, count in self.counts.items()
+            ]
+        })
+
+    @staticmethod
+    def loads(s):
+        d = json.loads(s)
+        sketch = SpaceSaving(d['capacity'])
+        sketch.floor = d['floor']
+        for entry in d['items']:
+            item = tuple(entry[:-2])
+            sketch.counts[item] = entry[-2]
+            sketch.errors[item] = entry[-1]
+        return sketch
+
+
+def merge(sketches, capacity):
+    """
+    Merge Space-Saving sketches of disjoint streams, as described in paper:
+    Mergeable Summaries
+    by P.K.Agarwal, G.Cormode, Z.Huang, J.Phillips, Z.Wei and K.Yi
+
+    An item missing from a sketch is counted with the bound of that sketch,
+    both in its count and its error. The capacity items with the highest
+    counts are kept.
+    """
+    base = 0
+    counts = {}
+    errors = {}
+    for sketch in sketches:
+        bound = sketch.bound()
+        base += bound
+        for item, count in sketch.counts.items():
+            counts[item] = counts.get(item, 0) + count - bound
+            errors[item] = errors.get(item, 0) + sketch.errors[item] - bound
+
+    result = SpaceSaving(capacity)
+    result.floor = base
+    kept = heapq.nlargest(capacity, counts, key=counts.get)
+    if len(kept) < len(counts):
+        # Dropped items are now unmonitored
+        result.floor = base + min(counts[item] for item in kept)
+    for item in kept:
+        result.counts[item] = counts[item] + base
+        result.errors[item] = errors[item] + base
+    return result
+
+
+class SketchStore(object):
+    """
+    Space-Saving sketches of the songs played per channel and hour.
+
+    Plays are added to in-memory sketches of the plays not stored yet, which
+    flush() stores as new sketches of the (channel, hour), so that several
+    processes can add plays to the same hour. Sketches that could not be
+    stored are kept, still counted, and stored again by the next flush under
+    the same id. The stored sketches of an hour are merged when it is queried
+    and the result is cached, together with the plays added by this process
+    since then, for cache_ttl seconds.
+
+    The storage overwrites a play posted again with the same channel and
+    start, so the sketches skip a play when it was already added with the
+    same song among the last dedup_size plays of this process. Re-posts
+    beyond that, to another process, or with another song are counted again.
+    """
+    def __init__(self, storage, capacity=200, cache_size=10000, cache_ttl=60,
+                 dedup_size=100000):
+        self.storage = storage
+        self.capacity = capacity
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        # (channel, start) -> song of the plays added recently
+        self._added = LRUCache(maxsize=dedup_size)
+        # (channel, hour) -> sketch of the plays not flushed yet
+        self._pending = {}
+        # (channel, hour) -> {id: sketch} of the flushed sketches not stored yet
+        self._unstored = {}
+        # Incremented whenever pending sketches are moved to _unstored or
+        # dropped, so that get() knows when to read the stored ones again
+        self._flushes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add(self, channel, start, song):
+        start = _naive_utc(start)
+        key = (channel, _hour(start))
+        with self._lock:
+            if self._added.get((channel, start)) == song:
+                return
+            self._added.set((channel, start), song)
+
+            sketch = self._pending.get(key)
+            if sketch is None:
+                sketch = self._pending[key] = SpaceSaving(self.capacity)
+            sketch.add(song)
+
+            merged = self.cache.get(key)
+            if merged is not None:
+                merged.add(song)
+
+    def get(self, channels, start, end):
+        """
+        Merged sketch of the channels in the window, rounded to the hours that
+        overlap with it
+        """
+        keys = []
+        hour = _hour(start)
+        last = _hour(end)
+        while hour <= last:
+            keys.extend((channel, hour) for channel in set(channels))
+            hour += timedelta(hours=1)
+
+        hours = {}
+        missing = []
+        for key in keys:
+            merged = self.cache.get(key)
+            if merged is None:
+                missing.append(key)
+            else:
+                hours[key] = merged
+
+        while missing:
+            with self._lock:
+                flushes = self._flushes
+                unstored = dict((key, dict(self._unstored.get(key, {}))) for key in missing)
+
+            # Read without the lock. A flushed sketch is either stored by now
+            # or still in unstored, and both are merged by id. Plays flushed
+            # during the read would be in neither, so the read is done again.
+            stored = self.storage.get_sketches(missing)
+            loaded = dict(
+                (key, dict((id_, SpaceSaving.loads(s)) for id_, s in sketches.items()))
+                for key, sketches in stored.items()
+            )
+
+            with self._lock:
+                if self._flushes != flushes:
+                    continue
+                for key in missing:
+                    sketches = loaded.get(key, {})
+                    sketches.update(unstored[key])
+                    sketches = list(sketches.values())
+                    if key in self._pending:
+                        sketches.append(self._pending[key])
+                    merged = merge(sketches, self.capacity)
+                    self.cache.set(key, merged)
+                    hours[key] = merged
+                missing = []
+
+        # add() updates the cached sketches in place
+        with self._lock:
+            return merge(
+                [sketch for sketch in hours.values() if len(sketch)],
+                self.capacity
+            )
+
+    def flush(self):
+        """
+        Store the sketches of the plays added since the last flush, and those
+        that previous flushes could not store
+        """
+        with self._lock:
+            for key, sketch in self._pending.items():
+                self._unstored.setdefault(key, {})[uuid.uuid1()] = sketch
+            if self._pending:
+                self._pending = {}
+                self._flushes += 1
+            sketches = [
+                (channel, hour, id_, sketch)
+                for (channel, hour), unstored in self._unstored.items()
+                for id_, sketch in unstored.items()
+            ]
+        if not sketches:
+            return
+
+        logger.info("Storing %d song sketches", len(sketches))
+        self.storage.add_sketches([
+            (channel, hour, id_, sketch.dumps())
+            for channel, hour, id_, sketch in sketches
+        ])
+
+        with self._lock:
+            for channel, hour, id_, _ in sketches:
+                unstored = self._unstored.get((channel, hour), {})
+                unstored.pop(id_, None)
+                if not unstored:
+                    self._unstored.pop((channel, hour), None)
+
+    def start(self, interval):
+        """Flush every interval seconds in a background thread and at exit"""
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Could not store the song sketches")
+
+        thread = threading.Thread(target=run, name='sketch-flush')
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+            self._unstored = {}
+            self._flushes += 1
+            self._added.clear()
+            self.cache.clear()
+
+
+def _hour(dt):
+    return _naive_utc(dt).replace(minute=0, second=0, microsecond=0)
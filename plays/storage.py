@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+from collections import Counter, namedtuple
+
+from .cache import _naive_utc
+from .dictionary import CHANNEL, SONG, Dictionary, decode_rows
+from .models import (
+    Channel, Performer, Song, PlayByChannel, PlayBySong, SongSketchByHour,
+    ChartByWeek, PlayByChannelId, PlayBySongId, add_ids, get_ids, get_names, save_play,
+    save_plays, _collect_song_counts, _prepare_statements, _recreate_keyspace
+)
+
+"""
+Storage backends of the plays API
+
+Plays passed to the backends have channel, start, end, title and performer
+attributes. Range queries return rows with the columns in the order expected by
+the fast path serializers in schemas.py.
+
+With DICTIONARY_ENCODING, backends store and count channels and songs by the
+ids of their dictionary (see dictionary.py): song counts are keyed by song id
+and song_names translates them back.
+"""
+
+ChannelPlayRow = namedtuple('ChannelPlayRow', 'channel start end title performer')
+SongPlayRow = namedtuple('SongPlayRow', 'title performer start end channel')
+EncodedPlayRow = namedtuple('EncodedPlayRow', 'start end channel_id song_id')
+
+
+class Storage(object):
+    """Operations of the plays API on the underlying database"""
+
+    def add_channel(self, name):
+        raise NotImplementedError
+
+    def add_performer(self, name):
+        raise NotImplementedError
+
+    def add_song(self, title, performer):
+        """Store the song and make sure that its performer is stored"""
+        raise NotImplementedError
+
+    def add_play(self, play):
+        """Store the play and make sure that its song is stored"""
+        raise NotImplementedError
+
+    def add_plays(self, plays):
+        """
+        Store several plays given as (index, play) pairs. Returns a dictionary
+        with the error of every index that could not be stored.
+        """
+        raise NotImplementedError
+
+    def get_channel_plays(self, channel, start, end, after=None, limit=None):
+        """
+        Plays of a channel in [start, end], or in (after, end] when after is
+        given, ordered by start. At most limit plays are returned.
+        """
+        raise NotImplementedError
+
+    def get_song_plays(self, title, performer, start, end, after=None, limit=None):
+        """Same as get_channel_plays for the plays of a song"""
+        raise NotImplementedError
+
+    def get_channels(self):
+        """Names of the channels with plays"""
+        raise NotImplementedError
+
+    def get_song_counts(self, channels, windows):
+        """
+        Song counts for every (start, end) window as dictionaries of
+        {channel: {song: count}}, where songs are (title, performer) tuples
+        or their ids with dictionary encoding. Channels without plays are
+        left out.
+        """
+        raise NotImplementedError
+
+    def song_names(self, songs):
+        """(title, performer) of the songs of get_song_counts, as {song: name}"""
+        raise NotImplementedError
+
+    def add_chart(self, name, week, chart):
+        """
+        Store the serialized chart of a group of channels for a week, unless
+        a chart of the week is stored already. Returns the stored chart.
+        """
+        raise NotImplementedError
+
+    def get_chart(self, name, week):
+        """Serialized chart of a group of channels for a week, None if not stored"""
+        raise NotImplementedError
+
+    def get_ids(self, kind, names):
+        """Dictionary ids of the names of a kind that have one, as {name: id}"""
+        raise NotImplementedError
+
+    def add_ids(self, kind, names):
+        """Allocate dictionary ids to names of a kind, as {name: id}"""
+        raise NotImplementedError
+
+    def get_names(self, kind, ids):
+        """Names of dictionary ids of a kind, as {id: name}"""
+        raise NotImplementedError
+
+    def add_sketches(self, sketches):
+        """
+        Store the serialized song sketches of (channel, hour, id, sketch)
+        tuples. Storing a sketch again with the same id replaces it.
+        """
+        raise NotImplementedError
+
+    def get_sketches(self, keys):
+        """
+        Song sketches stored for every (channel, hour) key, as a dictionary of
+        {key: {id: sketch}}. Keys without sketches are left out.
+        """
+        raise NotImplementedError
+
+    def truncate(self):
+        raise NotImplementedError
+
+
+class CassandraStorage(Storage):
+    """Storage on the Cassandra cluster set up by init_db_blueprint"""
+
+    def __init__(self, config):
+        self.config = config
+        self.dictionary = Dictionary(self, config.get('DICTIONARY_CACHE_SIZE', 100000))
+        self.encoded = config.get('DICTIONARY_ENCODING', False)
+        _prepare_statements()
+
+    def add_channel(self, name):
+        Channel.insert(name)
+
+    def add_performer(self, name):
+        Performer.insert(name)
+
+    def add_song(self, title, performer):
+        Song.insert(title, performer)
+        Performer.ensure(performer)
+
+    def add_play(self, play):
+        if not self.encoded:
+            save_play(play)
+            return
+
+        song = (play.title, play.performer)
+        save_play(
+            play,
+            channel_id=self.dictionary.ids(CHANNEL, [play.channel], allocate=True)[play.channel],
+            song_id=self.dictionary.ids(SONG, [song], allocate=True)[song]
+        )
+
+    def add_plays(self, plays):
+        channel_ids = song_ids = None
+        if self.encoded:
+            channel_ids = self.dictionary.ids(
+                CHANNEL, [play.channel for _, play in plays], allocate=True
+            )
+            song_ids = self.dictionary.ids(
+                SONG, [(play.title, play.performer) for _, play in plays], allocate=True
+            )
+
+        return save_plays(
+            plays,
+            concurrency=self.config['ADD_PLAYS_CONCURRENCY'],
+            batch_size=self.config['ADD_PLAYS_BATCH_SIZE'],
+            channel_ids=channel_ids,
+            song_ids=song_ids
+        )
+
+    def get_channel_plays(self, channel, start, end, after=None, limit=None):
+        if not self.encoded:
+            return PlayByChannel.get_plays(channel, start, end, after=after, limit=limit)
+
+        channel_id = self.dictionary.ids(CHANNEL, [channel]).get(channel)
+        if channel_id is None:
+            return []
+        rows = PlayByChannelId.get_plays(channel_id, start, end, after=after, limit=limit)
+        return decode_rows(rows, _channel_plays_decoder(self.dictionary, channel))
+
+    def get_song_plays(self, title, performer, start, end, after=None, limit=None):
+        if not self.encoded:
+            return PlayBySong.get_plays(title, performer, start, end, after=after, limit=limit)
+
+        song_id = self.dictionary.ids(SONG, [(title, performer)]).get((title, performer))
+        if song_id is None:
+            return []
+        rows = PlayBySongId.get_plays(song_id, start, end, after=after, limit=limit)
+        return decode_rows(rows, _song_plays_decoder(self.dictionary, title, performer))
+
+    def get_channels(self):
+        if not self.encoded:
+            return PlayByChannel.get_channels()
+        return set(self.dictionary.names(CHANNEL, PlayByChannelId.get_channels()).values())
+
+    def get_song_counts(self, channels, windows):
+        futures, convert = self.song_counts_futures(channels, windows)
+        return convert([_collect_song_counts(window_futures) for window_futures in futures])
+
+    def song_counts_futures(self, channels, windows):
+        """
+        Launch the queries of get_song_counts without waiting for them.
+        Returns the (channel, source, future) lists of every window, and a
+        function converting the list of their merged counts to the result of
+        get_song_counts.
+        """
+        if not self.encoded:
+            return PlayByChannel.song_counts_windows_futures(channels, windows), lambda counts: counts
+
+        channel_ids = self.dictionary.ids(CHANNEL, channels)
+        channels_by_id = dict((id_, channel) for channel, id_ in channel_ids.items())
+
+        def convert(windows_counts):
+            return [
+                {channels_by_id[channel_id]: counts for channel_id, counts in window.items()}
+                for window in windows_counts
+            ]
+        return PlayByChannelId.song_counts_windows_futures(list(channels_by_id), windows), convert
+
+    def song_names(self, songs):
+        if not self.encoded:
+            return dict((song, song) for song in songs)
+        return self.dictionary.names(SONG, songs)
+
+    def get_ids(self, kind, names):
+        return get_ids(kind, names)
+
+    def add_ids(self, kind, names):
+        return add_ids(kind, names, self.config.get('DICTIONARY_ID_BLOCK_SIZE', 100))
+
+    def get_names(self, kind, ids):
+        return get_names(kind, ids)
+
+    def add_sketches(self, sketches):
+        SongSketchByHour.add_sketches(
+            sketches,
+            concurrency=self.config['ADD_PLAYS_CONCURRENCY']
+        )
+
+    def get_sketches(self, keys):
+        return SongSketchByHour.get_sketches(keys)
+
+    def add_chart(self, name, week, chart):
+        return ChartByWeek.insert(name, week, chart)
+
+    def get_chart(self, name, week):
+        return ChartByWeek.get(name, week)
+
+    def truncate(self):
+        _recreate_keyspace()
+        self.dictionary.clear()
+
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in process memory, for benchmarks and tests that should not
+    depend on a Cassandra cluster. Plays are kept sorted by start in per
+    channel and per song partitions and ranges are found by bisection. As in
+    Cassandra, a play overwrites the play of its partition with the same
+    start, and datetimes are stored as naive UTC.
+    """
+
+    def __init__(self, config=None):
+        self.config = config
+        self._lock = threading.Lock()
+        self.dictionary = Dictionary(self, (config or {}).get('DICTIONARY_CACHE_SIZE', 100000))
+        self.encoded = (config or {}).get('DICTIONARY_ENCODING', False)
+        self.truncate()
+
+    def add_channel(self, name):
+        with self._lock:
+            self.channels.add(name)
+
+    def add_performer(self, name):
+        with self._lock:
+            self.performers.add(name)
+
+    def add_song(self, title, performer):
+        with self._lock:
+            self.songs.add((title, performer))
+            self.performers.add(performer)
+
+    def add_play(self, play):
+        start = _naive_utc(play.start)
+        end = _naive_utc(play.end) if play.end is not None else None
+        song = (play.title, play.performer)
+
+        if self.encoded:
+            channel_id = self.dictionary.ids(CHANNEL, [play.channel], allocate=True)[play.channel]
+            song_id = self.dictionary.ids(SONG, [song], allocate=True)[song]
+            row = EncodedPlayRow(start, end, channel_id, song_id)
+            with self._lock:
+                _insert(self.plays_by_channel.setdefault(channel_id, _Partition()), row)
+                _insert(self.plays_by_song.setdefault(song_id, _Partition()), row)
+                self.songs.add(song)
+            return
+
+        with self._lock:
+            _insert(
+                self.plays_by_channel.setdefault(play.channel, _Partition()),
+                ChannelPlayRow(play.channel, start, end, play.title, play.performer)
+            )
+            _insert(
+                self.plays_by_song.setdefault(song, _Partition()),
+                SongPlayRow(play.title, play.performer, start, end, play.channel)
+            )
+            self.songs.add(song)
+
+    def add_plays(self, plays):
+        for _, play in plays:
+            self.add_play(play)
+        return {}
+
+    def get_channel_plays(self, channel, start, end, after=None, limit=None):
+        if self.encoded:
+            channel_id = self.dictionary.ids(CHANNEL, [channel]).get(channel)
+            with self._lock:
+                rows = _range(self.plays_by_channel.get(channel_id), start, end, after, limit)
+            return list(decode_rows(rows, _channel_plays_decoder(self.dictionary, channel)))
+
+        with self._lock:
+            partition = self.plays_by_channel.get(channel)
+            return _range(partition, start, end, after, limit)
+
+    def get_song_plays(self, title, performer, start, end, after=None, limit=None):
+        if self.encoded:
+            song_id = self.dictionary.ids(SONG, [(title, performer)]).get((title, performer))
+            with self._lock:
+                rows = _range(self.plays_by_song.get(song_id), start, end, after, limit)
+            return list(decode_rows(rows, _song_plays_decoder(self.dictionary, title, performer)))
+
+        with self._lock:
+            partition = self.plays_by_song.get((title, performer))
+            return _range(partition, start, end, after, limit)
+
+    def get_channels(self):
+        with self._lock:
+            channels = list(self.plays_by_channel)
+        if not self.encoded:
+            return set(channels)
+        return set(self.dictionary.names(CHANNEL, channels).values())
+
+    def get_song_counts(self, channels, windows):
+        channel_ids = {}
+        if self.encoded:
+            channel_ids = self.dictionary.ids(CHANNEL, channels)
+
+        results = []
+        for start, end in windows:
+            counts = {}
+            for channel in channels:
+                if not self.encoded:
+                    rows = self.get_channel_plays(channel, start, end)
+                    songs = ((row.title, row.performer) for row in rows)
+                else:
+                    with self._lock:
+                        rows = _range(
+                            self.plays_by_channel.get(channel_ids.get(channel)), start, end
+                        )
+                    songs = (row.song_id for row in rows)
+                if rows:
+                    counts[channel] = dict(Counter(songs))
+            results.append(counts)
+        return results
+
+    def song_names(self, songs):
+        if not self.encoded:
+            return dict((song, song) for song in songs)
+        return self.dictionary.names(SONG, songs)
+
+    def get_ids(self, kind, names):
+        with self._lock:
+            ids = self.ids.get(kind, {})
+            return dict((name, ids[name]) for name in names if name in ids)
+
+    def add_ids(self, kind, names):
+        with self._lock:
+            ids = self.ids.setdefault(kind, {})
+            names_by_id = self.names.setdefault(kind, {})
+            for name in names:
+                if name not in ids:
+                    ids[name] = len(ids) + 1
+                    names_by_id[ids[name]] = name
+            return dict((name, ids[name]) for name in names)
+
+    def get_names(self, kind, ids):
+        with self._lock:
+            names = self.names.get(kind, {})
+            return dict((id_, names[id_]) for id_ in ids if id_ in names)
+
+    def add_sketches(self, sketches):
+        with self._lock:
+            for channel, hour, id_, sketch in sketches:
+                self.sketches.setdefault((channel, hour), {})[id_] = sketch
+
+    def get_sketches(self, keys):
+        with self._lock:
+            return {
+                key: dict(self.sketches[key])
+                for key in keys if key in self.sketches
+            }
+
+    def add_chart(self, name, week, chart):
+        with self._lock:
+            return self.charts.setdefault((name, week), chart)
+
+    def get_chart(self, name, week):
+        with self._lock:
+            return self.charts.get((name, week))
+
+    def truncate(self):
+        with self._lock:
+            self.channels = set()
+            self.performers = set()
+            self.songs = set()
+            self.plays_by_channel = {}
+            self.plays_by_song = {}
+            self.sketches = {}
+            self.charts = {}
+            # kind -> {name: id} and kind -> {id: name}
+            self.ids = {}
+            self.names = {}
+        self.dictionary.clear()
+
+
+class _Partition(object):
+    """Rows sorted by start, with the starts in a parallel list for bisect"""
+    def __init__(self):
+        self.starts = []
+        self.rows = []
+
+
+def _insert(partition, row):
+    i = bisect.bisect_left(partition.starts, row.start)
+    if i < len(partition.starts) and partition.starts[i] == row.start:
+        partition.rows[i] = row
+    else:
+        partition.starts.insert(i, row.start)
+        partition.rows.insert(i, row)
+
+
+def _range(partition, start, end, after=None, limit=None):
+    if partition is None:
+        return []
+
+    if after is not None:
+        lo = bisect.bisect_right(partition.starts, _naive_utc(after))
+    else:
+        lo = bisect.bisect_left(partition.starts, _naive_utc(start))
+    hi = bisect.bisect_right(partition.starts, _naive_utc(end))
+
+    if limit is not None:
+        hi = min(hi, lo + limit)
+    return partition.rows[lo:hi]
+
+
+def _channel_plays_decoder(dictionary, channel):
+    """Converter of the encoded plays of a channel for decode_rows"""
+    def decode(rows):
+        songs = dictionary.names(SONG, [row.song_id for row in rows])
+        return [
+            ChannelPlayRow(channel, row.start, row.end, *songs[row.song_id])
+            for row in rows
+        ]
+    return decode
+
+
+def _song_plays_decoder(dictionary, title, performer):
+    """Converter of the encoded plays of a song for decode_rows"""
+    def decode(rows):
+        channels = dictionary.names(CHANNEL, [row.channel_id for row in rows])
+        return [
+            SongPlayRow(title, performer, row.start, row.end, channels[row.channel_id])
+            for row in rows
+        ]
+    return decode
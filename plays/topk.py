@@ -1,109 +1,444 @@
 # -*- coding: utf-8 -*-
-from collections import defaultdict
+import heapq
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
 Best Position Algorithms for Top-k queries
 
-All algorithms expect a database m consisting of a dictionary of items with 
-scores. 
+All algorithms expect a database m consisting of a dictionary of items with
+scores.
 
 E.g.
 m = {
     "list1": {"item1": 10, "item2": 6, "item3": 3},
     "list2": {"item4": 15, "item1": 2},
 }
+
+The overall score of an item is the sum of its scores in every list. Items not
+present in a list score 0 in that list.
+
+Every algorithm accepts an optional stats dictionary that is filled with the
+number of sorted and random accesses performed.
+
+Lists are sorted lazily, only down to the depth read by the algorithm, and
+items are only tracked once they have been read.
+
+The exact algorithm reads every list entirely instead, which is faster than the
+threshold algorithms when a large part of the lists would be read anyway.
 """
 
-def fa(m, k):
+def fa(m, k, stats=None):
     """
-    Fagin's Algorithm from paper: 
+    Fagin's Algorithm from paper:
     Combining fuzzy information from multiple systems
     by R.Fagin
     """
-    
+
     sorted_lists = _get_sorted_lists(m)
-    
-    def item_dict():
-        return {
-            'score': 0,
-            'lists': []
-        }
-    
+    stats = _init_stats(stats)
+    if not sorted_lists or k <= 0:
+        return []
+
     # Sorted access
     # Access in parallel to each of the sorted lists
-    # Maintain each seen item in a set until there are at least k data items
-    # that have been seen in all lists
-    items = defaultdict(item_dict)
-    
+    # Maintain each seen item with its partial score and the bitmask of the
+    # lists where it has been seen until there are at least k data items that
+    # have been seen in all lists. Items are interned to consecutive ids
+    ids = {}
+    keys = []
+    scores = []
+    masks = []
+
     i = 0
+    depth = 0
     common_items = 0
-    list_count = len(sorted_lists)
-    max_list_size = max([len(l) for l in sorted_lists.values()])
-    
-    stop = False
-    while not stop:
-        for l_key, l_value in sorted_lists.items():
-            if i < len(l_value):
-                item, score  = l_value[i]
-                items[item]['score'] += score
-                items[item]['lists'].append(l_key)
-                 
-                if len(items[item]['lists']) == list_count:
-                    common_items += 1
-                
+    sorted_accesses = 0
+    all_lists = (1 << len(sorted_lists)) - 1
+    max_list_size = max([len(l) for l in sorted_lists])
+
+    while i < max_list_size and common_items < k:
+        if i >= depth:
+            depth = max(2 * depth, 16)
+            heads = [l_value.head(depth) for l_value in sorted_lists]
+
+        for j, (l_items, l_scores) in enumerate(heads):
+            if i >= len(l_items):
+                continue
+
+            item = l_items[i]
+            sorted_accesses += 1
+            n = ids.get(item)
+            if n is None:
+                n = ids[item] = len(keys)
+                keys.append(item)
+                scores.append(l_scores[i])
+                masks.append(1 << j)
+            else:
+                scores[n] += l_scores[i]
+                masks[n] |= 1 << j
+
+            if masks[n] == all_lists:
+                common_items += 1
+
         i += 1
-        if common_items >= k or i >= max_list_size:
-            stop = True
-    
+
     # Random Access
-    # For each data item in s, do a random access to all the lists wher it has
-    # not been seen, and update the score
-    for key, value in items.items():
-        if len(value['lists']) == list_count:
-            continue
-    
-        unvisited_lists = set(sorted_lists.keys()).difference(set(value['lists']))
-        for unvisited in unvisited_lists:
-            # Update score if item is present in the unvisited list
-            if key in m[unvisited]:
-                items[key]['score'] += m[unvisited][key]
-    
-    
-    # Sort by descending and slice top k
-    top_k_items = [(key, value['score']) for key, value in items.items()]
-    top_k_items = sorted(top_k_items, key=lambda x: -x[1])
-    return top_k_items[:k]
+    # For each data item in s, do a random access to all the lists where it
+    # has not been seen, and update the score
+    random_accesses = 0
+    partial = [n for n, mask in enumerate(masks) if mask != all_lists]
+    for j, l_value in enumerate(sorted_lists):
+        bit = 1 << j
+        get = l_value.scores.get
+        for n in partial:
+            if not masks[n] & bit:
+                # Update score if item is present in the unvisited list
+                random_accesses += 1
+                scores[n] += get(keys[n], 0)
+
+    stats['sorted_accesses'] = sorted_accesses
+    stats['random_accesses'] = random_accesses
+
+    # Select the top k by descending score
+    top = heapq.nlargest(k, range(len(keys)), key=scores.__getitem__)
+    return [(keys[n], scores[n]) for n in top]
+
+
+def ta(m, k, stats=None):
+    """
+    Threshold Algorithm from paper:
+    Optimal aggregation algorithms for middleware
+    by R.Fagin, A.Lotem and M.Naor
+    """
+    sorted_lists = _get_sorted_lists(m)
+    stats = _init_stats(stats)
+    if not sorted_lists or k <= 0:
+        return []
+
+    top = []
+    seen = set()
+
+    i = 0
+    max_list_size = max([len(l) for l in sorted_lists])
+
+    while i < max_list_size:
+        # Sorted access in parallel to each list. For every new item, do a
+        # random access to the other lists to get its overall score
+        threshold = 0
+        for j, l_value in enumerate(sorted_lists):
+            if i >= len(l_value):
+                continue
+
+            item, score = l_value[i]
+            stats['sorted_accesses'] += 1
+            threshold += score
+
+            if item in seen:
+                continue
+            seen.add(item)
+
+            score += _random_access(sorted_lists, item, j, stats)
+            _push(top, k, item, score)
+
+        i += 1
+
+        # Stop when k items have an overall score at least equal to the
+        # threshold: the sum of the last scores seen under sorted access
+        if len(top) == k and top[0][0] >= threshold:
+            break
+
+    return _sorted_top(top)
+
+
+def bpa(m, k, stats=None):
+    """
+    Best Position Algorithm from paper:
+    Best Position Algorithms for Top-k Queries
+    by R.Akbarinia, E.Pacitti and P.Valduriez
+    """
+    sorted_lists = _get_sorted_lists(m)
+    stats = _init_stats(stats)
+    if not sorted_lists or k <= 0:
+        return []
+
+    tracker = _BestPositions(sorted_lists)
+    top = []
+    seen = set()
+
+    i = 0
+    max_list_size = max([len(l) for l in sorted_lists])
+
+    while i < max_list_size:
+        # Sorted access in parallel to each list. Positions of the items seen
+        # under random access also count for the best positions
+        for j, l_value in enumerate(sorted_lists):
+            if i >= len(l_value):
+                continue
+
+            item, score = l_value[i]
+            stats['sorted_accesses'] += 1
+
+            if item in seen:
+                continue
+            seen.add(item)
+
+            tracker.mark(j, item)
+            score += _random_access_positions(
+                sorted_lists, tracker, item, j, stats
+            )
+            _push(top, k, item, score)
+
+        i += 1
 
+        # Stop when k items have an overall score at least equal to the
+        # threshold: the sum of the scores at the best positions
+        if len(top) == k and top[0][0] >= tracker.threshold():
+            break
 
-def ta(m, k):
+    return _sorted_top(top)
+
+
+def bpa2(m, k, stats=None):
     """
-    Threshold Algorithm
+    Best Position Algorithm Optimization (BPA2) from paper:
+    Best Position Algorithms for Top-k Queries
+    by R.Akbarinia, E.Pacitti and P.Valduriez
+
+    Instead of reading the lists sequentially, each round directly accesses
+    the first position after the best position of every list. Every position
+    is therefore accessed at most once.
     """
-    raise NotImplementedError
+    sorted_lists = _get_sorted_lists(m)
+    stats = _init_stats(stats)
+    if not sorted_lists or k <= 0:
+        return []
+
+    tracker = _BestPositions(sorted_lists)
+    top = []
+
+    while not tracker.exhausted():
+        for j, l_value in enumerate(sorted_lists):
+            # Direct access to the position next to the best position
+            i = tracker.next_position(j)
+            if i >= len(l_value):
+                continue
 
+            item, score = l_value[i]
+            stats['sorted_accesses'] += 1
 
-def bpa(m, k):
+            tracker.mark(j, item)
+            score += _random_access_positions(
+                sorted_lists, tracker, item, j, stats
+            )
+            _push(top, k, item, score)
+
+        if len(top) == k and top[0][0] >= tracker.threshold():
+            break
+
+    return _sorted_top(top)
+
+
+def exact(m, k, stats=None):
     """
-    Best Position Algorithm
+    Sums the scores of every item in all the lists and selects the top k.
+
+    With NumPy, items are interned to column ids of a sparse list x item score
+    matrix, whose columns are summed with bincount and partially sorted with
+    argpartition. Every score is read once, under sorted access.
     """
-    raise NotImplementedError
+    stats = _init_stats(stats)
+    if k <= 0:
+        return []
+
+    if numpy is None:
+        scores = Counter()
+        for l_value in m.values():
+            stats['sorted_accesses'] += len(l_value)
+            scores.update(l_value)
+        return heapq.nlargest(k, scores.items(), key=lambda x: x[1])
 
+    ids = {}
+    columns = []
+    values = []
+    for l_value in m.values():
+        columns.extend(ids.setdefault(item, len(ids)) for item in l_value)
+        values.extend(l_value.values())
+    stats['sorted_accesses'] = len(values)
+    if not ids:
+        return []
 
-def bpa2(m, k):
+    values = numpy.array(values)
+    totals = numpy.bincount(columns, weights=values, minlength=len(ids))
+    if values.dtype.kind in 'iu':
+        totals = totals.astype(values.dtype)
+
+    if k < len(totals):
+        top = numpy.argpartition(-totals, k - 1)[:k]
+    else:
+        top = numpy.arange(len(totals))
+    top = top[numpy.argsort(-totals[top], kind='mergesort')]
+
+    keys = [None] * len(ids)
+    for item, n in ids.items():
+        keys[n] = item
+    return [(keys[n], totals[n].item()) for n in top]
+
+
+ALGORITHMS = {
+    'fa': fa,
+    'ta': ta,
+    'bpa': bpa,
+    'bpa2': bpa2,
+    'exact': exact,
+}
+
+
+class _SortedList(object):
     """
-    Best Position Algorithm Optimization
+    Items of a list by descending score. The list is heapified on creation
+    and items are popped from the heap as positions are accessed, so sorting
+    costs grow with the depth read instead of with the length of the list.
+    Once the depth read is a large part of the list, the rest is sorted at
+    once, which is faster than popping it item by item.
     """
-    raise NotImplementedError
+    def __init__(self, scores):
+        # Original {item: score} dictionary, for random access
+        self.scores = scores
+        # The insertion order breaks ties so that items are never compared
+        self._heap = [
+            (-score, i, item) for i, (item, score) in enumerate(scores.items())
+        ]
+        heapq.heapify(self._heap)
+        self._items = []
+        self._values = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, position):
+        if position >= len(self._items):
+            if position >= len(self.scores):
+                raise IndexError(position)
+            self._extract(position + 1)
+        return self._items[position], self._values[position]
+
+    def head(self, depth):
+        """Items and scores of at least the first depth positions"""
+        if depth > len(self._items):
+            self._extract(depth)
+        return self._items, self._values
+
+    def _extract(self, depth):
+        # Extract at least twice the depth read so far
+        heap = self._heap
+        count = min(max(depth, 2 * len(self._items), 16) - len(self._items), len(heap))
+        if count >= len(heap) // 4:
+            extracted = sorted(heap)
+            del heap[:]
+        else:
+            extracted = [heapq.heappop(heap) for _ in range(count)]
+
+        for score, _, item in extracted:
+            self._items.append(item)
+            self._values.append(-score)
+
+
+class _BestPositions(object):
+    """
+    Keeps track of the items seen in every list, as a bitmask of lists per
+    item. The best position of a list is the greatest seen position such that
+    every position above it has also been seen.
+    """
+    def __init__(self, sorted_lists):
+        self.sorted_lists = sorted_lists
+        self.masks = {}
+        # Number of positions seen from the top of every list without gaps
+        self.best = [0] * len(sorted_lists)
+
+    def mark(self, j, item):
+        self.masks[item] = self.masks.get(item, 0) | 1 << j
+
+        l_value = self.sorted_lists[j]
+        best = self.best[j]
+        while best < len(l_value) and self.masks.get(l_value[best][0], 0) & 1 << j:
+            best += 1
+        self.best[j] = best
+
+    def next_position(self, j):
+        return self.best[j]
+
+    def exhausted(self):
+        return all(
+            best >= len(l_value)
+            for best, l_value in zip(self.best, self.sorted_lists)
+        )
+
+    def threshold(self):
+        # Unseen items of a fully seen list score 0 in it
+        threshold = 0
+        for best, l_value in zip(self.best, self.sorted_lists):
+            if best >= len(l_value):
+                continue
+            threshold += l_value[max(best - 1, 0)][1]
+        return threshold
+
+
+def _init_stats(stats):
+    if stats is None:
+        stats = {}
+    stats['sorted_accesses'] = 0
+    stats['random_accesses'] = 0
+    return stats
+
+
+def _random_access(sorted_lists, item, skip, stats):
+    """Overall score of an item in every list except the skip-th"""
+    score = 0
+    for j, l_value in enumerate(sorted_lists):
+        if j == skip:
+            continue
+        stats['random_accesses'] += 1
+        score += l_value.scores.get(item, 0)
+    return score
+
+
+def _random_access_positions(sorted_lists, tracker, item, skip, stats):
+    """
+    Overall score of an item in every list except the skip-th, marking it as
+    seen in the lists where it was found
+    """
+    score = 0
+    for j, l_value in enumerate(sorted_lists):
+        if j == skip:
+            continue
+        stats['random_accesses'] += 1
+        value = l_value.scores.get(item)
+        if value is not None:
+            score += value
+            tracker.mark(j, item)
+    return score
+
+
+def _push(top, k, item, score):
+    """Keep the k best items in a min-heap of (score, item)"""
+    if len(top) < k:
+        heapq.heappush(top, (score, item))
+    elif score > top[0][0]:
+        heapq.heapreplace(top, (score, item))
+
+
+def _sorted_top(top):
+    return [(item, score) for score, item in sorted(top, key=lambda x: -x[0])]
 
 
 def _get_sorted_lists(m):
     """
-    Converts the elements of the database into sorted lists by descending score
+    Converts the elements of the database into lazily sorted lists by
+    descending score
     """
-    sorted_lists = {}
-    for l_key, l_value in m.items():
-        s = []
-        for key, value in l_value.items():
-            s.append((key, value))
-        sorted_lists[l_key] = sorted(s, key=lambda x: -x[1])
-    return sorted_lists
\ No newline at end of file
+    return [_SortedList(l_value) for l_value in m.values()]
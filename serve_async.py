@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import logging
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from plays import create_app
+
+"""
+Asynchronous server of the plays API, on gevent's event loop
+
+Serves the Flask app with gevent's WSGI server, one greenlet per request.
+The standard library is monkey patched before anything else is imported, so
+the Cassandra driver uses its gevent connection class and waiting on a
+ResponseFuture only suspends the greenlet of the request: a single process
+keeps the queries of thousands of get_top requests in flight without a
+thread per request. Streamed responses are sent as they are generated.
+
+Usage:
+    APP_CONFIG=production python serve_async.py --port 5000
+"""
+
+logger = logging.getLogger()
+
+
+def serve(app, host='127.0.0.1', port=5000, connections=1000):
+    """WSGI server of the app, serving at most connections at once"""
+    return WSGIServer((host, port), app, spawn=Pool(connections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Asynchronous server of the plays API')
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('-c', '--connections', type=int, default=1000,
+                        help='Connections served at once')
+    args = parser.parse_args()
+
+    app = create_app(os.getenv('APP_CONFIG', 'default'))
+    server = serve(app, args.host, args.port, args.connections)
+    logger.info("Serving on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
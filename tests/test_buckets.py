@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import itertools
+import random
+import unittest
+from datetime import datetime, timedelta
+
+import dateutil.tz
+
+from plays.models import (
+    RESOLUTIONS, _bucket_start, _hour_bucket, _month_bucket, _month_buckets,
+    _next_bucket, _plan_buckets
+)
+
+
+def random_window(rnd, days):
+    start = datetime(2015, 1, 1) + timedelta(hours=rnd.randint(0, 3 * 365 * 24))
+    return start, start + timedelta(hours=rnd.randint(0, days * 24))
+
+
+class MonthBucketsTest(unittest.TestCase):
+
+    def test_boundaries(self):
+        self.assertEqual(
+            _month_buckets(datetime(2015, 11, 30, 23), datetime(2016, 2, 1)),
+            [201511, 201512, 201601, 201602]
+        )
+        self.assertEqual(
+            _month_buckets(datetime(2015, 12, 31, 23, 59, 59, 999999), datetime(2016, 1, 1)),
+            [201512, 201601]
+        )
+        self.assertEqual(_month_buckets(datetime(2016, 1, 1), datetime(2016, 1, 31)), [201601])
+        self.assertEqual(_month_buckets(datetime(2016, 2, 1), datetime(2016, 1, 31)), [])
+
+    def test_utc(self):
+        # 00:30 on January 1st at UTC+1 is still December in UTC
+        start = datetime(2016, 1, 1, 0, 30, tzinfo=dateutil.tz.tzoffset(None, 3600))
+        self.assertEqual(_month_bucket(start), 201512)
+        self.assertEqual(_hour_bucket(start), datetime(2015, 12, 31, 23))
+        self.assertEqual(_month_buckets(start, start + timedelta(hours=1)), [201512, 201601])
+
+        end = datetime(2016, 2, 29, 23, 30, tzinfo=dateutil.tz.tzoffset(None, -3600))
+        self.assertEqual(_month_buckets(end - timedelta(hours=1), end), [201602, 201603])
+
+    def test_random_windows(self):
+        rnd = random.Random(1)
+        for _ in range(50):
+            start, end = random_window(rnd, 400)
+            buckets = _month_buckets(start, end)
+            # Every play of the window is in one of the buckets, which are
+            # consecutive months from the first to the last play's
+            hour = start
+            while hour <= end:
+                self.assertIn(_month_bucket(hour), buckets)
+                hour += timedelta(hours=1)
+            self.assertEqual(buckets[0], _month_bucket(start))
+            self.assertEqual(buckets[-1], _month_bucket(end))
+            for previous, bucket in zip(buckets, buckets[1:]):
+                month = previous % 100
+                self.assertEqual(
+                    bucket, previous + 1 if month < 12 else (previous // 100 + 1) * 100 + 1
+                )
+
+
+class PlanBucketsTest(unittest.TestCase):
+    """_plan_buckets must tile the window with aligned buckets"""
+
+    def assertTiles(self, start, end, resolutions):
+        buckets = _plan_buckets(start, end, resolutions)
+        message = '%s - %s %r: %r' % (start, end, resolutions, buckets)
+
+        # Buckets follow each other from the start to the end of the window,
+        # so that every hour is covered exactly once
+        position = start
+        for resolution, bucket in buckets:
+            self.assertIn(resolution, tuple(resolutions) + ('hour', ), message)
+            self.assertEqual(bucket, _bucket_start(resolution, bucket), message)
+            self.assertEqual(bucket, position, message)
+            position = _next_bucket(resolution, bucket)
+        self.assertEqual(position, max(start, end), message)
+        return buckets
+
+    def test_boundaries(self):
+        all_resolutions = ('day', 'week', 'month')
+        # Exactly a month, a week and a day
+        self.assertEqual(
+            self.assertTiles(datetime(2016, 2, 1), datetime(2016, 3, 1), all_resolutions),
+            [('month', datetime(2016, 2, 1))]
+        )
+        self.assertEqual(
+            self.assertTiles(datetime(2016, 1, 4), datetime(2016, 1, 11), all_resolutions),
+            [('week', datetime(2016, 1, 4))]
+        )
+        self.assertEqual(
+            self.assertTiles(datetime(2016, 1, 4), datetime(2016, 1, 5), all_resolutions),
+            [('day', datetime(2016, 1, 4))]
+        )
+        # Across a year end, with weeks overlapping both months
+        self.assertEqual(
+            self.assertTiles(datetime(2015, 12, 28, 23), datetime(2016, 2, 2, 1), all_resolutions),
+            [('hour', datetime(2015, 12, 28, 23)), ('day', datetime(2015, 12, 29)),
+             ('day', datetime(2015, 12, 30)), ('day', datetime(2015, 12, 31)),
+             ('month', datetime(2016, 1, 1)), ('day', datetime(2016, 2, 1)),
+             ('hour', datetime(2016, 2, 2, 0))]
+        )
+        self.assertEqual(self.assertTiles(datetime(2016, 1, 1), datetime(2016, 1, 1), ()), [])
+
+    def test_random_windows(self):
+        rnd = random.Random(1)
+        combinations = [
+            combination
+            for n in range(len(RESOLUTIONS) + 1)
+            for combination in itertools.combinations(RESOLUTIONS, n)
+        ]
+        for _ in range(100):
+            start, end = random_window(rnd, rnd.choice((2, 40, 400)))
+            for resolutions in combinations:
+                self.assertTiles(start, end, resolutions)
+
+
+if __name__ == '__main__':
+    unittest.main()
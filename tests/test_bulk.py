@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from plays import create_app
+from plays import db as database
+from plays.bulk import import_plays
+
+CHANNEL = u'Channel1'
+PLAYS = [
+    {'channel': CHANNEL, 'start': u'2016-01-01T10:0%d:00' % i,
+     'end': u'2016-01-01T10:0%d:00' % i, 'title': u'Song%d' % i, 'performer': u'Performer'}
+    for i in range(5)
+]
+
+_app = None
+
+
+def app():
+    """The app is built once, its blueprints are module singletons"""
+    global _app
+    if _app is None:
+        _app = create_app('testing')
+    return _app
+
+
+class ImportResumeTest(unittest.TestCase):
+    """Resumed imports with the memory storage"""
+
+    def setUp(self):
+        app()
+        database.storage.truncate()
+        self.dir = tempfile.mkdtemp()
+        self.path = self.write_plays('plays.ndjson')
+        self.checkpoint = self.path + '.checkpoint'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_plays(self, name):
+        path = os.path.join(self.dir, name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for play in PLAYS:
+                f.write(json.dumps(play, sort_keys=True) + u'\n')
+        return path
+
+    def write_checkpoint(self, path, state):
+        with open(path, 'w') as f:
+            json.dump(state, f)
+
+    def titles(self):
+        rows = database.storage.get_channel_plays(
+            CHANNEL, datetime(2016, 1, 1), datetime(2016, 1, 2)
+        )
+        return sorted(row.title for row in rows)
+
+    def test_resume(self):
+        # Batches 0 and 2 of three were written, with batches of two lines
+        self.write_checkpoint(self.checkpoint, {
+            'path': os.path.abspath(self.path), 'batch_size': 2, 'next': 1, 'done': [2]
+        })
+        failed = import_plays(self.path, workers=0, batch_size=100, resume=True)
+        self.assertEqual(failed, 0)
+        self.assertEqual(self.titles(), [u'Song2', u'Song3'])
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.assertEqual(state['next'], 3)
+        self.assertEqual(state['done'], [])
+        self.assertEqual(state['batch_size'], 2)
+
+    def test_resume_without_checkpoint(self):
+        self.assertEqual(import_plays(self.path, workers=0, batch_size=2, resume=True), 0)
+        self.assertEqual(self.titles(), [u'Song%d' % i for i in range(5)])
+
+    def test_checkpoint_of_another_file(self):
+        other = self.write_plays('other.ndjson')
+        self.write_checkpoint(self.checkpoint, {
+            'path': os.path.abspath(other), 'batch_size': 2, 'next': 1, 'done': []
+        })
+        self.assertRaises(
+            ValueError, import_plays, self.path, workers=0, batch_size=2, resume=True
+        )
+        self.assertEqual(self.titles(), [])
+
+        # Without --resume the checkpoint is replaced
+        self.assertEqual(import_plays(self.path, workers=0, batch_size=2), 0)
+        self.assertEqual(len(self.titles()), len(PLAYS))
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['path'], os.path.abspath(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
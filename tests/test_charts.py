@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from plays.charts import ChartStore, WEEK, _week
+from plays.storage import MemoryStorage
+
+Play = namedtuple('Play', 'channel start end title performer')
+
+
+class ChartStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.charts = ChartStore(self.storage, {'group': [u'Channel1', u'Channel2']}, size=5)
+        self.week = _week(datetime.utcnow())
+
+    def add(self, channel, minutes, title):
+        play = Play(channel, self.week + timedelta(minutes=minutes), None, title, u'Performer')
+        with self.charts.writing():
+            self.storage.add_play(play)
+            self.charts.add(play.channel, play.start, (play.title, play.performer))
+
+    def plays(self, end=None):
+        top = self.charts.get(
+            [u'Channel2', u'Channel1'], self.week, end or self.week + WEEK, 5
+        )
+        return sum(song['plays'] for song in top)
+
+    def test_window(self):
+        self.charts.refresh()
+        self.add(u'Channel1', 1, u'Song1')
+        self.assertEqual(self.plays(), 1)
+        self.assertEqual(self.plays(self.week + WEEK - timedelta(seconds=1)), 1)
+        self.assertIsNone(self.charts.get([u'Channel1'], self.week, self.week + WEEK, 5))
+        self.assertIsNone(self.charts.get(
+            [u'Channel1', u'Channel2'], self.week, self.week + WEEK + timedelta(seconds=1), 5
+        ))
+
+    def test_reloads_during_writes(self):
+        self.charts.refresh()
+        stop = threading.Event()
+
+        def reload():
+            while not stop.is_set():
+                self.charts.refresh()
+
+        def write(channel):
+            for i in range(200):
+                self.add(channel, i, u'Song%d' % (i % 3))
+
+        reloader = threading.Thread(target=reload)
+        reloader.start()
+        writers = [threading.Thread(target=write, args=(c,)) for c in (u'Channel1', u'Channel2')]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        stop.set()
+        reloader.join()
+
+        self.assertEqual(self.plays(), 400)
+        self.charts.refresh()
+        self.assertEqual(self.plays(), 400)
+
+    def test_frozen_chart_of_another_process(self):
+        previous = self.week - WEEK
+        self.storage.add_chart('group', previous, json.dumps([[u'Song1', u'Performer1', 3]]))
+        self.assertEqual(
+            self.storage.add_chart('group', previous, json.dumps([])),
+            json.dumps([[u'Song1', u'Performer1', 3]])
+        )
+        self.charts.refresh()
+        self.assertEqual(self.charts._previous['group'], [((u'Song1', u'Performer1'), 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
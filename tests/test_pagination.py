@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import unittest
+
+from plays import create_app
+
+CHANNEL = u'Channel1'
+SONG = {'title': u'Song1', 'performer': u'Performer1'}
+
+# Plays across a year boundary, some of them less than a second apart
+STARTS = [
+    u'2015-12-31T23:00:00', u'2015-12-31T23:57:00.250000', u'2015-12-31T23:57:00.500000',
+    u'2016-01-01T00:00:00', u'2016-01-01T00:00:01', u'2016-01-31T23:59:59',
+    u'2016-02-01T00:00:00',
+]
+WINDOW = {'start': u'2015-12-01T00:00:00', 'end': u'2016-03-01T00:00:00'}
+
+_app = None
+
+
+def app():
+    """The app is built once, its blueprints are module singletons"""
+    global _app
+    if _app is None:
+        _app = create_app('testing')
+    return _app
+
+
+class PaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app().test_client()
+        self.post('/truncate_tables', {'truncate': True})
+        rep = self.post('/add_plays', [
+            dict(SONG, channel=CHANNEL, start=start, end=start)
+            for start in STARTS
+        ])
+        self.assertEqual(rep['result']['inserted'], len(STARTS))
+
+    def post(self, path, data):
+        response = self.client.post(
+            path, data=json.dumps(data), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.data.decode('utf-8'))
+
+    def get(self, path, status=200, **params):
+        response = self.client.get(path, query_string=dict(WINDOW, **params))
+        self.assertEqual(response.status_code, status, response.data)
+        return json.loads(response.data.decode('utf-8'))
+
+    def pages(self, path, page_size, **params):
+        """Plays of every page, following the cursors"""
+        plays = []
+        cursor = None
+        for _ in range(len(STARTS) + 2):
+            if cursor:
+                params['cursor'] = cursor
+            rep = self.get(path, page_size=page_size, **params)
+            self.assertLessEqual(len(rep['result']), page_size)
+            plays.extend(rep['result'])
+            cursor = rep['cursor']
+            if cursor is None:
+                return plays
+        self.fail('The cursors of %s do not end' % path)
+
+    def test_pages(self):
+        for path, params in (('/get_channel_plays', {'channel': CHANNEL}),
+                             ('/get_song_plays', SONG)):
+            expected = self.get(path, **params)['result']
+            self.assertEqual(len(expected), len(STARTS))
+            for page_size in (1, 2, 3, len(STARTS) - 1, len(STARTS), len(STARTS) + 1):
+                self.assertEqual(self.pages(path, page_size, **params), expected)
+                self.assertEqual(
+                    self.pages(path, page_size, stream='json', **params), expected
+                )
+
+    def test_last_page(self):
+        # A full last page has a cursor to an empty page
+        rep = self.get('/get_channel_plays', channel=CHANNEL, page_size=len(STARTS))
+        self.assertIsNotNone(rep['cursor'])
+        rep = self.get('/get_channel_plays', channel=CHANNEL, page_size=len(STARTS),
+                       cursor=rep['cursor'])
+        self.assertEqual(rep['result'], [])
+        self.assertIsNone(rep['cursor'])
+
+    def test_invalid_cursor(self):
+        for cursor in (u'!!!', base64.urlsafe_b64encode(b'not a date').decode('ascii'),
+                       base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii'), u'\xe9'):
+            rep = self.get('/get_channel_plays', 400, channel=CHANNEL, page_size=2,
+                           cursor=cursor)
+            self.assertEqual(rep['code'], 400)
+
+    def test_ndjson_pages(self):
+        self.get('/get_channel_plays', 400, channel=CHANNEL, page_size=2, stream='ndjson')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import dateutil.tz
+from marshmallow.utils import UTC
+
+from plays.cache import _naive_utc
+from plays.schemas import (
+    play_by_channel_schema, play_by_song_schema,
+    play_by_channel_serializer, play_by_song_serializer
+)
+from plays.storage import MemoryStorage
+
+START = datetime(2014, 1, 1, 1, 0, 0)
+
+VALUES = {
+    'channel': [u'Channel1', u'Ch\xe4nnel "2"', u'', None],
+    'title': [u'Song1', u'S\xf6ng\n3', u'♫', None],
+    'performer': [u'Performer1', u'P\xearformer3', u'\\', None],
+    'start': [
+        START,
+        START + timedelta(microseconds=123000),
+        UTC.localize(START),
+        datetime(2016, 2, 29, 23, 59, 59, tzinfo=dateutil.tz.tzoffset(None, 19800)),
+    ],
+    'end': [START + timedelta(minutes=3), None, UTC.localize(START), START],
+}
+
+
+class RowSerializerTest(unittest.TestCase):
+    """The fast path serializers must produce the same documents as the schemas"""
+
+    def assertSameDump(self, schema, serializer, row):
+        expected = schema.dump(row)
+        self.assertEqual(expected.errors, {})
+        self.assertEqual(
+            json.dumps(serializer.dump(row), sort_keys=True),
+            json.dumps(expected.data, sort_keys=True),
+            'Mismatch for %r' % (row,)
+        )
+
+    def test_rows(self):
+        for schema, serializer in ((play_by_channel_schema, play_by_channel_serializer),
+                                   (play_by_song_schema, play_by_song_serializer)):
+            Row = namedtuple('Row', serializer.columns)
+            for i in range(len(VALUES['start'])):
+                row = Row(*[VALUES[column][i] for column in serializer.columns])
+                self.assertSameDump(schema, serializer, row)
+
+    def test_storage_rows(self):
+        Play = namedtuple('Play', 'channel start end title performer')
+        storage = MemoryStorage()
+        for i in range(len(VALUES['start'])):
+            storage.add_play(Play(
+                u'Channel', VALUES['start'][i], VALUES['end'][i],
+                VALUES['title'][i] or u'Song', VALUES['performer'][i] or u'Performer'
+            ))
+
+        start, end = START - timedelta(days=1), START + timedelta(days=3650)
+        channel_rows = storage.get_channel_plays(u'Channel', start, end)
+        # Plays of the channel with the same start in UTC overwrite each other
+        self.assertEqual(
+            len(channel_rows), len(set(_naive_utc(dt) for dt in VALUES['start']))
+        )
+        for row in channel_rows:
+            self.assertSameDump(play_by_channel_schema, play_by_channel_serializer, row)
+            song_rows = storage.get_song_plays(row.title, row.performer, start, end)
+            self.assertTrue(song_rows)
+            for song_row in song_rows:
+                self.assertSameDump(play_by_song_schema, play_by_song_serializer, song_row)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+try:
+    from urllib2 import Request, urlopen
+    from urllib import urlencode
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlencode
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLAYS = [
+    {'channel': u'Channel1', 'start': u'2016-01-0%dT10:00:00' % day,
+     'end': u'2016-01-0%dT10:03:00' % day, 'title': u'Song%d' % (day % 2),
+     'performer': u'Performer'}
+    for day in range(1, 8)
+]
+
+
+@unittest.skipIf(gevent is None, 'gevent is not installed')
+class ServeAsyncTest(unittest.TestCase):
+    """Starts serve_async.py with the memory storage and queries it"""
+
+    @classmethod
+    def setUpClass(cls):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        cls.port = s.getsockname()[1]
+        s.close()
+
+        env = dict(os.environ, APP_CONFIG='testing')
+        cls.server = subprocess.Popen(
+            [sys.executable, 'serve_async.py', '--port', str(cls.port)],
+            cwd=ROOT, env=env
+        )
+        deadline = time.time() + 20
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), 1).close()
+                break
+            except socket.error:
+                if cls.server.poll() is not None or time.time() > deadline:
+                    cls.tearDownClass()
+                    raise
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.poll() is None:
+            cls.server.terminate()
+        cls.server.wait()
+
+    def request(self, path, params=None, data=None):
+        url = 'http://127.0.0.1:%d%s' % (self.port, path)
+        if params:
+            url += '?' + urlencode(params)
+        request = Request(url)
+        if data is not None:
+            request = Request(url, json.dumps(data).encode('utf-8'),
+                              {'Content-Type': 'application/json'})
+        response = urlopen(request, timeout=10)
+        try:
+            return response.info(), json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+    def test_endpoints(self):
+        self.request('/truncate_tables', data={'truncate': True})
+        _, rep = self.request('/add_plays', data=PLAYS)
+        self.assertEqual(rep['result']['inserted'], len(PLAYS))
+
+        window = {'start': '2016-01-01T00:00:00', 'end': '2016-01-08T00:00:00'}
+        headers, rep = self.request(
+            '/get_channel_plays', dict(window, channel='Channel1', stream='json')
+        )
+        self.assertEqual(headers.get('Transfer-Encoding'), 'chunked')
+        self.assertEqual(len(rep['result']), len(PLAYS))
+
+        # Concurrent requests are served by the greenlets of the process
+        results = []
+
+        def get_top():
+            results.append(self.request(
+                '/get_top', dict(window, channels='["Channel1"]', limit=2)
+            )[1]['result'])
+
+        threads = [threading.Thread(target=get_top) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 20)
+        for top in results:
+            self.assertEqual(
+                [(song['title'], song['plays']) for song in top],
+                [(u'Song1', 4), (u'Song0', 3)]
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from plays.sketch import SketchStore
+from plays.storage import MemoryStorage
+
+START = datetime(2016, 1, 1, 10, 0, 0)
+SONG = (u'Song1', u'Performer1')
+
+
+class FailingStorage(MemoryStorage):
+    """Memory storage whose next writes of sketches fail"""
+    failures = 0
+
+    def add_sketches(self, sketches):
+        if self.failures:
+            self.failures -= 1
+            # Part of the sketches is written before the failure
+            MemoryStorage.add_sketches(self, sketches[:1])
+            raise IOError('Write failed')
+        MemoryStorage.add_sketches(self, sketches)
+
+
+def plays(sketch, song=SONG):
+    return dict((item, count) for item, count, _ in sketch.top(10)).get(song, 0)
+
+
+class SketchStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = FailingStorage()
+        self.store = SketchStore(self.storage, cache_ttl=None)
+        self.window = (START, START + timedelta(hours=2))
+
+    def add(self, count, channel=u'Channel1', song=SONG):
+        for i in range(count):
+            self.store.add(channel, START + timedelta(minutes=3 * i), song)
+
+    def get(self):
+        return self.store.get([u'Channel1', u'Channel2'], *self.window)
+
+    def test_reposts_are_counted_once(self):
+        self.add(6)
+        self.add(6)
+        self.assertEqual(plays(self.get()), 6)
+
+    def test_flush(self):
+        self.add(6)
+        self.store.flush()
+        self.add(2, channel=u'Channel2')
+        self.assertEqual(plays(self.get()), 8)
+
+        # Read from the storage only
+        self.store.flush()
+        self.store.cache.clear()
+        self.assertEqual(plays(self.get()), 8)
+
+    def test_failed_flush(self):
+        self.add(3)
+        self.add(3, channel=u'Channel2')
+        self.storage.failures = 1
+        self.assertRaises(IOError, self.store.flush)
+        self.store.cache.clear()
+        self.assertEqual(plays(self.get()), 6)
+
+        # The sketches are written again under the same ids
+        self.add(1, channel=u'Channel2', song=(u'Song2', u'Performer2'))
+        self.store.flush()
+        self.store.cache.clear()
+        self.assertEqual(plays(self.get()), 6)
+        self.assertEqual(plays(self.get(), (u'Song2', u'Performer2')), 1)
+        self.assertEqual(sum(len(s) for s in self.storage.sketches.values()), 3)
+
+    def test_add_during_get(self):
+        # Adds evict songs from the full cached sketches that get merges
+        store = SketchStore(MemoryStorage(), capacity=5, cache_ttl=None)
+        store.add(u'Channel1', START, SONG)
+        store.get([u'Channel1'], *self.window)
+        errors = []
+        stop = threading.Event()
+
+        def add():
+            i = 0
+            while not stop.is_set():
+                store.add(u'Channel1', START + timedelta(seconds=i), (u'Song%d' % i, u''))
+                i += 1
+
+        def get():
+            try:
+                for _ in range(2000):
+                    store.get([u'Channel1'], *self.window)
+            except Exception as e:
+                errors.append(e)
+
+        adder = threading.Thread(target=add)
+        adder.start()
+        getters = [threading.Thread(target=get) for _ in range(2)]
+        for getter in getters:
+            getter.start()
+        for getter in getters:
+            getter.join()
+        stop.set()
+        adder.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
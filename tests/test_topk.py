@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+
+from plays import topk
+
+
+def brute_force(m):
+    """Overall score of every item"""
+    totals = {}
+    for l_value in m.values():
+        for item, score in l_value.items():
+            totals[item] = totals.get(item, 0) + score
+    return totals
+
+
+def database(rnd, lists, items, max_score):
+    """Random lists of random subsets of the items. Small scores make ties"""
+    return dict(
+        ('list%d' % i, dict(
+            ('item%d' % item, rnd.randint(1, max_score))
+            for item in rnd.sample(range(items), rnd.randint(0, items))
+        ))
+        for i in range(lists)
+    )
+
+
+class TopkTest(unittest.TestCase):
+    """Every algorithm must find a top k of the brute force overall scores"""
+
+    def assertTop(self, m, k):
+        totals = brute_force(m)
+        expected = sorted(totals.values(), reverse=True)[:max(k, 0)]
+        for name, algorithm in sorted(topk.ALGORITHMS.items()):
+            stats = {}
+            top = algorithm(m, k, stats)
+            message = '%s, k=%d, m=%r: %r' % (name, k, m, top)
+            # Ties may be broken either way, so the scores are compared, and
+            # every item must come with its overall score
+            self.assertEqual([score for _, score in top], expected, message)
+            self.assertEqual(len(set(item for item, _ in top)), len(top), message)
+            for item, score in top:
+                self.assertEqual(score, totals[item], message)
+            self.assertIn('sorted_accesses', stats)
+            self.assertIn('random_accesses', stats)
+
+    def check(self):
+        rnd = random.Random(1)
+        for _ in range(300):
+            m = database(rnd, rnd.randint(1, 5), rnd.randint(1, 30), rnd.choice((3, 100)))
+            for k in (1, 2, 5, 10, 40):
+                self.assertTop(m, k)
+
+        self.assertTop({}, 5)
+        self.assertTop({'list1': {}, 'list2': {}}, 5)
+        self.assertTop({'list1': {'item1': 1}}, 0)
+        # Every item ties
+        self.assertTop({
+            'list1': dict(('item%d' % i, 2) for i in range(10)),
+            'list2': dict(('item%d' % i, 1) for i in range(5, 15)),
+        }, 5)
+        # k larger than the number of items
+        self.assertTop({'list1': {'item1': 3, 'item2': 1}, 'list2': {'item3': 2}}, 10)
+
+    def test_without_numpy(self):
+        numpy, topk.numpy = topk.numpy, None
+        try:
+            self.check()
+        finally:
+            topk.numpy = numpy
+
+    @unittest.skipIf(topk.numpy is None, 'NumPy is not installed')
+    def test_with_numpy(self):
+        self.check()
+
+
+if __name__ == '__main__':
+    unittest.main()